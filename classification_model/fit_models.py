@@ -0,0 +1,92 @@
+import argparse
+import logging
+import os
+import pickle
+import warnings
+from itertools import product
+
+from result_directories import ResultDirectories
+from pycsca.classification_test import get_final_estimator
+from pycsca.classifiers import classifiers_space
+from pycsca.constants import *
+from pycsca.csv_reader import CSVReader
+from pycsca.model_store import ModelStore
+from pycsca.plot_utils import RANDOM_FOREST_CLASSIFIER, has_learning_curve
+from pycsca.utils import setup_logging, str2bool
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--folder', required=True,
+                        help='Folder that contains the input files Packets.pcap and Client Requests.csv '
+                             'and that the output files will be written to')
+    parser.add_argument('-lr', '--learning_curves', type=str2bool, nargs='?', const=True, default=False,
+                        help='Additionally fit the classifiers whose learning curves are plotted')
+    parser.add_argument('-a', '--all', type=str2bool, nargs='?', const=True, default=False,
+                        help='Fit the final models of all classifiers and labels, not only the vulnerable ones')
+    parser.add_argument('-nj', '--n_jobs', type=int, default=8, help='Number of jobs to be used for parallelism')
+    args = parser.parse_args()
+    folder = args.folder
+    n_jobs = int(args.n_jobs)
+
+    result_dirs = ResultDirectories(folder=folder)
+    if not os.path.exists(result_dirs.accuracies_file):
+        raise ValueError("The learning simulations are not done yet")
+    with open(result_dirs.accuracies_file, 'rb') as f:
+        metrics_dictionary = pickle.load(f)
+    result_dirs.debug_level = metrics_dictionary[DEBUG_LEVEL]
+    setup_logging(log_path=result_dirs.learning_log_file)
+    logger = logging.getLogger("FitModels")
+    logger.info("Arguments {}".format(args))
+    if args.all:
+        vulnerable_classes = None
+    elif os.path.exists(result_dirs.vulnerable_file):
+        with open(result_dirs.vulnerable_file, 'rb') as f:
+            vulnerable_classes = pickle.load(f)[P_VALUE_COLUMN]
+    else:
+        raise ValueError("The p-values are not calculated yet, run pvalues_calculation.py first or fit --all models")
+    logger.info("Vulnerable classes are {}".format(vulnerable_classes))
+
+    if args.all:
+        classifiers = [c for c, _, _ in classifiers_space]
+    elif args.learning_curves:
+        # The classifiers whose final models the plots use, see pycsca.plot_utils
+        classifiers = [c for c, _, _ in classifiers_space if has_learning_curve(c.__name__)]
+    else:
+        classifiers = [c for c, _, _ in classifiers_space if c.__name__ == RANDOM_FOREST_CLASSIFIER]
+
+    csv_reader = CSVReader(folder=folder, seed=42)
+    model_store = ModelStore(result_dirs.models_folder)
+    fitted, reused = 0, 0
+    for missing_ccs_fin, (label, j) in product(csv_reader.ccs_fin_array, list(csv_reader.label_mapping.items())):
+        if j == 0:
+            continue
+        if missing_ccs_fin:
+            label = label + ' Missing-CCS-FIN'
+        if vulnerable_classes is not None and label not in vulnerable_classes:
+            continue
+        x, y = None, None
+        for classifier in classifiers:
+            cls_name = classifier.__name__
+            scores_m = metrics_dictionary.get(SCORE_KEY_FORMAT.format(cls_name, label), None)
+            if scores_m is None:
+                logger.info("Classifier {} is not evaluated for label {}, skipping".format(cls_name, label))
+                continue
+            estimator = get_final_estimator(classifier, scores_m[BEST_PARAMETERS])
+            if model_store.contains(cls_name, label, estimator.get_params()):
+                reused += 1
+                continue
+            if 'n_jobs' in estimator.get_params():
+                estimator.set_params(n_jobs=n_jobs)
+            if x is None:
+                x, y = csv_reader.get_data_class_label(class_label=j, missing_ccs_fin=missing_ccs_fin)
+            logger.info("Fitting the final model of classifier {} for label {}".format(cls_name, label))
+            try:
+                estimator.fit(x, y)
+            except Exception as error:
+                logger.error("Classifier {} failed for label {} with error {}".format(cls_name, label, error))
+                continue
+            model_store.add_entry(model_store.save(estimator, cls_name, label, missing_ccs_fin,
+                                                   estimator.get_params()))
+            fitted += 1
+    logger.info("Fitted {} final models, {} were already stored".format(fitted, reused))
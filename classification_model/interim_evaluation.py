@@ -0,0 +1,137 @@
+import argparse
+import copy
+import glob
+import logging
+import os
+import time
+import warnings
+from datetime import datetime
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+
+from result_directories import ResultDirectories
+from pycsca.classification_test import evaluate_fold
+from pycsca.classifiers import classifiers_space
+from pycsca.constants import *
+from pycsca.csv_reader import CSVReader
+from pycsca.statistical_tests import fisher_exact_batch, holm_bonferroni_batch
+from pycsca.utils import setup_logging, str2bool
+
+INTERIM_COLUMNS = ['Time', 'Instances', DATASET, MODEL, ACCURACY, P_VALUE_COLUMN, P_VALUE_COLUMN + '-corrected',
+                   P_VALUE_COLUMN + '-rejected']
+
+
+def get_dataset_state(folder):
+    """
+    The files of the feature store and their modification times, the dataset only needs to be evaluated again if
+    they changed.
+    """
+    files = [os.path.join(folder, FEATURES_FILE)] + glob.glob(os.path.join(folder, FEATURE_PARTS_FOLDER, '*.parquet'))
+    return tuple(sorted((f, os.path.getmtime(f)) for f in files if os.path.exists(f)))
+
+
+def extraction_finished(folder):
+    # The extraction writes the complete feature store and removes the parts once the capture is done
+    return os.path.exists(os.path.join(folder, FEATURES_FILE)) and \
+           not os.path.isdir(os.path.join(folder, FEATURE_PARTS_FOLDER))
+
+
+def evaluate_label(classifiers, x, y, cv_iterations, n_jobs, random_state=42):
+    """
+    Evaluates the classifiers with their default parameters, without hyper-parameter optimization, and returns their
+    mean accuracy and median Fisher exact p-value over the folds.
+    """
+    cv_iterator = StratifiedKFold(n_splits=cv_iterations, shuffle=True, random_state=random_state)
+    inner_cv_iterator = StratifiedKFold(n_splits=3, shuffle=True, random_state=random_state)
+    results = []
+    for classifier, params, search_space in classifiers:
+        params = copy.deepcopy(params)
+        if 'n_jobs' in params.keys():
+            params['n_jobs'] = n_jobs
+        if 'random_state' in params.keys():
+            params['random_state'] = random_state
+        confusion_matrices, accuracies = [], []
+        for i, (train_index, test_index) in enumerate(cv_iterator.split(x, y)):
+            fold_scores = evaluate_fold(classifier, params, search_space, inner_cv_iterator, 0, x[train_index],
+                                        x[test_index], y[train_index], y[test_index], i, random_state=random_state)
+            confusion_matrices.extend(fold_scores[CONFUSION_MATRICES])
+            accuracies.extend(fold_scores[ACCURACY])
+        p_values = fisher_exact_batch(confusion_matrices)
+        p_value = np.median(p_values) if len(p_values) > 0 else np.nan
+        results.append((classifier.__name__, np.mean(accuracies), p_value))
+    return results
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--folder', required=True,
+                        help='Folder that contains the input files Packets.pcap and Client Requests.csv '
+                             'and that the output files will be written to')
+    parser.add_argument('-cv', '--cv_iterations', type=int, default=10,
+                        help='Number of folds of the interim Cross-Validation')
+    parser.add_argument('-c', '--classifiers', nargs='+',
+                        default=['LogisticRegression', 'RandomForestClassifier', 'ExtraTreesClassifier'],
+                        help='Classifiers evaluated with their default parameters on the growing dataset')
+    parser.add_argument('-in', '--interval', type=float, default=300,
+                        help='Seconds to wait between the interim evaluations')
+    parser.add_argument('-nj', '--n_jobs', type=int, default=8, help='Number of jobs to be used for parallelism')
+    parser.add_argument('-o', '--once', type=str2bool, nargs='?', const=True, default=False,
+                        help='Evaluate the current dataset once and exit, instead of until the extraction finished')
+    args = parser.parse_args()
+    folder = args.folder
+    cv_iterations = int(args.cv_iterations)
+    n_jobs = int(args.n_jobs)
+    interim_classifiers = [c for c in classifiers_space if c[0].__name__ in args.classifiers]
+
+    result_files = ResultDirectories(folder=folder)
+    setup_logging(log_path=result_files.interim_log_file)
+    logger = logging.getLogger("InterimEvaluation")
+    logger.info("Arguments {}".format(args))
+    evaluated_state = None
+    while True:
+        # Check before reading, so the last evaluation sees the complete feature store
+        finished = extraction_finished(folder) or args.once
+        state = get_dataset_state(folder)
+        if state != evaluated_state and len(state) > 0:
+            evaluated_state = state
+            try:
+                csv_reader = CSVReader(folder=folder, seed=42)
+            except (ValueError, KeyError) as error:
+                logger.info("The dataset can not be evaluated yet: {}".format(error))
+                csv_reader = None
+            rows = []
+            if csv_reader is not None:
+                now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                for missing_ccs_fin, (label, j) in product(csv_reader.ccs_fin_array,
+                                                           list(csv_reader.label_mapping.items())):
+                    if j == 0:
+                        continue
+                    x, y = csv_reader.get_data_class_label(class_label=j, missing_ccs_fin=missing_ccs_fin)
+                    if missing_ccs_fin:
+                        label = label + ' Missing-CCS-FIN'
+                    if len(y) == 0 or np.min(np.bincount(y, minlength=2)) < cv_iterations:
+                        logger.info("Not enough instances for label {} yet".format(label))
+                        continue
+                    results = evaluate_label(interim_classifiers, x, y, cv_iterations, n_jobs)
+                    rejected, p_values_corrected = holm_bonferroni_batch([p for _, _, p in results], alpha=0.01)
+                    for (cls_name, accuracy, p_value), p_corrected, reject in zip(results, p_values_corrected,
+                                                                                  rejected):
+                        rows.append([now, len(y), label, cls_name, accuracy, p_value, p_corrected, reject])
+                    if np.any(rejected):
+                        logger.info("Interim verdict with {} instances: the server is vulnerable to {} according to "
+                                    "{} of {} classifiers".format(len(y), label, np.sum(rejected), len(rejected)))
+                    else:
+                        logger.info("Interim verdict with {} instances: no leakage detected for {} yet".format(
+                            len(y), label))
+            if len(rows) > 0:
+                data_frame = pd.DataFrame(rows, columns=INTERIM_COLUMNS)
+                write_header = not os.path.exists(result_files.interim_result_file_path)
+                data_frame.to_csv(result_files.interim_result_file_path, mode='a', header=write_header, index=False)
+        if finished:
+            break
+        time.sleep(args.interval)
+    logger.info("Finished the interim evaluation")
@@ -13,9 +13,9 @@ from sklearn.utils import check_random_state
 from result_directories import ResultDirectories
 from pycsca.constants import *
 from pycsca.csv_reader import CSVReader
-from pycsca.plot_utils import classwise_barplot_for_dataset, \
-    bar_grid_for_dataset, plot_learning_curves_importances
-from pycsca.utils import setup_logging
+from pycsca.plot_utils import get_barplot_tasks, get_learning_curve_importance_tasks, run_render_tasks, \
+    share_loaded_importances
+from pycsca.utils import setup_logging, str2bool
 
 if __name__ == "__main__":
     warnings.simplefilter("ignore")
@@ -24,8 +24,14 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--folder', required=True,
                         help='Folder that contains the input files Packets.pcap and Client Requests.csv '
                              'and that the output files will be written to')
+    parser.add_argument('-nj', '--n_jobs', type=int, default=os.cpu_count(),
+                        help='Number of processes rendering the figures in parallel')
+    parser.add_argument('-lr', '--learning_curves', type=str2bool, nargs='?', const=True, default=False,
+                        help='Additionally plot the learning curves of all classifiers for every label')
     args = parser.parse_args()
     folder = args.folder
+    n_jobs = int(args.n_jobs)
+    mpl.use('Agg')
 
     result_dirs = ResultDirectories(folder=folder)
     if os.path.exists(result_dirs.accuracies_file):
@@ -61,12 +67,13 @@ if __name__ == "__main__":
                   facecolor='white', edgecolor='k', fontsize=10)
 
     extension = 'png'
-    plot_learning_curves_importances(result_dirs, csv_reader, vulnerable_classes_random, extension=extension)
-
-    plts = bar_grid_for_dataset(data_frame, ACCURACY, np.sqrt(cv_iterations_dict[N_SPLITS]), result_dirs.plots_folder,
-                                figsize=sfigsize, extension=extension)
-    plts = classwise_barplot_for_dataset(data_frame, ACCURACY, np.sqrt(cv_iterations_dict[N_SPLITS]),
-                                         result_dirs.plots_folder, figsize=sfigsize, extension=extension)
+    tasks, importance_tasks = get_learning_curve_importance_tasks(result_dirs, csv_reader, vulnerable_classes_random,
+                                                                  extension=extension, plotlr=args.learning_curves,
+                                                                  logger=logger)
+    tasks += get_barplot_tasks(data_frame, ACCURACY, np.sqrt(cv_iterations_dict[N_SPLITS]), result_dirs.plots_folder,
+                               figsize=sfigsize, extension=extension)
+    results = run_render_tasks(tasks, n_jobs=n_jobs, logger=logger)
+    run_render_tasks(share_loaded_importances(importance_tasks, results), n_jobs=n_jobs, logger=logger)
 
     logger.info("Finished Plotting")
     result_dirs.remove_folders()
@@ -5,19 +5,36 @@ import os
 import pandas as pd
 import pickle
 from itertools import product
-from scipy.stats import fisher_exact
-from statsmodels.stats.multitest import multipletests
 from pycsca import *
 from result_directories import ResultDirectories
 
-def holm_bonferroni(data_frame, label, pval_col):
+def holm_bonferroni(data_frame, pval_cols):
+    """
+    Corrects the p-values of the classifiers of every label and p-value column in one call. Returns the p-values,
+    corrected p-values and rejected hypotheses of every (label, p-value column), the baselines are never rejected.
+    """
     searchFor = [RandomClassifier.__name__, MajorityVoting.__name__, PriorClassifier.__name__]
     df = data_frame[~data_frame['Model'].str.contains('|'.join(searchFor))]
-    p_vals = df[df['Dataset'] == label][pval_col].values
-    reject, pvals_corrected, _, alpha = multipletests(p_vals, 0.01, method='holm', is_sorted=False)
-    reject = [False] * len(searchFor) + list(reject)
-    pvals_corrected = [1.0] * len(searchFor) + list(pvals_corrected)
-    return p_vals, pvals_corrected, reject
+    label_index, labels = pd.factorize(df['Dataset'])
+    position = df.groupby('Dataset', sort=False).cumcount().values
+    counts = np.bincount(label_index, minlength=len(labels))
+    # One row of classifiers per label and p-value column, padded with NaN for labels with fewer classifiers
+    p_values = np.full((len(labels), len(pval_cols), counts.max(initial=0)), np.nan)
+    p_values[label_index, :, position] = df[pval_cols].values
+    rejected, pvals_corrected = holm_bonferroni_batch(p_values, alpha=0.01)
+    corrections = dict()
+    for (i, label), (k, pval_col) in product(enumerate(labels), enumerate(pval_cols)):
+        n = counts[i]
+        corrections[(label, pval_col)] = (p_values[i, k, :n],
+                                          [1.0] * len(searchFor) + list(pvals_corrected[i, k, :n]),
+                                          [False] * len(searchFor) + list(rejected[i, k, :n]))
+    return corrections
+
+
+def pad_accuracies(accuracies_list, n_folds):
+    # Classifiers which stopped early have fewer folds, the missing ones are left out of the paired tests
+    return np.array([np.pad(np.asarray(accuracies, dtype=float)[:n_folds], (0, n_folds - len(accuracies[:n_folds])),
+                            constant_values=np.nan) for accuracies in accuracies_list])
 
 
 def get_confidence(value):
@@ -74,6 +91,15 @@ if __name__ == "__main__":
         raise ValueError("The learning simulations are not done yet")
     cv_iterations_dict = metrics_dictionary[CV_ITERATIONS_LABEL]
     result_dirs.debug_level = metrics_dictionary[DEBUG_LEVEL]
+    if cv_iterations_dict[CV_ITERATOR] == 'StratifiedKFold':
+        n_training_folds = cv_iterations_dict[N_SPLITS] - 1
+        n_test_folds = 1
+    elif cv_iterations_dict[CV_ITERATOR] == 'StratifiedShuffleSplit':
+        n_training_folds = 1 - test_size
+        n_test_folds = test_size
+    else:
+        raise ValueError('Cross-Validation technique is does not exist should be {} or {}'.format(cv_choices[0],
+                                                                                                  cv_choices[1]))
     final = []
     for missing_ccs_fin, (label, j) in product(csv_reader.ccs_fin_array, list(csv_reader.label_mapping.items())):
         if j == 0:
@@ -92,7 +118,29 @@ if __name__ == "__main__":
         except:
             logger.info("Skipping p-val calculation class label {}".format(label))
             continue
+        # The paired tests of all classifiers against all baselines are computed at once, as (baseline, classifier)
+        baseline_accs = [random_accs, majority_accs, prior_accs]
+        # A classifier whose training task failed has no scores, it is reported and left out of the tests
+        evaluated_classifiers = []
         for classifier, params, search_space in classifiers_space:
+            if SCORE_KEY_FORMAT.format(classifier.__name__, label) in metrics_dictionary:
+                evaluated_classifiers.append((classifier, params, search_space))
+            else:
+                logger.error("Classifier {} is not evaluated for label {}, skipping it".format(classifier.__name__,
+                                                                                              label))
+        classifier_accs = []
+        for classifier, params, search_space in evaluated_classifiers:
+            scores = metrics_dictionary[SCORE_KEY_FORMAT.format(classifier.__name__, label)]
+            classifier_accs.append(scores[ACCURACY][:scores.get(CV_FOLDS_USED, len(scores[ACCURACY]))])
+        width = max(len(accuracies) for accuracies in baseline_accs + classifier_accs)
+        baseline_matrix = pad_accuracies(baseline_accs, width)
+        accuracy_matrix = pad_accuracies(classifier_accs, width)
+        p_cttests = paired_ttest_batch(baseline_matrix, accuracy_matrix, n_training_folds, n_test_folds,
+                                       correction=True)
+        p_ttests = paired_ttest_batch(baseline_matrix, accuracy_matrix, n_training_folds, n_test_folds,
+                                      correction=False)
+        p_wilcoxes = wilcoxon_signed_rank_test_batch(baseline_matrix, accuracy_matrix)
+        for c, (classifier, params, search_space) in enumerate(evaluated_classifiers):
             cls_name = classifier.__name__
             KEY = SCORE_KEY_FORMAT.format(cls_name, label)
             scores = metrics_dictionary[KEY]
@@ -100,43 +148,29 @@ if __name__ == "__main__":
             logger.info("Classifier {}, p-value calculation {}".format(cls_name, label))
             accuracies = scores[ACCURACY]
             confusion_matrices = scores[CONFUSION_MATRICES]
+            # With early stopping only the first folds were evaluated, pair them with the same folds of the baselines
+            n_folds = scores.get(CV_FOLDS_USED, len(accuracies))
+            if n_folds < len(random_accs):
+                logger.info("Classifier {} stopped early after {} folds".format(cls_name, n_folds))
             cm_single = scores[CONFUSION_MATRIX_SINGLE]
-            if cv_iterations_dict[CV_ITERATOR] == 'StratifiedKFold':
-                n_training_folds = cv_iterations_dict[N_SPLITS] - 1
-                n_test_folds = 1
-            elif cv_iterations_dict[CV_ITERATOR] == 'StratifiedShuffleSplit':
-                n_training_folds = 1 - test_size
-                n_test_folds = test_size
-            else:
-                raise ValueError('Cross-Validation technique is does not exist should be {} or {}'.format(cv_choices[0],
-                                                                                                          cv_choices[1]))
             if np.any(np.isnan(accuracies)):
                 p_random_cttest, p_majority_cttest, p_prior_cttest, p_random_ttest, p_majority_ttest, p_prior_ttest, \
                 p_random_wilcox, p_majority_wilcox, p_prior_wilcox = 1, 1, 1, 1, 1, 1, 1, 1, 1
             else:
-                p_random_cttest = paired_ttest(random_accs, accuracies, n_training_folds, n_test_folds, correction=True)
-                p_majority_cttest = paired_ttest(majority_accs, accuracies, n_training_folds, n_test_folds,
-                                                 correction=True)
-                p_prior_cttest = paired_ttest(prior_accs, accuracies, n_training_folds, n_test_folds, correction=True)
-
-                p_random_ttest = paired_ttest(random_accs, accuracies, n_training_folds, n_test_folds, correction=False)
-                p_majority_ttest = paired_ttest(majority_accs, accuracies, n_training_folds, n_test_folds,
-                                                correction=False)
-                p_prior_ttest = paired_ttest(prior_accs, accuracies, n_training_folds, n_test_folds, correction=False)
-
-                p_majority_wilcox = wilcoxon_signed_rank_test(majority_accs, accuracies)
-                p_random_wilcox = wilcoxon_signed_rank_test(random_accs, accuracies)
-                p_prior_wilcox = wilcoxon_signed_rank_test(prior_accs, accuracies)
+                p_random_cttest, p_majority_cttest, p_prior_cttest = p_cttests[:, c]
+                p_random_ttest, p_majority_ttest, p_prior_ttest = p_ttests[:, c]
+                p_random_wilcox, p_majority_wilcox, p_prior_wilcox = p_wilcoxes[:, c]
 
-            _, pvalue_single = fisher_exact(cm_single)
             confusion_matrix_sum = confusion_matrices.sum(axis=0)
-            _, pvalue_sum = fisher_exact(confusion_matrix_sum)
-            p_values = np.array([fisher_exact(cm)[1] for cm in confusion_matrices])
+            p_values = fisher_exact_batch(np.concatenate([np.reshape(cm_single, (1, 2, 2)),
+                                                          np.reshape(confusion_matrix_sum, (1, 2, 2)),
+                                                          np.reshape(confusion_matrices, (-1, 2, 2))]))
+            pvalue_single, pvalue_sum, p_values = p_values[0], p_values[1], p_values[2:]
             pvalue_mean = np.mean(p_values)
             pvalue_median = np.median(p_values)
             logger.info("P-values {}".format(p_values))
 
-            rejected, pvals_corrected, _, alpha = multipletests(p_values, 0.01, method='holm', is_sorted=False)
+            rejected, pvals_corrected = holm_bonferroni_batch(p_values, alpha=0.01)
             logger.info("Holm Bonnferroni Rejected Hypothesis: {} min: {} max: {}".format(np.sum(rejected),
                                                                                           np.min(pvals_corrected),
                                                                                           np.max(pvals_corrected)))
@@ -163,6 +197,7 @@ if __name__ == "__main__":
     for pval_col in cols_pvals:
         data_frame[pval_col + '-rejected'] = False
 
+    corrections = holm_bonferroni(data_frame, cols_pvals)
     final = []
     for missing_ccs_fin, (label, j) in product(csv_reader.ccs_fin_array, list(csv_reader.label_mapping.items())):
         if j == 0:
@@ -176,7 +211,7 @@ if __name__ == "__main__":
             continue
         one_row = [label]
         for pval_col in cols_pvals:
-            p_vals, pvals_corrected, rejected = holm_bonferroni(data_frame, label, pval_col=pval_col)
+            p_vals, pvals_corrected, rejected = corrections[(label, pval_col)]
             data_frame.loc[data_frame['Dataset'] == label, [pval_col + '-rejected']] = rejected
             # print(label, pval_col, reject)
             # print(data_frame[data_frame['Dataset'] == label][[pval_col + '-corrected', pval_col + '-rejected']])
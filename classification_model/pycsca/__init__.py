@@ -2,6 +2,11 @@ from .baseline import RandomClassifier, MajorityVoting, PriorClassifier
 from .csv_reader import CSVReader
 from .classification_test import optimize_search_cv
 from .classifiers import classifiers_space, custom_dict
+from .fold_cache import FoldCache
+from .hpo_cache import HPOCache, WarmStartBayesSearchCV
+from .hpo_engines import HPO_BAYES, HPO_HALVING, HPO_RANDOM, HPO_ENGINES, get_hpo_search
+from .model_store import ModelStore
+from .standardized_folds import StandardizedFolds
 from .constants import *
 from .statistical_tests import *
 from .utils import *
@@ -4,14 +4,17 @@ import os
 from datetime import datetime
 
 import numpy as np
+from joblib import Parallel, delayed
 from sklearn.dummy import DummyClassifier
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import confusion_matrix, roc_auc_score, f1_score, accuracy_score, cohen_kappa_score, \
     matthews_corrcoef
 from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
-from skopt import BayesSearchCV
-
 from .constants import *
+from .fold_cache import get_data_hash
+from .hpo_cache import ORIGIN_DEFAULT, ORIGIN_SEARCH, ORIGIN_WARM_SEARCH, ORIGIN_REUSED
+from .hpo_engines import HPO_BAYES, get_hpo_search
+from .statistical_tests import fisher_verdict_decided
 from .utils import standardize_features, print_dictionary
 
 
@@ -68,8 +71,100 @@ def get_evaluation(metric_array, metric, y_test, y_pred, logger, i):
     return metric_array
 
 
+def get_parallel_budget(n_jobs, n_folds, inner_splits=3):
+    """
+    Splits the n_jobs between the outer folds, the inner hyper-parameter search and the estimator itself, so that
+    running the outer folds in parallel does not oversubscribe the cores.
+    """
+    outer_jobs = max(1, min(n_folds, n_jobs // inner_splits))
+    estimator_jobs = max(1, n_jobs // (outer_jobs * inner_splits))
+    return outer_jobs, estimator_jobs
+
+
+def evaluate_fold(classifier, params, search_space, inner_cv_iterator, hp_iterations, X_train, X_test, y_train,
+                  y_test, i, val_metric='accuracy', random_state=42, seed_points=None, initial_points=None,
+                  hpo=HPO_BAYES, standardize=True):
+    logger = logging.getLogger('Classifier-Test')
+    # The features of the shared folds are already standardized, see StandardizedFolds
+    if standardize:
+        X_train, X_test = standardize_features(X_train, X_test)
+    model = classifier(**params)
+    origin = ORIGIN_DEFAULT
+    points = []
+    if issubclass(classifier, DummyClassifier) or hp_iterations == 0:
+        model.fit(X_train, y_train)
+    else:
+        logger.info("####################### Starting the iteration {} #######################".format(i + 1))
+        # A search that already knows the evaluated points of earlier folds needs fewer iterations, only the
+        # Bayesian search can be warm-started
+        warm = hpo == HPO_BAYES and seed_points is not None and len(seed_points) > 0
+        n_iter = max(1, hp_iterations // 2) if warm else hp_iterations
+        initial_points = (initial_points or [])[:n_iter - 1] if hpo == HPO_BAYES else []
+        hpo_search = get_hpo_search(hpo, model, search_space, n_iter=n_iter, scoring=val_metric,
+                                    n_jobs=inner_cv_iterator.n_splits, cv=inner_cv_iterator, random_state=random_state,
+                                    seed_points=seed_points, initial_points=initial_points)
+        fit_params = dict(callback=callback(logger)) if hpo == HPO_BAYES else dict()
+        try:
+            hpo_search.fit(X_train, y_train, **fit_params)
+            params = update_params(hpo_search, i, logger, params)
+            logger.info("Optimizer Iterations done: {}".format(len(hpo_search.cv_results_['params'])))
+        except Exception as err:
+            exception_type = type(err).__name__
+            # Without the best parameters of the search, the fold falls back to the default parameters
+            logger.warning("Hyper-parameter search of fold {} failed with exception {}, error {}".format(
+                i + 1, exception_type, err))
+            if "cv_results_" in vars(hpo_search) and "best_params_" in vars(hpo_search):
+                if hpo_search.best_params_ is not None:
+                    params = update_params(hpo_search, i, logger, params)
+                    if 'n_jobs' in params.keys():
+                        params['n_jobs'] = None
+                    logger.info("Updating best parameters for the classifier")
+                    logger.info("Optimizer Iterations done {}".format(len(hpo_search.cv_results_['params'])))
+        if "best_params_" in vars(hpo_search) and hpo_search.best_params_ is not None:
+            # The scores of successive halving are measured on different budgets and do not seed a Bayesian search
+            if hpo == HPO_BAYES:
+                points = list(zip(hpo_search.cv_results_['params'], hpo_search.cv_results_['mean_test_score']))
+            if any(all(p.get(k) == v for k, v in hpo_search.best_params_.items()) for p in initial_points):
+                origin = ORIGIN_REUSED
+            else:
+                origin = ORIGIN_WARM_SEARCH if warm else ORIGIN_SEARCH
+
+        model = classifier(**params)
+        model.fit(X_train, y_train)
+
+    p_pred, y_pred = get_scores(X_test, model)
+    fold_scores = {}
+    for key, metric, prediction in [(CONFUSION_MATRICES, confusion_matrix, y_pred), (F1SCORE, f1_score, y_pred),
+                                    (ACCURACY, accuracy_score, y_pred), (COHENKAPPA, cohen_kappa_score, y_pred),
+                                    (AUC_SCORE, roc_auc_score, p_pred), (MCC, matthews_corrcoef, y_pred),
+                                    (INFORMEDNESS, instance_informedness, y_pred)]:
+        fold_scores[key] = get_evaluation([], metric, y_test, prediction, logger, i)
+    fold_scores[BEST_PARAMETERS] = copy.deepcopy(params)
+    fold_scores[HPO_ORIGIN] = origin
+    fold_scores[HPO_POINTS] = points
+    return fold_scores
+
+
+def get_best_fold(best_parameters):
+    """
+    Index of the outer Cross-Validation fold with the highest accuracy in the [accuracy, parameters, origin] entries
+    of BEST_PARAMETERS, whose parameters are used for the final model and cached for the warm start.
+    """
+    return int(np.argmax(np.array(best_parameters, dtype=object)[:, 0]))
+
+
+def get_final_estimator(classifier, best_parameters):
+    """
+    The unfitted final model of a classifier, with the parameters of its best outer Cross-Validation fold, which is
+    fitted on the whole dataset.
+    """
+    return classifier(**best_parameters[get_best_fold(best_parameters)][1])
+
+
 def optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterations, x, y, val_metric='accuracy',
-                       n_jobs=6, random_state=42):
+                       n_jobs=6, random_state=42, parallel_outer=False, early_stopping=False, n_hypotheses=1,
+                       warm_start=False, seed_points=None, initial_points=None, hpo=HPO_BAYES, fold_cache=None,
+                       folds=None):
     logger = logging.getLogger('Classifier-Test')
     # clf = classifier(**params)
     # y_pred = None
@@ -87,59 +182,131 @@ def optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterati
     informedness = []
     best_parameters = []
     scores = {}
+    # The shared folds are split and standardized once for all classifiers of the label
+    splits = list(cv_iterator.split(x, y)) if folds is None else folds.splits
+    outer_jobs, estimator_jobs = get_parallel_budget(n_jobs, len(splits), inner_splits=inner_cv_iterator.n_splits)
+    parallel_outer = parallel_outer and outer_jobs > 1
+    # The baselines are cheap and their accuracies are paired with the ones of every other classifier
+    early_stopping = early_stopping and not issubclass(classifier, DummyClassifier)
     logger.info("n_jobs {} class_weight {}".format('n_jobs' in params.keys(), 'class_weight' in params.keys()))
     if 'class_weight' in params.keys():
         w = y.sum() / y.shape[0]
         params['class_weight'] = {0: 1 / (1 - w), 1: 1 / w}
     if 'n_jobs' in params.keys() and classifier.__name__ != LogisticRegression.__name__:
-        if 'PFS_FOLDER' in os.environ:
+        if parallel_outer:
+            params['n_jobs'] = estimator_jobs
+        elif 'PFS_FOLDER' in os.environ:
             params['n_jobs'] = 4
         else:
             params['n_jobs'] = n_jobs
     logger.info("Current default parameters {}".format(print_dictionary(params, sep='\t')))
 
-    d = dict(n_iter=hp_iterations, scoring=val_metric, n_jobs=inner_cv_iterator.n_splits, cv=inner_cv_iterator)
-    logger.info("BayesSearchCV parameters {}".format(print_dictionary(d, sep='\t')))
-    for i, (train_index, test_index) in enumerate(cv_iterator.split(x, y)):
-        X_train, X_test = x[train_index], x[test_index]
-        y_train, y_test = y[train_index], y[test_index]
-        X_train, X_test = standardize_features(X_train, X_test)
-        model = classifier(**params)
-        if issubclass(classifier, DummyClassifier) or hp_iterations == 0:
-            model.fit(X_train, y_train)
+    d = dict(hpo=hpo, n_iter=hp_iterations, scoring=val_metric, n_jobs=inner_cv_iterator.n_splits,
+             cv=inner_cv_iterator)
+    logger.info("Hyper-parameter search parameters {}".format(print_dictionary(d, sep='\t')))
+    if parallel_outer:
+        logger.info("Running {} outer folds in parallel, with {} jobs per estimator".format(outer_jobs,
+                                                                                         estimator_jobs))
+    batch_size = outer_jobs if parallel_outer else 1
+    fold_results = []
+    cached_folds = 0
+    if fold_cache is not None:
+        data_hash = get_data_hash(x, y) if folds is None else folds.data_hash
+        settings = dict(hp_iterations=hp_iterations, val_metric=val_metric, hpo=hpo, warm_start=warm_start,
+                        inner_splits=inner_cv_iterator.n_splits, random_state=random_state)
+        if warm_start:
+            # The HPO cache grows with every run, so reruns keep the warm start points of the first run, which the
+            # keys of its warm-started folds depend on. The key covers the whole task instead of a single fold
+            snapshot_key = fold_cache.get_key(data_hash, [], [], classifier, params,
+                                              dict(settings, warm_start_snapshot=True))
+            snapshot = fold_cache.pin(snapshot_key, dict(seed_points=seed_points, initial_points=initial_points))
+            if snapshot['seed_points'] != seed_points or snapshot['initial_points'] != initial_points:
+                logger.info("Warm starting with the points of the first run, so that its cached folds are reused")
+            seed_points, initial_points = snapshot['seed_points'], snapshot['initial_points']
+
+    def get_cached_fold(fold_params, train_index, test_index, fold_seed_points, fold_initial_points):
+        if fold_cache is None:
+            return None, None
+        fold_settings = settings
+        if fold_seed_points is not None:
+            # A warm-started search depends on the points it was seeded with, which depend on the earlier runs
+            fold_settings = dict(settings, seed_points=fold_seed_points, initial_points=fold_initial_points)
+        key = fold_cache.get_key(data_hash, train_index, test_index, classifier, fold_params, fold_settings)
+        return key, fold_cache.get(key)
+
+    def get_fold_features(i, train_index, test_index):
+        if folds is None:
+            return x[train_index], x[test_index]
+        return folds.get_fold(i)
+
+    hpo_points = []
+    for batch_start in range(0, len(splits), batch_size):
+        batch = list(enumerate(splits))[batch_start:batch_start + batch_size]
+        if warm_start:
+            # Seed with everything evaluated so far and try the latest best parameters first
+            fold_seed_points = list(seed_points or []) + hpo_points
+            fold_initial_points = list(initial_points or [])
+            if len(fold_results) > 0 and fold_results[-1][HPO_ORIGIN] != ORIGIN_DEFAULT:
+                fold_initial_points.insert(0, fold_results[-1][BEST_PARAMETERS])
         else:
-            logger.info("####################### Starting the iteration {} #######################".format(i + 1))
-
-            bayes_search = BayesSearchCV(model, search_space, n_iter=hp_iterations, scoring=val_metric,
-                                         n_jobs=inner_cv_iterator.n_splits, cv=inner_cv_iterator, error_score=0,
-                                         random_state=random_state)
-            try:
-                bayes_search.fit(X_train, y_train, callback=callback(logger))
-                params = update_params(bayes_search, i, logger, params)
-                logger.info("Optimizer Iterations done: {}".format(len(bayes_search.cv_results_['params'])))
-            except Exception as err:
-                exception_type = type(err).__name__
-                logger.info("Exception {}, error {}".format(exception_type, err))
-                if "cv_results_" in vars(bayes_search) and "best_params_" in vars(bayes_search):
-                    if bayes_search.best_params_ is not None:
-                        params = update_params(bayes_search, i, logger, params)
-                        if 'n_jobs' in params.keys():
-                            params['n_jobs'] = None
-                        logger.info("Updating best parameters for the classifier")
-                        logger.info("Optimizer Iterations done {}".format(len(bayes_search.cv_results_['params'])))
-
-            model = classifier(**params)
-            model.fit(X_train, y_train)
-
-        p_pred, y_pred = get_scores(X_test, model)
-        confusion_matrices = get_evaluation(confusion_matrices, confusion_matrix, y_test, y_pred, logger, i)
-        f1_scores = get_evaluation(f1_scores, f1_score, y_test, y_pred, logger, i)
-        accuracies = get_evaluation(accuracies, accuracy_score, y_test, y_pred, logger, i)
-        cohen_kappa = get_evaluation(cohen_kappa, cohen_kappa_score, y_test, y_pred, logger, i)
-        aucs = get_evaluation(aucs, roc_auc_score, y_test, p_pred, logger, i)
-        mccs = get_evaluation(mccs, matthews_corrcoef, y_test, y_pred, logger, i)
-        informedness = get_evaluation(informedness, instance_informedness, y_test, y_pred, logger, i)
-        best_parameters.append([accuracies[i], copy.deepcopy(params)])
+            fold_seed_points, fold_initial_points = None, None
+        if parallel_outer:
+            cached = [get_cached_fold(params, train_index, test_index, fold_seed_points, fold_initial_points)
+                      for i, (train_index, test_index) in batch]
+            # The folds are returned in the order of the splits, so the paired tests see the same arrays as serially
+            computed = iter(Parallel(n_jobs=outer_jobs)(
+                delayed(evaluate_fold)(classifier, copy.deepcopy(params), search_space, inner_cv_iterator,
+                                       hp_iterations, *get_fold_features(i, train_index, test_index),
+                                       y[train_index], y[test_index], i, val_metric=val_metric,
+                                       random_state=random_state, seed_points=fold_seed_points,
+                                       initial_points=fold_initial_points, hpo=hpo, standardize=folds is None)
+                for (i, (train_index, test_index)), (key, fold_scores) in zip(batch, cached) if fold_scores is None))
+            for key, fold_scores in cached:
+                if fold_scores is None:
+                    fold_scores = next(computed)
+                    if key is not None:
+                        fold_cache.put(key, fold_scores)
+                else:
+                    cached_folds += 1
+                fold_results.append(fold_scores)
+        else:
+            for i, (train_index, test_index) in batch:
+                key, fold_scores = get_cached_fold(params, train_index, test_index, fold_seed_points,
+                                                   fold_initial_points)
+                if fold_scores is None:
+                    # The parameters are updated in place, the best parameters of a fold are the starting point of
+                    # the next
+                    fold_scores = evaluate_fold(classifier, params, search_space, inner_cv_iterator, hp_iterations,
+                                                *get_fold_features(i, train_index, test_index), y[train_index],
+                                                y[test_index], i, val_metric=val_metric, random_state=random_state,
+                                                seed_points=fold_seed_points, initial_points=fold_initial_points,
+                                                hpo=hpo, standardize=folds is None)
+                    if key is not None:
+                        fold_cache.put(key, fold_scores)
+                else:
+                    params.update(fold_scores[BEST_PARAMETERS])
+                    cached_folds += 1
+                fold_results.append(fold_scores)
+        hpo_points = [point for fold_scores in fold_results for point in fold_scores[HPO_POINTS]]
+        if early_stopping and len(fold_results) < len(splits):
+            confusion_matrices_done = [cm for fold_scores in fold_results for cm in fold_scores[CONFUSION_MATRICES]]
+            if fisher_verdict_decided(confusion_matrices_done, len(splits), n_hypotheses=n_hypotheses):
+                logger.info("The Fisher exact test verdict is decided after {} of {} folds, stopping".format(
+                    len(fold_results), len(splits)))
+                break
+
+    if cached_folds > 0:
+        logger.info("Reused {} of {} folds from the fold cache".format(cached_folds, len(fold_results)))
+    for i, fold_scores in enumerate(fold_results):
+        confusion_matrices.extend(fold_scores[CONFUSION_MATRICES])
+        f1_scores.extend(fold_scores[F1SCORE])
+        accuracies.extend(fold_scores[ACCURACY])
+        cohen_kappa.extend(fold_scores[COHENKAPPA])
+        aucs.extend(fold_scores[AUC_SCORE])
+        mccs.extend(fold_scores[MCC])
+        informedness.extend(fold_scores[INFORMEDNESS])
+        params = fold_scores[BEST_PARAMETERS]
+        best_parameters.append([accuracies[i], copy.deepcopy(params), fold_scores[HPO_ORIGIN]])
 
     # if x.shape[0] < 100:
     #     iterator = StratifiedShuffleSplit(n_splits=cv_iterator.n_splits, test_size=0.5, random_state=random_state)
@@ -154,12 +321,15 @@ def optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterati
     #         p_pred, y_pred = get_scores(X_test, model)
     #         confusion_matrices = get_evaluation(confusion_matrices, confusion_matrix, y_test, y_pred, logger, i)
 
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=0.5, random_state=random_state)
-    train_index, test_index = list(sss.split(x, y))[0]
-    X_train, X_test = x[train_index], x[test_index]
+    if folds is None:
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=0.5, random_state=random_state)
+        train_index, test_index = list(sss.split(x, y))[0]
+        X_train, X_test = standardize_features(x[train_index], x[test_index])
+    else:
+        train_index, test_index = folds.single_split
+        X_train, X_test = folds.get_single_fold()
     y_train, y_test = y[train_index], y[test_index]
 
-    X_train, X_test = standardize_features(X_train, X_test)
     model = classifier(**params)
     model.fit(X_train, y_train)
     y_pred = model.predict(X_test)
@@ -176,16 +346,18 @@ def optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterati
     scores[MCC] = np.array(mccs)
     scores[INFORMEDNESS] = np.array(informedness)
     scores[TIME_TAKEN] = total
+    scores[CV_FOLDS_USED] = len(fold_results)
     scores[BEST_PARAMETERS] = best_parameters
+    scores[HPO_POINTS] = hpo_points
     logger.info("Total Time taken by the learner {} is {} seconds and {} minutes".format(classifier.__name__, total,
                                                                                          total / 60))
     return scores
 
 
-def update_params(bayes_search, i, logger, params):
-    params.update(bayes_search.best_params_)
-    params_str = print_dictionary(bayes_search.best_params_, sep='\t')
-    best_score = bayes_search.best_score_
+def update_params(hpo_search, i, logger, params):
+    params.update(hpo_search.best_params_)
+    params_str = print_dictionary(hpo_search.best_params_, sep='\t')
+    best_score = hpo_search.best_score_
     logger.info("For the outer split {} Best parameters are: {} with accuracy of: {:.4f}\n".format(i + 1, params_str,
                                                                                                    best_score))
     return params
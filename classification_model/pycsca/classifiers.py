@@ -1,5 +1,12 @@
+import warnings
+
+with warnings.catch_warnings():
+    # The histogram-based boosting is experimental before scikit-learn 1.0, the enabler only warns since
+    warnings.simplefilter('ignore')
+    # noinspection PyUnresolvedReferences
+    from sklearn.experimental import enable_hist_gradient_boosting
 from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, AdaBoostClassifier, \
-    ExtraTreesClassifier
+    ExtraTreesClassifier, HistGradientBoostingClassifier
 from sklearn.linear_model import LogisticRegression, RidgeClassifier, SGDClassifier
 from sklearn.svm import LinearSVC
 from sklearn.tree import DecisionTreeClassifier, ExtraTreeClassifier
@@ -8,6 +15,16 @@ from .baseline import *
 
 from .mlp import MultiLayerPerceptron
 
+# The histogram-based boosting libraries are optional, they are only evaluated if they are installed
+try:
+    from lightgbm import LGBMClassifier
+except ImportError:
+    LGBMClassifier = None
+try:
+    from xgboost import XGBClassifier
+except ImportError:
+    XGBClassifier = None
+
 custom_dict = {RandomClassifier.__name__: 0,
                MajorityVoting.__name__: 1,
                PriorClassifier.__name__: 2,
@@ -26,8 +43,13 @@ custom_dict = {RandomClassifier.__name__: 0,
                ExtraTreesClassifier.__name__: 11,
 
                AdaBoostClassifier.__name__: 12,
-               GradientBoostingClassifier.__name__: 13
+               GradientBoostingClassifier.__name__: 13,
+               HistGradientBoostingClassifier.__name__: 14
                }
+if LGBMClassifier is not None:
+    custom_dict[LGBMClassifier.__name__] = 15
+if XGBClassifier is not None:
+    custom_dict[XGBClassifier.__name__] = 16
 
 classifiers_space = []
 classifiers_space.append((RandomClassifier, {}, {}))
@@ -174,3 +196,46 @@ search_space = {"criterion": Categorical(["friedman_mse", "mse", "mae"]),
                 "n_estimators": Integer(50, 300)
                 }
 classifiers_space.append((clf, params, search_space))
+
+clf = HistGradientBoostingClassifier
+params = dict(learning_rate=0.1, max_iter=100, max_leaf_nodes=31, max_depth=None, min_samples_leaf=20,
+              l2_regularization=0.0, max_bins=255, early_stopping='auto', scoring='loss', validation_fraction=0.1,
+              n_iter_no_change=10, tol=1e-7, verbose=0, random_state=None)
+search_space = {"learning_rate": Real(0.01, 1.0, 'log-uniform'),
+                "max_iter": Integer(50, 300),
+                "max_leaf_nodes": Integer(8, 64),
+                "max_depth": Integer(3, 20),
+                "min_samples_leaf": Integer(2, 20),
+                "l2_regularization": Real(1e-6, 1.0, 'log-uniform'),
+                "max_bins": Integer(32, 255)
+                }
+classifiers_space.append((clf, params, search_space))
+
+if LGBMClassifier is not None:
+    clf = LGBMClassifier
+    params = dict(boosting_type='gbdt', num_leaves=31, max_depth=-1, learning_rate=0.1, n_estimators=100,
+                  min_child_samples=20, subsample=1.0, subsample_freq=0, colsample_bytree=1.0, reg_alpha=0.0,
+                  reg_lambda=0.0, n_jobs=None, random_state=None, verbose=-1)
+    search_space = {"learning_rate": Real(0.01, 1.0, 'log-uniform'),
+                    "n_estimators": Integer(50, 300),
+                    "num_leaves": Integer(8, 64),
+                    "min_child_samples": Integer(2, 20),
+                    "subsample": Real(0.3, 1.0, 'log-uniform'),
+                    "subsample_freq": Integer(0, 5),
+                    "colsample_bytree": Real(0.3, 1.0, 'log-uniform'),
+                    "reg_lambda": Real(1e-6, 1.0, 'log-uniform')
+                    }
+    classifiers_space.append((clf, params, search_space))
+
+if XGBClassifier is not None:
+    clf = XGBClassifier
+    params = dict(n_estimators=100, max_depth=6, learning_rate=0.3, tree_method='hist', subsample=1.0,
+                  colsample_bytree=1.0, reg_lambda=1.0, n_jobs=None, random_state=None, verbosity=0)
+    search_space = {"learning_rate": Real(0.01, 1.0, 'log-uniform'),
+                    "n_estimators": Integer(50, 300),
+                    "max_depth": Integer(3, 20),
+                    "subsample": Real(0.3, 1.0, 'log-uniform'),
+                    "colsample_bytree": Real(0.3, 1.0, 'log-uniform'),
+                    "reg_lambda": Real(1e-6, 1.0, 'log-uniform')
+                    }
+    classifiers_space.append((clf, params, search_space))
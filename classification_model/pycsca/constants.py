@@ -8,7 +8,11 @@ CONFUSION_MATRIX_SINGLE = 'confusion_matrix_single'
 CONFUSION_MATRICES = 'confusion_matrices'
 METRICS = [ACCURACY, F1SCORE, AUC_SCORE, COHENKAPPA, MCC, INFORMEDNESS]
 BEST_PARAMETERS = 'Best-Parameters'
+HPO_POINTS = 'HPO-Points'
+MODEL_ENTRY = 'Model-Entry'
+HPO_ORIGIN = 'HPO-Origin'
 TIME_TAKEN = 'HPO-Time'
+CV_FOLDS_USED = 'CV-Folds-Used'
 MODEL = 'Model'
 FOLD_ID = 'Fold-ID'
 DATASET = 'Dataset'
@@ -22,6 +26,9 @@ SCORE_KEY_FORMAT = '{}-scores-{}'
 
 LABEL_COL = 'label'
 MISSING_CCS_FIN = 'missing_ccs_fin'
+FEATURES_FILE = 'Features.parquet'
+FEATURE_NAMES_METADATA_KEY = 'feature_names'
+FEATURE_PARTS_FOLDER = 'Feature Parts'
 cv_choices = ['kfcv', 'mccv', 'auto']
 debug_levels = {0: "Final", 1: "Intermediate", 2: "Debug"}
 CV_ITERATOR = "CV_ITERATOR"
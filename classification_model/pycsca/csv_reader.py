@@ -1,3 +1,6 @@
+import glob
+import hashlib
+import json
 import logging
 import os
 from abc import ABCMeta
@@ -6,30 +9,91 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 import numpy as np
+import pyarrow.parquet as pq
 from sklearn.preprocessing import LabelEncoder
 
-from .constants import LABEL_COL, MISSING_CCS_FIN
+from .constants import LABEL_COL, MISSING_CCS_FIN, FEATURES_FILE, FEATURE_NAMES_METADATA_KEY, FEATURE_PARTS_FOLDER
 from .utils import str2bool, print_dictionary
 
 sns.set(color_codes=True)
 plt.style.use('default')
 
 
+def read_feature_names(schema):
+    """
+    Returns the [machine, human] feature name pairs stored in the schema metadata by the feature extraction, or None
+    for feature stores written without them.
+    """
+    metadata = schema.metadata or {}
+    if FEATURE_NAMES_METADATA_KEY.encode() not in metadata:
+        return None
+    return json.loads(metadata[FEATURE_NAMES_METADATA_KEY.encode()])
+
+
 class CSVReader(metaclass=ABCMeta):
-    def __init__(self, folder: str, preprocessing='replace', **kwargs):
+    def __init__(self, folder: str, preprocessing='replace', dtype=np.float32, **kwargs):
         self.logger = logging.getLogger(CSVReader.__name__)
         self.dataset_folder = folder
         self.f_file = os.path.join(self.dataset_folder, "Feature Names.csv")
         self.df_file = os.path.join(self.dataset_folder, "Features.csv")
+        self.parquet_file = os.path.join(self.dataset_folder, FEATURES_FILE)
+        self.parts_folder = os.path.join(self.dataset_folder, FEATURE_PARTS_FOLDER)
         self.preprocessing = preprocessing
+        self.dtype = dtype
         self.ccs_fin_array = [False]
         self.correct_class = "Correctly Formatted Pkcs#1 Pms Message"
         self.__load_dataset__()
 
+    def __read_feature_store__(self):
+        schema = pq.read_schema(self.parquet_file, memory_map=True)
+        feature_names = read_feature_names(schema)
+        if feature_names is not None:
+            self.features = pd.DataFrame(feature_names, columns=['machine', 'human'])
+        else:
+            self.features = pd.read_csv(self.f_file, index_col=0)
+        columns = [LABEL_COL, MISSING_CCS_FIN] + list(self.features['machine'].values)
+        columns = [c for c in columns if c in schema.names]
+        table = pq.read_table(self.parquet_file, columns=columns, memory_map=True)
+        # Without the pandas metadata, integer columns with missing values become float instead of nullable integers
+        data_frame = table.to_pandas(ignore_metadata=True)
+        if LABEL_COL in data_frame.columns:
+            data_frame[LABEL_COL] = data_frame[LABEL_COL].astype(str)
+        self.logger.info("Loaded {} columns of {} from {}".format(len(columns), len(schema.names),
+                                                                  self.parquet_file))
+        return data_frame
+
+    def __read_feature_parts__(self):
+        """
+        Reads the parts written by the feature extraction while the capture is still running. Every part has the
+        features of its own sessions, the union of the features is used.
+        """
+        data_frames = []
+        feature_names = dict()
+        part_files = sorted(glob.glob(os.path.join(self.parts_folder, '*.parquet')))
+        for part_file in part_files:
+            table = pq.read_table(part_file, memory_map=True)
+            for machine, human in read_feature_names(table.schema) or []:
+                feature_names[machine] = human
+            data_frames.append(table.to_pandas(ignore_metadata=True))
+        if len(data_frames) == 0:
+            raise ValueError("No parts in {} yet".format(self.parts_folder))
+        self.features = pd.DataFrame(list(feature_names.items()), columns=['machine', 'human'])
+        data_frame = pd.concat(data_frames, ignore_index=True, sort=False)
+        data_frame[LABEL_COL] = data_frame[LABEL_COL].astype(str)
+        self.logger.info("Loaded {} rows from {} parts in {}".format(data_frame.shape[0], len(part_files),
+                                                                    self.parts_folder))
+        return data_frame
+
     def __load_dataset__(self):
-        if not os.path.exists(self.df_file):
-            raise ValueError("No such file or directory: {}".format(self.df_file))
-        self.data_frame = pd.read_csv(self.df_file, index_col=0)
+        if os.path.exists(self.parquet_file):
+            self.data_frame = self.__read_feature_store__()
+        elif os.path.isdir(self.parts_folder):
+            self.data_frame = self.__read_feature_parts__()
+        elif os.path.exists(self.df_file):
+            self.data_frame = pd.read_csv(self.df_file, index_col=0)
+            self.features = pd.read_csv(self.f_file, index_col=0)
+        else:
+            raise ValueError("No such file or directory: {} or {}".format(self.parquet_file, self.df_file))
 
         if LABEL_COL not in self.data_frame.columns:
             error_string = 'Dataframe does not contain label columns'
@@ -53,24 +117,21 @@ class CSVReader(metaclass=ABCMeta):
         self.inverse_label_mapping = dict((v, k) for k, v in self.label_mapping.items())
         self.n_labels = len(self.label_mapping)
 
-        self.data_raw = pd.DataFrame.copy(self.data_frame)
+        self.data_raw = pd.DataFrame.copy(self.data_frame[[c for c in [LABEL_COL, MISSING_CCS_FIN]
+                                                          if c in self.data_frame.columns]])
         self.data_frame[LABEL_COL].replace(self.label_mapping, inplace=True)
         self.logger.info("Label Mapping {}".format(print_dictionary(self.label_mapping)))
         self.logger.info("Inverse Label Mapping {}".format(print_dictionary(self.inverse_label_mapping)))
 
-        if self.preprocessing == 'replace':
-            self.data_frame = self.data_frame.fillna(value=-1)
-        elif self.preprocessing == 'remove':
+        if self.preprocessing == 'remove':
             cols = [c for c in self.data_frame.columns if 'msg1' not in c or 'msg5' not in c]
             self.data_frame = self.data_frame[cols]
-            self.data_frame = self.data_frame.fillna(value=-1)
-        self.features = pd.read_csv(self.f_file, index_col=0)
         self.feature_names = self.features['machine'].values.flatten()
+        self.__build_feature_matrix__()
         if MISSING_CCS_FIN in self.data_frame.columns:
             self.data_frame[MISSING_CCS_FIN] = self.data_frame[MISSING_CCS_FIN].apply(str2bool)
             self.ccs_fin_array = list(self.data_frame[MISSING_CCS_FIN].unique())
-        df = pd.DataFrame.copy(self.data_frame)
-        df[LABEL_COL].replace(self.inverse_label_mapping, inplace=True)
+        self.__build_row_indices__()
         df = pd.DataFrame.copy(self.data_frame)
         df[LABEL_COL].replace(self.inverse_label_mapping, inplace=True)
         df = pd.DataFrame(df[[LABEL_COL, MISSING_CCS_FIN]].value_counts().sort_index())
@@ -90,6 +151,47 @@ class CSVReader(metaclass=ABCMeta):
         self.logger.info('\t\n' + df.to_string().replace('\n', '\n\t'))
         df.to_csv(fname)
 
+    def __build_feature_matrix__(self):
+        """
+        Builds the feature matrix once, the subsets for every label and CCS/FIN value are selected from it by row
+        indices. Missing features are filled while copying column by column, so no filled copy of the whole data frame
+        is created, afterwards the data frame only keeps the label and CCS/FIN columns.
+        """
+        fill_value = -1 if self.preprocessing in ['replace', 'remove'] else np.nan
+        self.x = np.empty((self.data_frame.shape[0], len(self.feature_names)), dtype=self.dtype)
+        for i, feature in enumerate(self.feature_names):
+            self.x[:, i] = self.data_frame[feature].to_numpy(dtype=self.dtype, na_value=fill_value)
+        self.y = self.data_frame[LABEL_COL].values.astype(int)
+        self.data_frame = pd.DataFrame.copy(self.data_frame[[c for c in [LABEL_COL, MISSING_CCS_FIN]
+                                                             if c in self.data_frame.columns]])
+        fingerprint = hashlib.sha1(self.x.tobytes())
+        fingerprint.update(self.y.tobytes())
+        self.fingerprint = fingerprint.hexdigest()
+        self.logger.info("Feature matrix of shape {} uses {:.1f} MB".format(self.x.shape, self.x.nbytes / 2 ** 20))
+
+    def __build_row_indices__(self):
+        if MISSING_CCS_FIN in self.data_frame.columns:
+            missing_ccs_fin = self.data_frame[MISSING_CCS_FIN].values.astype(bool)
+            self.ccs_fin_rows = {val: np.flatnonzero(missing_ccs_fin == val) for val in self.ccs_fin_array}
+        else:
+            self.ccs_fin_rows = {val: np.arange(self.y.shape[0]) for val in self.ccs_fin_array}
+        self.label_rows = {}
+        for val, rows in self.ccs_fin_rows.items():
+            for class_label in self.inverse_label_mapping.keys():
+                self.label_rows[(val, class_label)] = rows[self.y[rows] == class_label]
+
+    def get_rows(self, class_label=0, missing_ccs_fin=False):
+        if MISSING_CCS_FIN in self.data_frame.columns:
+            rows = self.ccs_fin_rows.get(missing_ccs_fin, np.array([], dtype=int))
+        else:
+            rows = np.arange(self.y.shape[0])
+        if class_label != 0:
+            if MISSING_CCS_FIN not in self.data_frame.columns:
+                missing_ccs_fin = self.ccs_fin_array[0]
+            rows = np.union1d(self.label_rows.get((missing_ccs_fin, 0), rows[:0]),
+                              self.label_rows.get((missing_ccs_fin, class_label), rows[:0]))
+        return rows
+
     def plot_class_distribution(self):
         fig_param = {'facecolor': 'w', 'edgecolor': 'w', 'transparent': False, 'dpi': 800, 'bbox_inches': 'tight',
                      'pad_inches': 0.05}
@@ -139,19 +241,12 @@ class CSVReader(metaclass=ABCMeta):
         fig.savefig(**fig_param)
 
     def get_data_class_label(self, class_label=1, missing_ccs_fin=False):
-        if MISSING_CCS_FIN in self.data_frame.columns:
-            df = self.data_frame[self.data_frame[MISSING_CCS_FIN] == missing_ccs_fin]
-        else:
-            df = self.data_frame
-        if class_label == 0:
-            x, y = self.get_data(df)
-        else:
-            p = [0, class_label]
-            df = df[df.label.isin(p)]
-            df[LABEL_COL].replace([class_label], 1, inplace=True)
-            x, y = df[self.feature_names].values, df[LABEL_COL].values.flatten()
+        rows = self.get_rows(class_label=class_label, missing_ccs_fin=missing_ccs_fin)
+        x, y = self.get_data(rows)
+        if class_label != 0:
+            y = (y == class_label).astype(y.dtype)
         return x, y
 
-    def get_data(self, df):
-        x, y = df[self.feature_names].values, df[LABEL_COL].values.flatten()
+    def get_data(self, rows):
+        x, y = self.x[rows], self.y[rows]
         return x, y
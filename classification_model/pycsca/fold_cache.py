@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+
+import numpy as np
+import scipy
+import sklearn
+import skopt
+
+from .utils import create_dir_recursively, dump_pickle_atomically
+
+__all__ = ['FoldCache', 'get_data_hash']
+
+# The results of a fold are only reused with the libraries they were computed with
+LIBRARY_VERSIONS = (sys.version.split(' ')[0], np.__version__, scipy.__version__, sklearn.__version__,
+                    skopt.__version__)
+# Estimator parameters which do not change the fitted model
+IGNORED_PARAMETERS = ['n_jobs', 'verbose']
+
+
+def get_data_hash(x, y):
+    sha = hashlib.sha1()
+    for array in (x, y):
+        array = np.ascontiguousarray(array)
+        sha.update(str((array.dtype, array.shape)).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+def describe(value):
+    # Random states are consumed while running, their representation is neither stable nor meaningful
+    if isinstance(value, np.random.RandomState):
+        return type(value).__name__
+    if isinstance(value, dict):
+        return '{' + ', '.join('{}: {}'.format(k, describe(value[k])) for k in sorted(value.keys())) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(describe(v) for v in value) + ']'
+    return repr(value)
+
+
+class FoldCache(object):
+    """
+    Content-addressed cache of the scores of single outer Cross-Validation folds. The key is the hash of the feature
+    matrix and labels, the split indices, the classifier, its parameters, the search settings and the library
+    versions, so a rerun after a crash or with additional classifiers only computes the folds that changed.
+    """
+
+    def __init__(self, folder):
+        self.logger = logging.getLogger(FoldCache.__name__)
+        self.folder = folder
+        create_dir_recursively(self.folder, False)
+
+    def get_key(self, data_hash, train_index, test_index, classifier, params, settings):
+        sha = hashlib.sha1()
+        sha.update(data_hash.encode())
+        sha.update(np.asarray(train_index, dtype=np.int64).tobytes())
+        sha.update(b'|')
+        sha.update(np.asarray(test_index, dtype=np.int64).tobytes())
+        sha.update('{}.{}'.format(classifier.__module__, classifier.__name__).encode())
+        sha.update(describe({k: v for k, v in params.items() if k not in IGNORED_PARAMETERS}).encode())
+        sha.update(describe(settings).encode())
+        sha.update(str(LIBRARY_VERSIONS).encode())
+        return sha.hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.folder, key + '.pickle')
+
+    def get(self, key):
+        file_path = self.get_file_path(key)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError) as err:
+            self.logger.error("Ignoring the corrupt cached fold {}: {}".format(file_path, err))
+            return None
+
+    def put(self, key, fold_scores):
+        dump_pickle_atomically(fold_scores, self.get_file_path(key))
+
+    def pin(self, key, value):
+        """
+        Returns the value stored under the key by the first run, storing the given value if there is none yet.
+        """
+        pinned = self.get(key)
+        if pinned is None:
+            self.put(key, value)
+            return value
+        return pinned
@@ -0,0 +1,115 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+from skopt import BayesSearchCV
+from skopt.utils import point_asdict
+
+from .utils import dump_pickle_atomically
+
+__all__ = ['WarmStartBayesSearchCV', 'HPOCache', 'ORIGIN_DEFAULT', 'ORIGIN_SEARCH', 'ORIGIN_WARM_SEARCH',
+           'ORIGIN_REUSED']
+
+ORIGIN_DEFAULT = 'default'
+ORIGIN_SEARCH = 'search'
+ORIGIN_WARM_SEARCH = 'warm-search'
+ORIGIN_REUSED = 'reused'
+
+
+def point_aslist(search_space, params):
+    # skopt orders the dimensions by the sorted parameter names, see skopt.utils.dimensions_aslist
+    return [params[k] for k in sorted(search_space.keys())]
+
+
+class WarmStartBayesSearchCV(BayesSearchCV):
+    """
+    BayesSearchCV that starts from earlier results instead of from scratch. The seed points, pairs of parameters and
+    their cross-validation score from earlier folds or runs, are told to the optimizer without being evaluated again.
+    The initial points, e.g. the best parameters of the previous fold or of other labels, are evaluated first and
+    count towards n_iter. Overrides private methods of scikit-optimize 0.9, which is pinned for that reason.
+    """
+
+    def __init__(self, estimator, search_spaces, optimizer_kwargs=None, n_iter=50, scoring=None, fit_params=None,
+                 n_jobs=1, n_points=1, iid='deprecated', refit=True, cv=None, verbose=0, pre_dispatch='2*n_jobs',
+                 random_state=None, error_score='raise', return_train_score=False, seed_points=None,
+                 initial_points=None):
+        self.seed_points = seed_points
+        self.initial_points = initial_points
+        super(WarmStartBayesSearchCV, self).__init__(
+            estimator=estimator, search_spaces=search_spaces, optimizer_kwargs=optimizer_kwargs, n_iter=n_iter,
+            scoring=scoring, fit_params=fit_params, n_jobs=n_jobs, n_points=n_points, iid=iid, refit=refit, cv=cv,
+            verbose=verbose, pre_dispatch=pre_dispatch, random_state=random_state, error_score=error_score,
+            return_train_score=return_train_score)
+
+    def _make_optimizer(self, params_space):
+        optimizer = super(WarmStartBayesSearchCV, self)._make_optimizer(params_space)
+        points, scores = [], []
+        for params, score in self.seed_points or []:
+            point = point_aslist(params_space, params) if set(params_space.keys()) <= set(params.keys()) else None
+            if point is not None and point in optimizer.space and np.isfinite(score):
+                points.append(point)
+                scores.append(-score)
+        if len(points) > 0:
+            # The optimizer minimizes, hence the negative scores
+            optimizer.tell(points, scores)
+        self.pending_points_ = [point_aslist(params_space, params) for params in self.initial_points or []
+                                if set(params_space.keys()) <= set(params.keys()) and
+                                point_aslist(params_space, params) in optimizer.space]
+        return optimizer
+
+    def _step(self, search_space, optimizer, evaluate_candidates, n_points=1):
+        if len(self.pending_points_) == 0:
+            return super(WarmStartBayesSearchCV, self)._step(search_space, optimizer, evaluate_candidates,
+                                                             n_points=n_points)
+        params = self.pending_points_[:n_points]
+        self.pending_points_ = self.pending_points_[n_points:]
+        all_results = evaluate_candidates([point_asdict(search_space, p) for p in params])
+        local_results = all_results["mean_test_score"][-len(params):]
+        return optimizer.tell(params, [-score for score in local_results])
+
+
+class HPOCache(object):
+    """
+    Hyper-parameter optimization results of earlier runs, keyed by the dataset fingerprint, the classifier and the
+    label. The evaluated points seed the searches of the same classifier and label, the best parameters of the
+    other labels of the same dataset are evaluated first.
+    """
+
+    def __init__(self, file_path, fingerprint, max_seed_points=50):
+        self.logger = logging.getLogger(HPOCache.__name__)
+        self.file_path = file_path
+        self.fingerprint = fingerprint
+        self.max_seed_points = max_seed_points
+        self.entries = dict()
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'rb') as f:
+                self.entries = pickle.load(f)
+        self.logger.info("Loaded {} cached searches from {}".format(len(self.entries), self.file_path))
+
+    def get_seed_points(self, cls_name, label):
+        entry = self.entries.get((self.fingerprint, cls_name, label), None)
+        if entry is None:
+            return []
+        # The best points are kept, so the surrogate model stays cheap to fit
+        return sorted(entry['points'], key=lambda point: -point[1])[:self.max_seed_points]
+
+    def get_initial_points(self, cls_name, label):
+        initial_points = []
+        for (fingerprint, name, other_label), entry in self.entries.items():
+            if fingerprint == self.fingerprint and name == cls_name and entry['best_params'] is not None:
+                if other_label == label:
+                    initial_points.insert(0, entry['best_params'])
+                elif entry['best_params'] not in initial_points:
+                    initial_points.append(entry['best_params'])
+        return initial_points
+
+    def update(self, cls_name, label, points, best_params):
+        key = (self.fingerprint, cls_name, label)
+        entry = self.entries.get(key, {'points': [], 'best_params': None})
+        entry['points'] = sorted(entry['points'] + list(points), key=lambda point: -point[1])[:self.max_seed_points]
+        entry['best_params'] = best_params
+        self.entries[key] = entry
+
+    def save(self):
+        dump_pickle_atomically(self.entries, self.file_path)
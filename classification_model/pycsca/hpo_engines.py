@@ -0,0 +1,84 @@
+import logging
+
+from scipy.stats import loguniform, randint, uniform
+# noinspection PyUnresolvedReferences
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingRandomSearchCV, RandomizedSearchCV
+from skopt.space import Categorical, Integer, Real
+
+from .classifiers import HistGradientBoostingClassifier
+from .hpo_cache import WarmStartBayesSearchCV
+from .mlp import MultiLayerPerceptron
+
+__all__ = ['HPO_BAYES', 'HPO_HALVING', 'HPO_RANDOM', 'HPO_ENGINES', 'get_distributions', 'get_resource',
+           'get_hpo_search']
+
+HPO_BAYES = 'bayes'
+HPO_HALVING = 'halving'
+HPO_RANDOM = 'random'
+HPO_ENGINES = [HPO_BAYES, HPO_HALVING, HPO_RANDOM]
+N_SAMPLES = 'n_samples'
+
+
+def get_distributions(search_space):
+    """
+    Converts the skopt search space of a classifier into the scipy distributions and lists accepted by the sklearn
+    randomized searches.
+    """
+    distributions = dict()
+    for name, dimension in search_space.items():
+        if isinstance(dimension, Categorical):
+            distributions[name] = list(dimension.categories)
+        elif isinstance(dimension, Integer):
+            distributions[name] = randint(dimension.low, dimension.high + 1)
+        elif isinstance(dimension, Real) and dimension.prior == 'log-uniform':
+            distributions[name] = loguniform(dimension.low, dimension.high)
+        elif isinstance(dimension, Real):
+            distributions[name] = uniform(dimension.low, dimension.high - dimension.low)
+        else:
+            raise ValueError("Search space dimension {} of type {} is not supported".format(name, type(dimension)))
+    return distributions
+
+
+def get_resource(model, search_space):
+    """
+    Returns the budget resource of successive halving and its maximum. Ensembles are grown with n_estimators, the
+    MultiLayerPerceptron and the HistGradientBoostingClassifier are trained for max_iter epochs and boosting
+    iterations, all other classifiers use the number of training samples.
+    """
+    params = model.get_params()
+    if 'n_estimators' in params:
+        resource = 'n_estimators'
+    elif isinstance(model, (MultiLayerPerceptron, HistGradientBoostingClassifier)):
+        resource = 'max_iter'
+    else:
+        return N_SAMPLES, 'auto'
+    if resource in search_space:
+        return resource, search_space[resource].high
+    return resource, params[resource]
+
+
+def get_hpo_search(hpo, model, search_space, n_iter, scoring, n_jobs, cv, random_state, seed_points=None,
+                   initial_points=None):
+    """
+    Creates the hyper-parameter search of the given engine. The Bayesian search evaluates n_iter configurations on the
+    whole training fold, the random search the same number of random configurations. Successive halving starts the
+    same number of random configurations with a small budget and only trains the best third on the next budget.
+    """
+    logger = logging.getLogger('HPO-Engines')
+    if hpo == HPO_BAYES:
+        return WarmStartBayesSearchCV(model, search_space, n_iter=n_iter, scoring=scoring, n_jobs=n_jobs, cv=cv,
+                                      error_score=0, random_state=random_state, refit=False, seed_points=seed_points,
+                                      initial_points=initial_points)
+    if hpo == HPO_RANDOM:
+        return RandomizedSearchCV(model, get_distributions(search_space), n_iter=n_iter, scoring=scoring,
+                                  n_jobs=n_jobs, cv=cv, error_score=0, random_state=random_state, refit=False)
+    if hpo == HPO_HALVING:
+        resource, max_resources = get_resource(model, search_space)
+        distributions = get_distributions({k: v for k, v in search_space.items() if k != resource})
+        logger.info("Successive halving of {} candidates over the resource {} up to {}".format(n_iter, resource,
+                                                                                               max_resources))
+        return HalvingRandomSearchCV(model, distributions, n_candidates=n_iter, factor=3, resource=resource,
+                                     max_resources=max_resources, min_resources='exhaust', scoring=scoring,
+                                     n_jobs=n_jobs, cv=cv, error_score=0, random_state=random_state, refit=False)
+    raise ValueError("Unknown hyper-parameter optimization engine {}, choose from {}".format(hpo, HPO_ENGINES))
@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import os
+import pickle
+
+import joblib
+import pandas as pd
+
+from .fold_cache import describe
+from .utils import create_dir_recursively
+
+__all__ = ['ModelStore', 'MODEL_INDEX_FILE', 'get_model_name', 'load_model_file']
+
+MODEL_INDEX_FILE = 'Model Index.csv'
+MODEL_EXTENSION = '.joblib'
+LEGACY_EXTENSION = '.pickle'
+INDEX_COLUMNS = ['classifier', 'label', 'missing_ccs_fin', 'params_hash', 'size', 'file']
+
+
+def get_model_name(cls_name, label):
+    return cls_name.lower() + '-' + '_'.join(label.lower().split(' '))
+
+
+def get_params_hash(params):
+    # The number of jobs does not change the fitted model
+    return hashlib.sha1(describe({k: v for k, v in params.items() if k != 'n_jobs'}).encode()).hexdigest()
+
+
+class ModelStore(object):
+    """
+    Store of the fitted models of every classifier and label. The models are written with joblib, whose numpy arrays,
+    e.g. the nodes of the trees of the ensembles, are memory-mapped on loading instead of being deserialized, and an
+    index of classifier, label, missing CCS FIN, parameter hash and size lets the consumers load only the models they
+    need. Models pickled by earlier versions, <classifier>-<label>.pickle, are still found and loaded.
+    The artifacts can be saved by parallel workers, the index is only written by the process that owns the store.
+    """
+
+    def __init__(self, folder, compress=0):
+        self.logger = logging.getLogger(ModelStore.__name__)
+        self.folder = folder
+        # Compressed artifacts are smaller but can not be memory-mapped
+        self.compress = compress
+        self.index_file = os.path.join(self.folder, MODEL_INDEX_FILE)
+        create_dir_recursively(self.folder, False)
+        if os.path.exists(self.index_file):
+            index = pd.read_csv(self.index_file)
+            self.entries = {(e['classifier'], e['label']): e for e in index.to_dict(orient='records')}
+        else:
+            self.entries = dict()
+
+    def save(self, model, cls_name, label, missing_ccs_fin, params):
+        """
+        Writes the model and returns its index entry, which is added to the index with add_entry.
+        """
+        file_name = get_model_name(cls_name, label) + MODEL_EXTENSION
+        file_path = os.path.join(self.folder, file_name)
+        joblib.dump(model, file_path + '.tmp', compress=self.compress)
+        os.replace(file_path + '.tmp', file_path)
+        legacy_path = os.path.join(self.folder, get_model_name(cls_name, label) + LEGACY_EXTENSION)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+        return dict(zip(INDEX_COLUMNS, [cls_name, label, bool(missing_ccs_fin), get_params_hash(params),
+                                        os.path.getsize(file_path), file_name]))
+
+    def contains(self, cls_name, label, params):
+        entry = self.entries.get((cls_name, label), None)
+        return entry is not None and entry['params_hash'] == get_params_hash(params) and \
+               os.path.exists(os.path.join(self.folder, entry['file']))
+
+    def add_entry(self, entry):
+        self.entries[(entry['classifier'], entry['label'])] = entry
+        index = pd.DataFrame(list(self.entries.values()), columns=INDEX_COLUMNS)
+        index.sort_values(by=['label', 'classifier'], inplace=True)
+        index.to_csv(self.index_file + '.tmp', index=False)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def get_model_files(self):
+        """
+        Paths of the stored models by label and classifier, both in the file name format of get_model_name, from the
+        index and the legacy pickles, without loading any of them.
+        """
+        model_files = dict()
+        for file_name in sorted(os.listdir(self.folder)):
+            name, extension = os.path.splitext(file_name)
+            if extension == LEGACY_EXTENSION:
+                cls_name, label = name.split('-', 1)
+                model_files.setdefault(label, dict())[cls_name] = os.path.join(self.folder, file_name)
+        for entry in self.entries.values():
+            cls_name, label = get_model_name(entry['classifier'], entry['label']).split('-', 1)
+            model_files.setdefault(label, dict())[cls_name] = os.path.join(self.folder, entry['file'])
+        return model_files
+
+    def load(self, cls_name, label, mmap_mode='r'):
+        entry = self.entries.get((cls_name, label), None)
+        if entry is not None:
+            return load_model_file(os.path.join(self.folder, entry['file']), mmap_mode=mmap_mode)
+        for extension in (MODEL_EXTENSION, LEGACY_EXTENSION):
+            file_path = os.path.join(self.folder, get_model_name(cls_name, label) + extension)
+            if os.path.exists(file_path):
+                return load_model_file(file_path, mmap_mode=mmap_mode)
+        raise ValueError("There is no model of classifier {} for label {} in {}".format(cls_name, label, self.folder))
+
+
+def load_model_file(file_path, mmap_mode='r'):
+    if file_path.endswith(LEGACY_EXTENSION):
+        with open(file_path, 'rb') as f:
+            return pickle.load(f)
+    return joblib.load(file_path, mmap_mode=mmap_mode)
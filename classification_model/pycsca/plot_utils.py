@@ -1,30 +1,40 @@
-import glob
 import logging
 import math
 import os
-import pickle
 import re
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from itertools import product
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import seaborn as sns
 from sklearn.model_selection import ShuffleSplit, learning_curve
 
 from .classifiers import custom_dict
+from .model_store import ModelStore, load_model_file
 from .utils import progress_bar
 
 RANDOM_FOREST_CLASSIFIER = 'RandomForestClassifier'
+# The first rank in custom_dict of every group of bars
+MODEL_GROUP_RANKS = [0, 3, 6, 7, 8, 10, 12]
+MODEL_NAMES = {'SGD': "PerceptronLearningAlgorithm", 'LinearSVC': "SupportVectorMachine",
+               'Ridge': "RidgeClassificationModel", 'HistGradientBoosting': "HistogramGradientBoosting",
+               'LGBM': "LightGradientBoostingMachine", 'XGB': "ExtremeGradientBoosting"}
 
 sns.set(color_codes=True)
 plt.style.use('default')
 
 __all__ = ['fig_param', 'colors', 'bar_grid_for_dataset', 'classwise_barplot_for_dataset',
-           'bar_plot_for_problem', 'plot_learning_curves_importances', 'pgf_with_latex']
+           'bar_plot_for_problem', 'plot_learning_curves_importances', 'pgf_with_latex', 'get_barplot_tasks',
+           'get_learning_curve_importance_tasks', 'run_render_tasks', 'share_loaded_importances', 'has_learning_curve',
+           'RANDOM_FOREST_CLASSIFIER']
 
 colors = ['black', 'black', 'black', 'indigo', 'blueviolet', 'mediumorchid', 'plum', 'mediumblue', 'firebrick',
-          'darkorange', 'sandybrown', 'darkgoldenrod', 'gold', 'khaki']
+          'darkorange', 'sandybrown', 'darkgoldenrod', 'gold', 'khaki', 'darkkhaki', 'palegoldenrod', 'lemonchiffon']
 logger = logging.getLogger("Plotting")
 
 pgf_with_latex = {  # setup matplotlib to use latex for output
@@ -63,21 +73,26 @@ def init_plots(df, extension, metric, figsize):
     opacity = 0.7
     offset = 0.1
     df = df[~df['Dataset'].str.contains('Multi-Class')]
+    # A model that is missing for some of the datasets is plotted as an empty bar
+    models = pd.MultiIndex.from_product([df['Dataset'].unique(), df['Model'].unique()], names=['Dataset', 'Model'])
+    df = df.set_index(['Dataset', 'Model']).reindex(models).reset_index()
     df['rank'] = df['Model'].map(custom_dict)
     df.sort_values(by='rank', inplace=True)
     del df['rank']
     u_models = list(df.Model.unique())
+    # Baselines, linear models, support vector machine, perceptron, trees, forests and all boosting models, counted
+    # from the models present, as failed or optional classifiers have no results
+    groups = Counter(bisect_right(MODEL_GROUP_RANKS, custom_dict[model]) for model in u_models)
+    groups = [groups[group] for group in sorted(groups.keys())]
     u_models = [model.split('Classifier')[0] for model in u_models]
-    u_models[u_models.index('SGD')] = "PerceptronLearningAlgorithm"
-    u_models[u_models.index('LinearSVC')] = "SupportVectorMachine"
-    u_models[u_models.index('Ridge')] = "RidgeClassificationModel"
+    u_models = [MODEL_NAMES.get(model, model) for model in u_models]
     u_models = [' '.join(re.findall('[A-Z][^A-Z]*', model)) for model in u_models]
     u_models[0] = u_models[0] + ' Guesser (Baseline)'
     u_datasets = list(df.Dataset.unique())
     bar_width_offset = bar_width + offset
     space = 0.3
     index = []
-    for i in [3, 3, 1, 1, 2, 2, 2]:
+    for i in groups:
         if len(index) == 0:
             index.extend(list(np.arange(1, i + 1) * bar_width_offset))
         else:
@@ -158,10 +173,12 @@ def bar_grid_for_dataset(df, metric, std, folder, figsize=(4, 4), extension='png
     plt.show()
 
 
-def classwise_barplot_for_dataset(df, metric, std, folder, figsize=(3, 4), extension='png'):
+def classwise_barplot_for_dataset(df, metric, std, folder, figsize=(3, 4), extension='png', datasets=None):
     bar_width, df, fig_param, index, opacity, u_datasets, u_models, end = init_plots(df, extension, figsize, metric)
     ini = index[0]
     for dataset in u_datasets:
+        if datasets is not None and dataset not in datasets:
+            continue
         logger.info("Plotting single plot for dataset {}".format(dataset))
         fig, ax = plt.subplots(figsize=figsize, frameon=True, edgecolor='k', facecolor='white')
         accs = list(df[df['Dataset'] == dataset][metric].values)
@@ -215,9 +232,29 @@ def bar_plot_for_problem(df, metric, params, std, folder, figsize=(14, 6), exten
     plt.savefig(**fig_param)
 
 
-def plot_importance(models, feature_names, fname, extension, number=15):
+def normalize(x):
+    return (x - x.min()) / (x.max() - x.min())
+
+
+def get_importances(model):
+    """
+    The normalized feature importances of a random forest and their deviation over its trees, which is all the
+    importance plots need of the model.
+    """
+    trees = np.array(model.estimators_)
+    trees = trees.flatten()
+    deviation = []
+    for tree in trees:
+        imp = tree.feature_importances_
+        imp = normalize(imp)
+        deviation.append(imp)
+    std = np.std(deviation, axis=0) / len(trees)
+    return normalize(model.feature_importances_), std
+
+
+def plot_importance(model_importances, feature_names, fname, extension, number=15):
     fig_param['format'] = extension
-    n_models = len(models)
+    n_models = len(model_importances)
     if n_models <= 12:
         c = 3
         r = 4
@@ -236,30 +273,14 @@ def plot_importance(models, feature_names, fname, extension, number=15):
                             facecolor='white')
     axs = np.array(axs).flatten()
 
-    def norm(x):
-        return (x - x.min()) / (x.max() - x.min())
-
-    def get_importances(model):
-        feature_importances = model.feature_importances_
-        trees = np.array(model.estimators_)
-        trees = trees.flatten()
-        deviation = []
-        for tree in trees:
-            imp = tree.feature_importances_
-            imp = norm(imp)
-            deviation.append(imp)
-        std = np.std(deviation, axis=0) / len(trees)
-        indices = np.argsort(feature_importances)[::-1]
-
-        importances = norm(feature_importances)[indices][0:number]
-        names = feature_names[indices[0:number]]
-        std = std[indices][0:number]
-        return importances, std, names
+    def get_top_importances(importances, std):
+        indices = np.argsort(importances)[::-1]
+        return importances[indices][0:number], std[indices][0:number], feature_names[indices[0:number]]
 
     add_title = False
-    for ax, (label, model) in zip(axs, models.items()):
+    for ax, (label, (importances, std)) in zip(axs, model_importances.items()):
         logger.debug("Plotting grid plot importances for dataset {}".format(label))
-        importances, std, names = get_importances(model)
+        importances, std, names = get_top_importances(importances, std)
 
         ax.set_title(label)
         if "Missing" in label:
@@ -282,9 +303,18 @@ def plot_importance(models, feature_names, fname, extension, number=15):
     plt.savefig(**fig_param)
 
 
-def learning_curve_for_label(estimators, X, y, vulnerable, fname, extension):
+def has_learning_curve(cls_name):
+    """
+    Whether the learning curve of a classifier is plotted, the random guesser and the perceptron are left out. The
+    name is matched case-insensitively, so it can be the class or the file name of the model.
+    """
+    cls_name = cls_name.lower()
+    return not ('randomclassifier' in cls_name or 'perceptron' in cls_name)
+
+
+def learning_curve_for_label(estimators, X, y, vulnerable, fname, extension, n_jobs=os.cpu_count() - 2):
     ncols = 2
-    nrows = int(len(estimators) / ncols)
+    nrows = int(math.ceil(len(estimators) / ncols))
     figsize = (7, nrows * 4)
     fig_param['format'] = extension
     fig, axs = plt.subplots(nrows=nrows, ncols=ncols, sharex=True, sharey=True, figsize=figsize,
@@ -305,7 +335,7 @@ def learning_curve_for_label(estimators, X, y, vulnerable, fname, extension):
         else:
             train_sizes = np.arange(10, 300, 10) / X.shape[0]
         train_sizes, train_scores, test_scores, fit_times, _ = learning_curve(estimator, X, y, cv=cv,
-                                                                              n_jobs=os.cpu_count() - 2,
+                                                                              n_jobs=n_jobs,
                                                                               train_sizes=train_sizes,
                                                                               return_times=True)
 
@@ -327,6 +357,10 @@ def learning_curve_for_label(estimators, X, y, vulnerable, fname, extension):
             label = "RidgeClassification\nModel"
         if 'Hist' in label:
             label = "HistogramGradient\nBoosting"
+        if 'LGBM' in label:
+            label = "LightGradient\nBoosting"
+        if 'XGB' in label:
+            label = "ExtremeGradient\nBoosting"
         label = ' '.join(re.findall('[A-Z][^A-Z]*', label))
         ax.set_title(label, y=0.90, fontsize=13)
         ax.fill_between(train_sizes, train_scores_mean - train_scores_std,
@@ -354,60 +388,142 @@ def learning_curve_for_label(estimators, X, y, vulnerable, fname, extension):
         ax.set_xticks(train_sizes[::2])
         ax.set_xticklabels(train_sizes[::2], rotation=90, ha='right', fontsize=11)
 
-    axs[9].set_xlabel('# Training Examples', x=-0.2, fontsize=14)
-    axs[4].set_ylabel('Accuracy', fontsize=14)
+    for ax in axs[len(estimators):]:
+        ax.set_axis_off()
+    # The x label is centered below the second to last row and the y label on the middle of the left column, of the
+    # used axes only, as the final models of some classifiers can be missing
+    axs[min(ncols * max(nrows - 1, 1) - 1, len(estimators) - 1)].set_xlabel('# Training Examples', x=-0.2,
+                                                                         fontsize=14)
+    axs[ncols * ((nrows - 1) // 2)].set_ylabel('Accuracy', fontsize=14)
 
     params = dict(loc='lower right', bbox_to_anchor=(1.0, -0.45), ncol=2, fancybox=False, shadow=True,
                   facecolor='white', edgecolor='k', fontsize=13)
     if not vulnerable:
         params['bbox_to_anchor'] = (1.00, -0.45)
-    plt.legend(**params)
+    axs[len(estimators) - 1].legend(**params)
 
     fig_param['fname'] = fname
     plt.savefig(**fig_param)
 
 
-def plot_learning_curves_importances(result_dirs, csv_reader, vulnerable_classes, extension='png', plotlr=False,
-                                     logger=logging.getLogger('None')):
-    def get_estimators_data(models_folder, csv_reader, label_number, missing_ccs_fin):
-        X, y = csv_reader.get_data_class_label(class_label=label_number, missing_ccs_fin=missing_ccs_fin)
+def importance_task(model_files, feature_names, fname, extension, number, loaded_importances=None):
+    """
+    Plots the importances of the random forests, only loading the ones whose importances were not already computed by
+    the learning curve tasks, see share_loaded_importances.
+    """
+    loaded_importances = loaded_importances or dict()
+    model_importances = {label: loaded_importances[path] if path in loaded_importances else
+                         get_importances(load_model_file(path)) for label, path in model_files.items()}
+    plot_importance(model_importances, feature_names, fname, extension=extension, number=number)
+
+
+def learning_curve_task(model_files, X, y, vulnerable, fname, extension, importance_files=()):
+    """
+    Plots the learning curves of a label and returns the importances of the models in importance_files by their path,
+    so that the importance plots need not load those models again.
+    """
+    estimators = [load_model_file(path) for path in model_files]
+    # The render tasks already run in parallel, so the learning curves of one label are computed serially
+    learning_curve_for_label(estimators, X, y, vulnerable, fname, extension, n_jobs=1)
+    return {path: get_importances(estimator) for path, estimator in zip(model_files, estimators)
+            if path in importance_files}
+
+
+def init_render_worker(rc_params):
+    mpl.use('Agg')
+    mpl.rcParams.update(rc_params)
+
+
+def render(task, args):
+    try:
+        return task(*args)
+    finally:
+        plt.close('all')
+
+
+def run_render_tasks(tasks, n_jobs=1, logger=logging.getLogger('None')):
+    """
+    Renders the figures of the independent tasks, triples of a name, a plotting function and its arguments, on a
+    pool of processes with the non-interactive Agg backend. Every task loads the models it needs itself, so the
+    models are not sent between the processes.
+
+    :return: The results of the tasks by their name
+    """
+    results = dict()
+    if n_jobs == 1 or len(tasks) <= 1:
+        for name, task, args in tasks:
+            results[name] = render(task, args)
+            logger.info("Rendered {}".format(name))
+        return results
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks)), initializer=init_render_worker,
+                             initargs=(dict(mpl.rcParams),)) as executor:
+        futures = [(name, executor.submit(render, task, args)) for name, task, args in tasks]
+        for name, future in futures:
+            results[name] = future.result()
+            logger.info("Rendered {}".format(name))
+    return results
+
+
+def share_loaded_importances(importance_tasks, results):
+    """
+    Passes the importances of the random forests that the learning curve tasks already loaded on to the importance
+    tasks, which are therefore run after the learning curves.
+    """
+    loaded_importances = dict()
+    for result in results.values():
+        if isinstance(result, dict):
+            loaded_importances.update(result)
+    return [(name, task, args + (loaded_importances,)) for name, task, args in importance_tasks]
+
+
+def get_barplot_tasks(df, metric, std, folder, figsize=(4, 4), extension='png'):
+    tasks = [('grid plot', bar_grid_for_dataset, (df, metric, std, folder, figsize, extension))]
+    for dataset in df[~df['Dataset'].str.contains('Multi-Class')]['Dataset'].unique():
+        tasks.append(('single plot of {}'.format(dataset), classwise_barplot_for_dataset,
+                      (df, metric, std, folder, figsize, extension, [dataset])))
+    return tasks
+
+
+def get_learning_curve_importance_tasks(result_dirs, csv_reader, vulnerable_classes, extension='png', plotlr=False,
+                                        logger=logging.getLogger('None')):
+    """
+    Creates one render task per figure, the learning curves of each label and the feature importances of the
+    random forests with and without the missing CCS FIN messages. The learning curves come first, as they take the
+    longest. The importance tasks are returned separately, they are run once the learning curves are done with the
+    importances of the random forests the learning curve tasks loaded, see share_loaded_importances, so every model
+    is loaded only once.
+
+    :return: The learning curve tasks and the importance tasks
+    """
+    model_files = ModelStore(result_dirs.models_folder).get_model_files()
+    importance_files_missing_ccs_fin = {}
+    importance_files_ccs_fin = {}
+    tasks = []
+    for missing_ccs_fin, (label, label_number) in product(csv_reader.ccs_fin_array,
+                                                          list(csv_reader.label_mapping.items())):
         label = csv_reader.inverse_label_mapping[label_number]
         if missing_ccs_fin:
             label = label + ' Missing-CCS-FIN'
-
-        name = '-' + '_'.join(label.lower().split(' ')) + '.pickle'
-        estimators = []
-        files = glob.glob(os.path.join(models_folder, '*.pickle'))
-        files.sort()
-        for pic in files:
-            if name in pic and not ('randomclassifier' in pic or 'perceptron' in pic):
-                with open(pic, 'rb') as f:
-                    model = pickle.load(f)
-                    estimators.append(model)
-        return label, estimators, X, y
-
-    models_missing_ccs_fin = {}
-    models_ccs_fin = {}
-    for missing_ccs_fin, (label, label_number) in product(csv_reader.ccs_fin_array,
-                                                          list(csv_reader.label_mapping.items())):
-        label, estimators, X, y = get_estimators_data(result_dirs.models_folder, csv_reader, label_number=label_number,
-                                                      missing_ccs_fin=missing_ccs_fin)
+        label_files = model_files.get('_'.join(label.lower().split(' ')), dict())
         condition = label in vulnerable_classes
-        if condition:
-            name = RANDOM_FOREST_CLASSIFIER.lower() + '-' + '_'.join(label.lower().split(' ')) + '.pickle'
-            f = open(os.path.join(result_dirs.models_folder, name), 'rb')
-            model = pickle.load(f)
-
-            # model.n_estimators = 300
-            # model.fit(X, y)
+        if condition and RANDOM_FOREST_CLASSIFIER.lower() not in label_files:
+            logger.error("There is no random forest model for label {}, skipping its feature importances".format(
+                label))
+        elif condition:
+            rf_file = label_files[RANDOM_FOREST_CLASSIFIER.lower()]
             if missing_ccs_fin:
-                models_missing_ccs_fin[label] = model
+                importance_files_missing_ccs_fin[label] = rf_file
             else:
-                models_ccs_fin[label] = model
-        if len(estimators) != 0 and plotlr:
-            label = label.replace(" ", "_")
-            fname = os.path.join(result_dirs.learning_curves_folder, "learning_curves_{}.{}".format(label, extension))
-            learning_curve_for_label(estimators, X, y, condition, fname, extension)
+                importance_files_ccs_fin[label] = rf_file
+        estimator_files = [path for cls_name, path in sorted(label_files.items()) if has_learning_curve(cls_name)]
+        if len(estimator_files) != 0 and plotlr:
+            X, y = csv_reader.get_data_class_label(class_label=label_number, missing_ccs_fin=missing_ccs_fin)
+            fname = os.path.join(result_dirs.learning_curves_folder,
+                                 "learning_curves_{}.{}".format(label.replace(" ", "_"), extension))
+            importance_files = [label_files[RANDOM_FOREST_CLASSIFIER.lower()]] \
+                if condition and RANDOM_FOREST_CLASSIFIER.lower() in label_files else []
+            tasks.append(('learning curves of {}'.format(label), learning_curve_task,
+                          (estimator_files, X, y, condition, fname, extension, importance_files)))
         logger.info("Vulnerability {} Manipulation {}".format(condition, label))
     feature_names = []
     for f in csv_reader.feature_names:
@@ -415,9 +531,21 @@ def plot_learning_curves_importances(result_dirs, csv_reader, vulnerable_classes
         feature_names.append(format_name(f))
     feature_names = np.array(feature_names)
     number = 10
-    if bool(models_missing_ccs_fin):
+    importance_tasks = []
+    if bool(importance_files_missing_ccs_fin):
         fname = os.path.join(result_dirs.importance_folder, "importance_missing_ccs_fin.{}".format(extension))
-        plot_importance(models_missing_ccs_fin, feature_names, fname, extension=extension, number=number)
-    if bool(models_ccs_fin):
+        importance_tasks.append(('importances with missing CCS FIN', importance_task,
+                                 (importance_files_missing_ccs_fin, feature_names, fname, extension, number)))
+    if bool(importance_files_ccs_fin):
         fname = os.path.join(result_dirs.importance_folder, "importance_ccs_fin.{}".format(extension))
-        plot_importance(models_ccs_fin, feature_names, fname, extension=extension, number=number)
+        importance_tasks.append(('importances', importance_task,
+                                 (importance_files_ccs_fin, feature_names, fname, extension, number)))
+    return tasks, importance_tasks
+
+
+def plot_learning_curves_importances(result_dirs, csv_reader, vulnerable_classes, extension='png', plotlr=False,
+                                     logger=logging.getLogger('None'), n_jobs=1):
+    tasks, importance_tasks = get_learning_curve_importance_tasks(result_dirs, csv_reader, vulnerable_classes,
+                                                                  extension=extension, plotlr=plotlr, logger=logger)
+    results = run_render_tasks(tasks, n_jobs=n_jobs, logger=logger)
+    run_render_tasks(share_loaded_importances(importance_tasks, results), n_jobs=n_jobs, logger=logger)
@@ -0,0 +1,64 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+from sklearn.model_selection import StratifiedShuffleSplit
+
+from .fold_cache import get_data_hash
+from .utils import create_dir_recursively, dump_pickle_atomically, standardize_features
+
+__all__ = ['StandardizedFolds', 'get_folds_folder']
+
+SPLITS_FILE = 'Splits.pickle'
+
+
+def get_folds_folder(folder, label):
+    return os.path.join(folder, '_'.join(label.lower().split(' ')))
+
+
+def save_array_atomically(array, file_path):
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + '.tmp', file_path)
+
+
+class StandardizedFolds(object):
+    """
+    The outer Cross-Validation splits of a label and the standardized train and test features of every split,
+    computed once and shared read-only by all classifiers. The last split is the single train-test split of
+    CONFUSION_MATRIX_SINGLE. The features are written as .npy files and memory-mapped on loading, so the workers of
+    the process pool share the pages of the operating system instead of each receiving a pickled copy.
+    """
+
+    def __init__(self, folder):
+        self.logger = logging.getLogger(StandardizedFolds.__name__)
+        self.folder = folder
+        with open(os.path.join(self.folder, SPLITS_FILE), 'rb') as f:
+            description = pickle.load(f)
+        self.splits = description['splits']
+        self.single_split = description['single_split']
+        self.data_hash = description['data_hash']
+
+    @classmethod
+    def write(cls, folder, x, y, cv_iterator, random_state):
+        create_dir_recursively(folder, False)
+        splits = list(cv_iterator.split(x, y))
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=0.5, random_state=random_state)
+        single_split = list(sss.split(x, y))[0]
+        for i, (train_index, test_index) in enumerate(splits + [single_split]):
+            X_train, X_test = standardize_features(x[train_index], x[test_index])
+            save_array_atomically(X_train, os.path.join(folder, 'fold-{:03d}-train.npy'.format(i)))
+            save_array_atomically(X_test, os.path.join(folder, 'fold-{:03d}-test.npy'.format(i)))
+        # The splits are written last, a folder without them is incomplete and written again
+        dump_pickle_atomically(dict(splits=splits, single_split=single_split, data_hash=get_data_hash(x, y)),
+                               os.path.join(folder, SPLITS_FILE))
+        return cls(folder)
+
+    def get_fold(self, i, mmap_mode='r'):
+        X_train = np.load(os.path.join(self.folder, 'fold-{:03d}-train.npy'.format(i)), mmap_mode=mmap_mode)
+        X_test = np.load(os.path.join(self.folder, 'fold-{:03d}-test.npy'.format(i)), mmap_mode=mmap_mode)
+        return X_train, X_test
+
+    def get_single_fold(self, mmap_mode='r'):
+        return self.get_fold(len(self.splits), mmap_mode=mmap_mode)
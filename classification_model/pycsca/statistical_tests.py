@@ -1,9 +1,79 @@
 import logging
 
 import numpy as np
-from scipy.stats import t, wilcoxon
+from scipy.stats import t, wilcoxon, norm, rankdata
 
-__all__ = ["wilcoxon_signed_rank_test", "paired_ttest"]
+__all__ = ["wilcoxon_signed_rank_test", "paired_ttest", "fisher_verdict_decided", "fisher_exact_batch",
+           "holm_bonferroni_batch", "paired_ttest_batch", "wilcoxon_signed_rank_test_batch"]
+
+# Relative tolerance of scipy.stats.fisher_exact when comparing the probabilities of the tables
+FISHER_RELATIVE_TOLERANCE = 1 + 1e-7
+_log_factorials = np.zeros(1)
+
+
+def log_factorials(n):
+    """
+    Returns the table of log(k!) for k up to at least n. The table is cached and only grown, so all the confusion
+    matrices of a run share it.
+    """
+    global _log_factorials
+    if len(_log_factorials) <= n:
+        size = max(int(n) + 1, 2 * len(_log_factorials))
+        _log_factorials = np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, size)))])
+    return _log_factorials
+
+
+def fisher_exact_batch(confusion_matrices, chunk_size=256):
+    """
+    Two-sided p-values of the Fisher exact test for an (N, 2, 2) array of contingency tables, the same as
+    [fisher_exact(cm)[1] for cm in confusion_matrices]. The hypergeometric probabilities of all tables with the same
+    margins are computed at once in log-space, the p-value is the sum of those not more likely than the observed one.
+    """
+    tables = np.asarray(confusion_matrices, dtype=np.int64).reshape(-1, 2, 2)
+    p_values = np.ones(tables.shape[0])
+    if tables.shape[0] == 0:
+        return p_values
+    a, b, c, d = tables[:, 0, 0], tables[:, 0, 1], tables[:, 1, 0], tables[:, 1, 1]
+    row1, row2, col1, n = a + b, c + d, a + c, a + b + c + d
+    lf = log_factorials(n.max())
+    log_margins = lf[row1] + lf[row2] + lf[col1] + lf[n - col1] - lf[n]
+    low = np.maximum(0, col1 - row2)
+    high = np.minimum(row1, col1)
+    for start in range(0, tables.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # All possible values of the top left cell, padded to the widest support of the chunk
+        support = low[chunk, None] + np.arange((high[chunk] - low[chunk]).max() + 1)[None, :]
+        valid = support <= high[chunk, None]
+        support = np.where(valid, support, low[chunk, None])
+        log_pmf = log_margins[chunk, None] - lf[support] - lf[row1[chunk, None] - support] - \
+                  lf[col1[chunk, None] - support] - lf[row2[chunk, None] - col1[chunk, None] + support]
+        log_pmf_observed = log_margins[chunk] - lf[a[chunk]] - lf[b[chunk]] - lf[c[chunk]] - lf[d[chunk]]
+        extreme = valid & (log_pmf <= (log_pmf_observed + np.log(FISHER_RELATIVE_TOLERANCE))[:, None])
+        log_pmf = np.where(extreme, log_pmf, -np.inf)
+        maximum = log_pmf.max(axis=1)
+        p_values[chunk] = np.exp(maximum + np.log(np.exp(log_pmf - maximum[:, None]).sum(axis=1)))
+    return np.minimum(p_values, 1.0)
+
+
+def holm_bonferroni_batch(p_values, alpha=0.01):
+    """
+    Holm-Bonferroni correction along the last axis of an array of p-values, e.g. one row of classifiers for every
+    label and p-value column, the same as multipletests(p_vals, alpha, method='holm') for every row. NaN p-values,
+    e.g. of missing classifiers, do not count as hypotheses and are never rejected.
+    Returns the rejected hypotheses and the corrected p-values.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    # NaNs are sorted to the end, so they do not affect the cumulative maximum of the valid p-values
+    order = np.argsort(p_values, axis=-1)
+    p_sorted = np.take_along_axis(p_values, order, axis=-1)
+    n_hypotheses = np.sum(~np.isnan(p_values), axis=-1, keepdims=True)
+    corrected = np.maximum.accumulate((n_hypotheses - np.arange(p_values.shape[-1])) * p_sorted, axis=-1)
+    corrected = np.minimum(corrected, 1.0)
+    pvals_corrected = np.empty_like(corrected)
+    np.put_along_axis(pvals_corrected, order, corrected, axis=-1)
+    with np.errstate(invalid='ignore'):
+        rejected = pvals_corrected <= alpha
+    return rejected, pvals_corrected
 
 
 # def corrected_dependent_ttest(x1, x2, n_training_folds, n_test_folds, alpha):
@@ -45,8 +115,8 @@ def paired_ttest(x1, x2, n_training_folds, n_test_folds, correction=False, alter
 
     logger = logging.getLogger('Paired T-Test')
     if correction:
-        logger.info("With the correction option")
-    logger.info("D_bar {} Variance {} Sigma {}".format(d_bar, sigma2, np.sqrt(sigma2)))
+        logger.debug("With the correction option")
+    logger.debug("D_bar {} Variance {} Sigma {}".format(d_bar, sigma2, np.sqrt(sigma2)))
 
     # compute the modified variance
     if correction:
@@ -66,10 +136,120 @@ def paired_ttest(x1, x2, n_training_folds, n_test_folds, correction=False, alter
     elif alternative == 'two-sided':
         p = 2 * t.sf(np.abs(t_static), df)
 
-    logger.info("Final Variance {} Sigma {} t_static {} p {}".format(sigma2, np.sqrt(sigma2), t_static, p))
-    logger.info("np.isnan(p) {}, np.isinf {},  d_bar == 0 {}, sigma2_mod == 0 {}, np.isinf(t_static) {}, "
+    logger.debug("Final Variance {} Sigma {} t_static {} p {}".format(sigma2, np.sqrt(sigma2), t_static, p))
+    logger.debug("np.isnan(p) {}, np.isinf {},  d_bar == 0 {}, sigma2_mod == 0 {}, np.isinf(t_static) {}, "
                 "np.isnan(t_static) {}".format(np.isnan(p), np.isinf(p), d_bar == 0, sigma2 == 0, np.isinf(t_static),
                                                np.isnan(t_static)))
     if np.isnan(p) or np.isinf(p) or d_bar == 0 or sigma2 == 0 or np.isinf(t_static) or np.isnan(t_static):
         p = 1.0
     return p
+
+
+def get_paired_differences(x1, x2):
+    """
+    Differences of every row of x1 (e.g. baselines x folds) with every row of x2 (e.g. classifiers x folds), of shape
+    (len(x1), len(x2), folds). Rows may be padded with NaN, e.g. for classifiers which stopped early, such folds are
+    left out of the pair.
+    """
+    x1 = np.atleast_2d(np.asarray(x1, dtype=float))
+    x2 = np.atleast_2d(np.asarray(x2, dtype=float))
+    n_folds = max(x1.shape[1], x2.shape[1])
+    x1 = np.pad(x1, ((0, 0), (0, n_folds - x1.shape[1])), constant_values=np.nan)
+    x2 = np.pad(x2, ((0, 0), (0, n_folds - x2.shape[1])), constant_values=np.nan)
+    return x1[:, None, :] - x2[None, :, :]
+
+
+def paired_ttest_batch(x1, x2, n_training_folds, n_test_folds, correction=False, alternative="two-sided"):
+    """
+    Grid of the p-values of paired_ttest(x1[i], x2[j]) for every row i of x1 and j of x2, computed at once.
+    """
+    diff = get_paired_differences(x1, x2)
+    n = np.sum(~np.isnan(diff), axis=-1)
+    df = n - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_bar = np.nanmean(diff, axis=-1)
+        sigma2 = np.nansum((diff - d_bar[..., None]) ** 2, axis=-1) / df
+        if correction:
+            sigma2 = sigma2 * (1 / n + n_test_folds / n_training_folds)
+        else:
+            sigma2 = sigma2 / n
+        t_static = np.divide(d_bar, np.sqrt(sigma2))
+        if alternative == 'less':
+            p = t.cdf(t_static, df)
+        elif alternative == 'greater':
+            p = t.sf(t_static, df)
+        elif alternative == 'two-sided':
+            p = 2 * t.sf(np.abs(t_static), df)
+        else:
+            raise ValueError("Alternative must be either 'two-sided', 'greater' or 'less'")
+    logger = logging.getLogger('Paired T-Test')
+    logger.debug("D_bar {} Final Variance {} t_static {} p {}".format(d_bar, sigma2, t_static, p))
+    undefined = np.isnan(p) | np.isinf(p) | (d_bar == 0) | (sigma2 == 0) | np.isinf(t_static) | np.isnan(t_static)
+    return np.where(undefined, 1.0, p)
+
+
+# Pairs with up to this many differences are delegated to scipy.stats.wilcoxon, as its choice of the exact distribution
+# depends on the version: before scipy 1.9 it is used up to 25 differences without zeros, since then up to 50
+WILCOXON_EXACT_MAX = 50
+
+
+def wilcoxon_signed_rank_test_batch(x1, x2, alternative="two-sided"):
+    """
+    Grid of the p-values of wilcoxon_signed_rank_test(x1[i], x2[j]) for every row i of x1 and j of x2. Pairs with up
+    to WILCOXON_EXACT_MAX differences are tested by wilcoxon_signed_rank_test itself, for all larger pairs
+    scipy.stats.wilcoxon(correction=True) uses the normal approximation, whose ranks, rank sums and tie corrections
+    are computed at once. As in scipy, zero differences are dropped, pairs without any non-zero difference get a
+    p-value of 1.
+    """
+    diff = get_paired_differences(x1, x2)
+    valid = ~np.isnan(diff)
+    nonzero = valid & (diff != 0)
+    n_valid = valid.sum(axis=-1)
+    count = nonzero.sum(axis=-1)
+    absolute = np.where(nonzero, np.abs(diff), np.inf)
+    # The dropped differences are ranked last, so the ranks of the others are not affected
+    ranks = rankdata(absolute, axis=-1)
+    r_plus = np.sum(np.where(nonzero & (diff > 0), ranks, 0), axis=-1)
+    r_minus = np.sum(np.where(nonzero & (diff < 0), ranks, 0), axis=-1)
+    if alternative == "two-sided":
+        statistic = np.minimum(r_plus, r_minus)
+    elif alternative in ["less", "greater"]:
+        statistic = r_plus
+    else:
+        raise ValueError("Alternative must be either 'two-sided', 'greater' or 'less'")
+
+    # Sum of t * (t^2 - 1) over the groups of tied absolute differences
+    ties = np.sum(nonzero[..., None, :] & (absolute[..., None, :] == absolute[..., :, None]), axis=-1)
+    tie_correction = np.sum(np.where(nonzero, ties ** 2 - 1, 0), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = count * (count + 1.) * 0.25
+        se = np.sqrt((count * (count + 1.) * (2. * count + 1.) - 0.5 * tie_correction) / 24)
+        if alternative == "two-sided":
+            z = (statistic - mean - 0.5 * np.sign(statistic - mean)) / se
+            p_values = 2. * norm.sf(np.abs(z))
+        elif alternative == "greater":
+            p_values = norm.sf((statistic - mean - 0.5) / se)
+        else:
+            p_values = norm.cdf((statistic - mean + 0.5) / se)
+
+    for index in zip(*np.nonzero((n_valid <= WILCOXON_EXACT_MAX) & (count > 0))):
+        differences = diff[index][valid[index]]
+        p_values[index] = wilcoxon_signed_rank_test(differences, np.zeros_like(differences), alternative=alternative)
+    return np.where(count == 0, 1.0, p_values)
+
+
+def fisher_verdict_decided(confusion_matrices, n_folds, alpha=0.01, n_hypotheses=1):
+    """
+    Checks if the verdict on the median of the per-fold Fisher exact p-values is already decided after the folds
+    done so far, whatever the p-values of the remaining folds of the n_folds are. The median is rejected by the
+    Holm-Bonferroni correction over n_hypotheses classifiers for certain once more than half of all folds are below
+    alpha / n_hypotheses, and can not be rejected anymore once more than half of all folds are above alpha. The test
+    is only curtailed, it stops when the outcome of the complete run is known, so no further alpha spending is needed.
+    """
+    p_values = fisher_exact_batch(confusion_matrices)
+    majority = n_folds // 2 + 1
+    if np.sum(p_values < alpha / n_hypotheses) >= majority:
+        return True
+    if np.sum(p_values > alpha) >= majority:
+        return True
+    return False
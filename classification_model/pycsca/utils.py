@@ -1,12 +1,13 @@
 import inspect
 import logging
 import os
+import pickle
 import sys
 from sklearn.preprocessing import StandardScaler
 import numpy as np
 
 __all__ = ['create_dir_recursively', 'setup_logging', 'progress_bar', 'print_dictionary', 'str2bool',
-           'standardize_features', 'standardize_features']
+           'standardize_features', 'standardize_features', 'dump_pickle_atomically']
 
 
 def progress_bar(count, total, status=''):
@@ -33,6 +34,16 @@ def create_dir_recursively(path, is_file_path=False):
         os.makedirs(path, exist_ok=True)
 
 
+def dump_pickle_atomically(obj, file_path):
+    """Pickles the object to a temporary file first, so that a crash never leaves a truncated file behind"""
+    tmp_file_path = file_path + '.tmp'
+    with open(tmp_file_path, 'wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_path, file_path)
+
+
 def standardize_features(x_train, x_test):
     standardize = Standardize()
     x_train = standardize.fit_transform(x_train)
@@ -23,9 +23,13 @@ class ResultDirectories():
     def _create_intermediate_folders_(self):
         self.accuracies_file = os.path.join(self.folder, self.intermediate_folder, 'Model Accuracies.pickle')
         self.vulnerable_file = os.path.join(self.folder, self.intermediate_folder, 'Vulnerable Classes.pickle')
+        self.hpo_cache_file = os.path.join(self.folder, self.intermediate_folder, 'HPO Cache.pickle')
         self.model_result_file_path = os.path.join(self.folder, self.intermediate_folder, 'Model Results.csv')
         self.models_folder = os.path.join(self.folder, self.intermediate_folder, 'Models')
+        self.fold_cache_folder = os.path.join(self.folder, self.intermediate_folder, 'Fold Cache')
+        self.standardized_folds_folder = os.path.join(self.folder, self.intermediate_folder, 'Standardized Folds')
         self.result_file_path = os.path.join(self.folder, self.intermediate_folder, 'Final Results.csv')
+        self.interim_result_file_path = os.path.join(self.folder, self.intermediate_folder, 'Interim Results.csv')
         self.detailed_report_file = os.path.join(self.folder, self.intermediate_folder, 'Detailed Report.txt')
         create_dir_recursively(self.models_folder, False)
 
@@ -33,6 +37,7 @@ class ResultDirectories():
         self.learning_log_file = os.path.join(self.folder, self.debug_folder, 'learning.log')
         self.plotting_log_file = os.path.join(self.folder, self.debug_folder, 'plotting.log')
         self.pvalue_cal_log_file = os.path.join(self.folder, self.debug_folder, 'p-value-calculation.log')
+        self.interim_log_file = os.path.join(self.folder, self.debug_folder, 'interim-evaluation.log')
         create_dir_recursively(self.learning_log_file, True)
 
 
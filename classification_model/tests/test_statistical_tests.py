@@ -0,0 +1,32 @@
+import unittest
+
+import numpy as np
+
+from pycsca.statistical_tests import wilcoxon_signed_rank_test, wilcoxon_signed_rank_test_batch
+
+
+class WilcoxonSignedRankTestBatchTest(unittest.TestCase):
+    def assert_matches_pairwise(self, x1, x2, alternative):
+        p_values = wilcoxon_signed_rank_test_batch(x1, x2, alternative=alternative)
+        for i, j in np.ndindex(p_values.shape):
+            valid = ~np.isnan(x1[i]) & ~np.isnan(x2[j])
+            expected = wilcoxon_signed_rank_test(x1[i][valid], x2[j][valid], alternative=alternative)
+            self.assertAlmostEqual(p_values[i, j], expected, places=10,
+                                   msg="Pair {} {} of {} folds, {}".format(i, j, valid.sum(), alternative))
+
+    def test_matches_pairwise_test(self):
+        random_state = np.random.RandomState(42)
+        for n_folds in [10, 30, 60]:
+            # Rounded accuracies, so that there are ties and zero differences as with real folds
+            x1 = np.round(random_state.uniform(0.4, 0.6, size=(3, n_folds)), 2)
+            x2 = np.round(random_state.uniform(0.45, 0.65, size=(4, n_folds)), 2)
+            x2[0] = x1[0]
+            x2[1, :5] = x1[1, :5]
+            # A classifier which stopped early
+            x2[2, n_folds // 2:] = np.nan
+            for alternative in ["two-sided", "less", "greater"]:
+                self.assert_matches_pairwise(x1, x2, alternative)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,20 +1,29 @@
 import argparse
+import copy
 import logging
 import numpy as np
 import os
 import pickle
+import shutil
 import warnings
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from itertools import product
+from joblib.externals.loky import get_reusable_executor
 from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
 from sklearn.utils import check_random_state
 
 from result_directories import ResultDirectories
-from pycsca.classification_test import optimize_search_cv
-from pycsca.classifiers import classifiers_space
+from pycsca.classification_test import get_best_fold, get_final_estimator, optimize_search_cv
+from pycsca.classifiers import classifiers_space, custom_dict
 from pycsca.constants import *
 from pycsca.csv_reader import CSVReader
-from pycsca.utils import setup_logging, print_dictionary
+from pycsca.fold_cache import FoldCache
+from pycsca.hpo_cache import HPOCache
+from pycsca.hpo_engines import HPO_BAYES, HPO_ENGINES
+from pycsca.model_store import ModelStore
+from pycsca.standardized_folds import StandardizedFolds, get_folds_folder
+from pycsca.utils import setup_logging, print_dictionary, dump_pickle_atomically
 
 
 def print_accuracies(cls_name, label, scores):
@@ -26,6 +35,73 @@ def print_accuracies(cls_name, label, scores):
     logger.info("Classifier {}, label {}, Evaluations {}".format(cls_name, label, print_dictionary(d)))
 
 
+def expected_time(cls_name, label, metrics_dictionary):
+    """
+    Expected duration of a task from the recorded HPO-Time, of the same task if it was run before, otherwise the mean
+    of the classifier over all labels. Tasks without any history are expected to take longest.
+    """
+    scores_m = metrics_dictionary.get(SCORE_KEY_FORMAT.format(cls_name, label), None)
+    if scores_m is not None and TIME_TAKEN in scores_m:
+        return scores_m[TIME_TAKEN]
+    times = [v[TIME_TAKEN] for k, v in metrics_dictionary.items() if isinstance(v, dict) and TIME_TAKEN in v and
+             k.startswith(SCORE_KEY_FORMAT.format(cls_name, ''))]
+    if len(times) > 0:
+        return np.mean(times)
+    return np.inf
+
+
+# Workers forked from the scheduler inherit the loaded dataset, spawned workers load it once on their first task
+dataset_reader = None
+
+
+def get_task_data(folder, j, missing_ccs_fin):
+    global dataset_reader
+    if dataset_reader is None:
+        dataset_reader = CSVReader(folder=folder, seed=42)
+    return dataset_reader.get_data_class_label(class_label=j, missing_ccs_fin=missing_ccs_fin)
+
+
+def run_task(classifier, params, search_space, cv_iterator, hp_iterations, folder, j, missing_ccs_fin, label, n_jobs,
+             random_state, parallel_outer, early_stopping, models_folder, warm_start=False, seed_points=None,
+             initial_points=None, hpo=HPO_BAYES, fold_cache_folder=None, lean=False, folds_folder=None):
+    logger = logging.getLogger("LearningExperiment")
+    start_task = datetime.now()
+    x, y = get_task_data(folder, j, missing_ccs_fin)
+    fold_cache = FoldCache(fold_cache_folder) if fold_cache_folder is not None else None
+    folds = StandardizedFolds(folds_folder) if folds_folder is not None else None
+    cls_name = classifier.__name__
+    logger.info("#############################################################################")
+    logger.info("Classifier {}, running for class {}".format(cls_name, label))
+    params['random_state'] = random_state
+    scores_m = optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterations, x, y,
+                                  n_jobs=n_jobs, random_state=random_state, parallel_outer=parallel_outer,
+                                  early_stopping=early_stopping, n_hypotheses=len(classifiers_space) - 3,
+                                  warm_start=warm_start, seed_points=seed_points, initial_points=initial_points,
+                                  hpo=hpo, fold_cache=fold_cache, folds=folds)
+    if lean:
+        logger.info("Deferring the final model of classifier {} for label {} to fit_models.py".format(cls_name, label))
+    else:
+        best_estimator = get_final_estimator(classifier, scores_m[BEST_PARAMETERS])
+        best_estimator.fit(x, y)
+        # The index of the store is updated by the scheduler, see run_and_checkpoint
+        scores_m[MODEL_ENTRY] = ModelStore(models_folder).save(best_estimator, cls_name, label, missing_ccs_fin,
+                                                               best_estimator.get_params())
+    total = (datetime.now() - start_task).total_seconds()
+    logger.info("Time taken for classifier {} and label {} is {} minutes".format(cls_name, label, total / 60))
+    return scores_m
+
+
+def run_pool_task(*args):
+    """
+    Runs a task in a worker of the process pool. joblib starts a loky executor in the worker for the search and the
+    folds, whose processes only exit after an idle timeout of 300 seconds, which would stall the shutdown of the pool
+    by that long once the last task is done.
+    """
+    try:
+        return run_task(*args)
+    finally:
+        get_reusable_executor().shutdown(wait=True)
+
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -58,6 +134,31 @@ if __name__ == "__main__":
                         help='The decision to skip the learning task for the current configuration')
     parser.add_argument('-dl', '--debuglevel', choices=list(debug_levels.keys()), default=1,
                         help='The Debug level specifying if the Debug and Intermediate Result folder to be stored')
+    parser.add_argument('-nw', '--n_workers', type=int, default=1,
+                        help='Number of (label, classifier) tasks to be run in parallel, sharing n_jobs')
+    parser.add_argument('-po', '--parallel_outer', type=str2bool, nargs='?', const=True, default=False,
+                        help='Run the outer Cross-Validation folds in parallel, splitting n_jobs between the folds, '
+                             'the inner hyper-parameter search and the classifier')
+    parser.add_argument('-es', '--early_stopping', type=str2bool, nargs='?', const=True, default=False,
+                        help='Stop the Cross-Validation of a classifier as soon as the Fisher exact test verdict '
+                             'can not change anymore with the remaining folds')
+    parser.add_argument('-ws', '--warm_start', type=str2bool, nargs='?', const=True, default=False,
+                        help='Seed the hyper-parameter search of every fold with the points evaluated in earlier '
+                             'folds and runs, cached in the Intermediate Results, and try the best parameters of the '
+                             'other labels first')
+    parser.add_argument('-hpo', '--hpo', choices=HPO_ENGINES, default=HPO_BAYES,
+                        help='Hyper-parameter optimization engine: Bayesian optimization, successive halving over '
+                             'n_estimators, max_iter or the number of samples, or random search')
+    parser.add_argument('-fc', '--fold_cache', type=str2bool, nargs='?', const=True, default=True,
+                        help='Reuse the scores of the Cross-Validation folds already computed by earlier runs, '
+                             'cached in the Intermediate Results. With --warm_start, reruns keep the warm start '
+                             'points of the first run, so that its folds are reused')
+    parser.add_argument('-lm', '--lean', type=str2bool, nargs='?', const=True, default=False,
+                        help='Do not fit the final models on the whole dataset, fit_models.py fits the ones the plots '
+                             'need once the vulnerable labels are known')
+    parser.add_argument('-sf', '--shared_folds', type=str2bool, nargs='?', const=True, default=True,
+                        help='Split and standardize the Cross-Validation folds of every label once and share them '
+                             'between all classifiers, memory-mapped from the Intermediate Results')
     args = parser.parse_args()
     cv_iterations = int(args.cv_iterations)
     hp_iterations = int(args.iterations)
@@ -66,6 +167,15 @@ if __name__ == "__main__":
     folder = args.folder
     cv_technique = str(args.cv_technique)
     debug_level = int(args.debuglevel)
+    parallel_outer = args.parallel_outer
+    n_workers = max(1, int(args.n_workers))
+    early_stopping = args.early_stopping
+    hpo = str(args.hpo)
+    # Only the Bayesian search can be seeded with the cached points
+    warm_start = args.warm_start and hpo == HPO_BAYES
+    use_fold_cache = args.fold_cache
+    lean = args.lean
+    shared_folds = args.shared_folds
     random_state = check_random_state(42)
 
     result_files = ResultDirectories(folder=folder, debug_level=debug_level)
@@ -73,6 +183,7 @@ if __name__ == "__main__":
     logger = logging.getLogger("LearningExperiment")
     logger.info("Arguments {}".format(args))
     csv_reader = CSVReader(folder=folder, seed=42)
+    dataset_reader = csv_reader
     csv_reader.plot_class_distribution()
     dataset = args.folder.split('/')[-1]
     if os.path.exists(result_files.accuracies_file):
@@ -105,55 +216,100 @@ if __name__ == "__main__":
     cv_iterations_dict[CV_ITERATOR] = str(cv_iterator).split('(')[0]
     cv_iterations_dict[N_SPLITS] = cv_iterations
     metrics_dictionary[DEBUG_LEVEL] = debug_level
+    metrics_dictionary[CV_ITERATIONS_LABEL] = cv_iterations_dict
+    tasks = []
     for missing_ccs_fin, (label, j) in product(csv_reader.ccs_fin_array, list(csv_reader.label_mapping.items())):
-        start_label = datetime.now()
-        dt_string = start_label.strftime("%d/%m/%Y %H:%M:%S")
-        logger.info("#############################################################################")
-        logger.info("Starting time = {}".format(dt_string))
-        i = 0
-        x, y = csv_reader.get_data_class_label(class_label=j, missing_ccs_fin=missing_ccs_fin)
         if j == 0:
-            label = MULTI_CLASS
             logger.info("Skipping Multi-Class")
             continue
         if missing_ccs_fin:
             label = label + ' Missing-CCS-FIN'
-
         for classifier, params, search_space in classifiers_space:
-            logger.info("#############################################################################")
-            logger.info("Classifier {}, running for class {}".format(classifier.__name__, label))
             cls_name = classifier.__name__
             KEY = SCORE_KEY_FORMAT.format(cls_name, label)
             scores_m = metrics_dictionary.get(KEY, None)
             if skip_existing and scores_m is not None:
-                logger.info("Classifier {}, is already evaluated for label {}".format(classifier.__name__, label))
+                logger.info("Classifier {}, is already evaluated for label {}".format(cls_name, label))
                 print_accuracies(cls_name, label, scores_m)
             else:
-                params['random_state'] = random_state
-                n_classes = csv_reader.n_labels
-                if int(test_size * y.shape[0]) < n_classes:
-                    test_size = (n_classes * 2) / y.shape[0]
-                scores_m = optimize_search_cv(classifier, params, search_space, cv_iterator, hp_iterations, x, y,
-                                              n_jobs=n_jobs, random_state=random_state)
-                metrics_dictionary[KEY] = scores_m
-                name = cls_name.lower() + '-' + '_'.join(label.lower().split(' ')) + '.pickle'
-                file_name = os.path.join(result_files.models_folder, name)
-                idx = np.argmin(np.array(scores_m[BEST_PARAMETERS])[:, 0])
-                best_params = scores_m[BEST_PARAMETERS][idx][1]
-                params_str = print_dictionary(best_params, sep='\t')
-                params.update(best_params)
-                best_estimator = classifier(**params)
-                best_estimator.fit(x, y)
-                with open(file_name, 'wb') as f:
-                    pickle.dump(best_estimator, f)
-        end_label = datetime.now()
-        total = (end_label - start_label).total_seconds()
-        logger.info("Time taken for evaluation of label {} is {} minutes ".format(label, total / 60))
-        logger.info("#######################################################################")
+                tasks.append((classifier, params, search_space, label, j, missing_ccs_fin))
+    # Longest expected tasks first, so that the cheap baselines fill the gaps at the end instead of waiting in front
+    tasks.sort(key=lambda task: (-expected_time(task[0].__name__, task[3], metrics_dictionary),
+                                 -custom_dict.get(task[0].__name__, 0)))
+    logger.info("Scheduling {} tasks on {} workers".format(len(tasks), n_workers))
+
+    folds_folders = dict()
+    if shared_folds:
+        for classifier, params, search_space, label, j, missing_ccs_fin in tasks:
+            if label in folds_folders:
+                continue
+            x, y = csv_reader.get_data_class_label(class_label=j, missing_ccs_fin=missing_ccs_fin)
+            folds_folders[label] = get_folds_folder(result_files.standardized_folds_folder, label)
+            # Every label is split with its own copy of the random state, as the workers of the pool would
+            fold_cv_iterator, fold_random_state = copy.deepcopy((cv_iterator, random_state))
+            StandardizedFolds.write(folds_folders[label], x, y, fold_cv_iterator, fold_random_state)
+        logger.info("Standardized the Cross-Validation folds of {} labels".format(len(folds_folders)))
+
+    hpo_cache = HPOCache(result_files.hpo_cache_file, csv_reader.fingerprint) if warm_start else None
+    model_store = ModelStore(result_files.models_folder)
+
+    def task_arguments(classifier, params, search_space, label, j, missing_ccs_fin):
+        # The cache is read when the task starts, so it sees the results of all tasks finished before
+        seed_points = hpo_cache.get_seed_points(classifier.__name__, label) if warm_start else None
+        initial_points = hpo_cache.get_initial_points(classifier.__name__, label) if warm_start else None
+        return (classifier, copy.deepcopy(params), search_space, cv_iterator, hp_iterations, folder, j,
+                missing_ccs_fin, label, max(1, n_jobs // n_workers), random_state, parallel_outer, early_stopping,
+                result_files.models_folder, warm_start, seed_points, initial_points, hpo,
+                result_files.fold_cache_folder if use_fold_cache else None, lean, folds_folders.get(label, None))
+
+    failed_tasks = []
+
+    def run_and_checkpoint(classifier, label, search_space, run):
+        try:
+            scores_m = run()
+        except Exception as error:
+            # The other tasks still run, the failures are reported once all of them are done
+            logger.exception("Classifier {} failed for label {} with error {}".format(classifier.__name__, label,
+                                                                                      error))
+            failed_tasks.append("{} for label {}".format(classifier.__name__, label))
+            return
+        KEY = SCORE_KEY_FORMAT.format(classifier.__name__, label)
+        hpo_points = scores_m.pop(HPO_POINTS, [])
+        model_entry = scores_m.pop(MODEL_ENTRY, None)
+        if model_entry is not None:
+            model_store.add_entry(model_entry)
+        metrics_dictionary[KEY] = scores_m
+        dump_pickle_atomically(metrics_dictionary, result_files.accuracies_file)
+        if warm_start and len(hpo_points) > 0:
+            best_fold = get_best_fold(scores_m[BEST_PARAMETERS])
+            best_params = {k: v for k, v in scores_m[BEST_PARAMETERS][best_fold][1].items() if k in search_space}
+            hpo_cache.update(classifier.__name__, label, hpo_points, best_params)
+            hpo_cache.save()
+        logger.info("Checkpointed the scores of classifier {} for label {}".format(classifier.__name__, label))
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # Tasks are submitted one by one as workers become free, keeping the longest-expected-first order
+            futures = {}
+            pending_tasks = list(tasks)
+            while len(pending_tasks) > 0 or len(futures) > 0:
+                while len(pending_tasks) > 0 and len(futures) < n_workers:
+                    task = pending_tasks.pop(0)
+                    futures[executor.submit(run_pool_task, *task_arguments(*task))] = task
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    run_and_checkpoint(task[0], task[3], task[2], future.result)
+    else:
+        for task in tasks:
+            run_and_checkpoint(task[0], task[3], task[2], lambda: run_task(*task_arguments(*task)))
+    if os.path.exists(result_files.standardized_folds_folder):
+        shutil.rmtree(result_files.standardized_folds_folder)
     end = datetime.now()
     total = (end - start).total_seconds()
     logger.info("Time taken for finishing the learning task is {} seconds and {} hours".format(total, total / 3600))
     logger.info("#######################################################################")
-    metrics_dictionary[CV_ITERATIONS_LABEL] = cv_iterations_dict
-    with open(result_files.accuracies_file, 'wb') as file:
-        pickle.dump(metrics_dictionary, file)
+    dump_pickle_atomically(metrics_dictionary, result_files.accuracies_file)
+    if len(failed_tasks) > 0:
+        raise RuntimeError("{} of {} tasks failed, their scores are missing: {}".format(len(failed_tasks), len(tasks),
+                                                                                       ', '.join(failed_tasks)))
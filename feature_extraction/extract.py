@@ -1,6 +1,8 @@
-from typing import List, Optional, Dict, Union
+from typing import List, Optional, Dict, Union, Tuple
 
-from network_trace import IterableCapture
+from feature_store import write_feature_store, write_feature_part, FEATURES_FILE, FEATURE_PARTS_FOLDER
+from network_trace import IterableCapture, StreamingCapture
+from raw_trace import RawCapture, FIELD_DIFFERENCES
 from state_machine import StateMachine
 from state_machine import State
 
@@ -13,12 +15,90 @@ import pandas
 from num2words import num2words
 
 import argparse
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import time
 
 
 class FeatureExtractor:
-    def __init__(self, capture_file: str, label_file: str):
-        self.iterable_capture = IterableCapture(capture_file)
-        self.label_dataframe = pandas.read_csv(label_file)
+    def __init__(self, capture_file: str, label_file: str, single_pass: bool = False, backend: str = 'pyshark',
+                 follow: bool = False, stop_file: Optional[str] = None):
+        self.capture_file = capture_file
+        self.label_file = label_file
+        self.single_pass = single_pass
+        self.backend = backend
+        self.follow = follow
+        self.stop_file = stop_file
+        self.iterable_capture = None
+        self.label_modified = None
+        self.label_dataframe = self.read_label_file()
+        self.label_index, self.duplicate_randoms = self.build_label_index(self.label_dataframe)
+        self.unmatched_randoms = 0
+
+    def read_label_file(self) -> pandas.DataFrame:
+        if not self.follow:
+            return pandas.read_csv(self.label_file)
+        # The client may still be appending to the label file, only the complete lines are used
+        empty_dataframe = pandas.DataFrame(columns=['client_hello_random', 'label', 'skipped_ccs_fin'])
+        if not os.path.exists(self.label_file):
+            return empty_dataframe
+        self.label_modified = os.path.getmtime(self.label_file)
+        with open(self.label_file, 'rb') as label_file:
+            content = label_file.read()
+        content = content[:content.rfind(b'\n') + 1]
+        return pandas.read_csv(io.BytesIO(content)) if content else empty_dataframe
+
+    def refresh_label_index(self):
+        """
+        Rebuilds the label index if the label file changed since it was read last.
+        """
+        if os.path.exists(self.label_file) and os.path.getmtime(self.label_file) != self.label_modified:
+            self.label_dataframe = self.read_label_file()
+            self.label_index, self.duplicate_randoms = self.build_label_index(self.label_dataframe)
+
+    def open_capture(self, shard_index: int = 0, shard_count: int = 1):
+        if self.backend == 'raw' or self.follow:
+            # The raw decoder always reads the capture in a single pass, and it is the only one that can follow it
+            return RawCapture(self.capture_file, shard_index=shard_index, shard_count=shard_count,
+                              follow=self.follow, stop_file=self.stop_file)
+        elif self.single_pass and shard_count == 1:
+            return StreamingCapture(self.capture_file)
+        else:
+            # StreamingCapture cannot filter the sessions of a shard in tshark, every shard would dissect the whole
+            # capture, the slices of IterableCapture are filtered in tshark
+            return IterableCapture(self.capture_file, shard_index=shard_index, shard_count=shard_count)
+
+    @staticmethod
+    def normalize_random(random: str) -> str:
+        # tshark shows the random as colon separated hex, be lenient towards other separators and upper case
+        return ''.join(character for character in str(random).lower() if character in '0123456789abcdef')
+
+    @staticmethod
+    def build_label_index(label_dataframe: pandas.DataFrame) -> (Dict[str, Tuple[str, bool]], int):
+        """
+        Builds a hash index from the normalized client hello random to the label and the skipped CCS/FIN flag.
+
+        :return: The index and the number of randoms that appear more than once, of those the first row is used
+        """
+        label_index = {}
+        duplicate_randoms = 0
+        if label_dataframe is None:
+            return label_index, duplicate_randoms
+        if 'skipped_ccs_fin' in label_dataframe:
+            skipped_ccs_fin = label_dataframe['skipped_ccs_fin']
+        else:
+            skipped_ccs_fin = [False] * len(label_dataframe)
+        for random, label, missing in zip(label_dataframe['client_hello_random'], label_dataframe['label'],
+                                          skipped_ccs_fin):
+            random = FeatureExtractor.normalize_random(random)
+            if random in label_index:
+                duplicate_randoms += 1
+            else:
+                label_index[random] = (label, missing)
+        return label_index, duplicate_randoms
 
     @staticmethod
     def is_from_server(packet: Packet, server_ip: str) -> bool:
@@ -34,30 +114,32 @@ class FeatureExtractor:
         if 'ipv6' in packet:
             return packet.ipv6.dst.get_default_value() == server_ip
 
+    @staticmethod
+    def get_session_random(session: List[Packet]) -> str:
+        # Iterate over all packets until we hit the client hello, then save its random
+        session_client_hello_random = ""
+        for packet in session:
+            if 'TLS' in packet and packet.tls.get('handshake') and \
+                    packet.tls.get('handshake').get_default_value() == 'Handshake Protocol: Client Hello':
+                # We got a TLS Client Hello, extract the randomness from it
+                session_client_hello_random = packet.tls.get('handshake_random').get_default_value()
+
+            if 'SSL' in packet and packet.ssl.get('handshake') and \
+                    packet.ssl.get('handshake').get_default_value() == 'Handshake Protocol: Client Hello':
+                # We got a SSL Client Hello, extract the randomness from it
+                session_client_hello_random = packet.ssl.get('handshake_random').get_default_value()
+        return FeatureExtractor.normalize_random(session_client_hello_random)
+
     def get_session_label(self, session: List[Packet]) -> Dict[str, Union[str, bool]]:
         label = 'label unknown'
         missing = False
         if self.label_dataframe is not None:
-            # Iterate over all packets until we hit the client hello, then save its random
-            session_client_hello_random = ""
-            for packet in session:
-                if 'TLS' in packet and packet.tls.get('handshake') and \
-                        packet.tls.get('handshake').get_default_value() == 'Handshake Protocol: Client Hello':
-                    # We got a TLS Client Hello, extract the randomness from it
-                    session_client_hello_random = packet.tls.get('handshake_random').get_default_value()
-
-                if 'SSL' in packet and packet.ssl.get('handshake') and \
-                        packet.ssl.get('handshake').get_default_value() == 'Handshake Protocol: Client Hello':
-                    # We got a SSL Client Hello, extract the randomness from it
-                    session_client_hello_random = packet.ssl.get('handshake_random').get_default_value()
-            # Match the session random to the randoms in the label dataframe
-            matching_label = self.label_dataframe.loc[self.label_dataframe['client_hello_random'] == session_client_hello_random]
-            if len(matching_label) > 0:
-                label = matching_label['label'].iloc[0]
-                if 'skipped_ccs_fin' in matching_label:
-                    missing = matching_label['skipped_ccs_fin'].iloc[0]
+            # Match the session random to the randoms in the label index
+            matching_label = self.label_index.get(self.get_session_random(session))
+            if matching_label is not None:
+                label, missing = matching_label
             else:
-                print(f'Warning: No matching label found for randomness "{session_client_hello_random}"')
+                self.unmatched_randoms += 1
 
         return {'label': label, 'missing_ccs_fin': missing}
 
@@ -168,11 +250,18 @@ class FeatureExtractor:
 
         return session_features, session_column_names
 
-    def extract_capture_features(self) -> (pandas.DataFrame, pandas.DataFrame):
-        print('Starting feature extraction')
+    def extract_shard_features(self, shard_index: int = 0, shard_count: int = 1) -> (list, dict, int):
+        """
+        Extracts the features of all TCP sessions that belong to one shard of the capture.
 
-        capture_labeled_features = []
-        capture_column_names = {}
+        :return: A list of (tcp.stream index, labeled session features) and, for every column name, a tuple of
+            (first occurrence as (tcp.stream index, position within the session), last tcp.stream index, human name)
+            so that shards can be merged exactly as if the whole capture had been processed serially, as well as the
+            number of sessions whose client hello random was not found in the label file
+        """
+        self.iterable_capture = self.open_capture(shard_index, shard_count)
+        shard_labeled_features = []
+        shard_column_names = {}
         for index, tcp_session in self.iterable_capture:
             session_label = self.get_session_label(tcp_session)
             session_features, session_column_names = self.extract_session_features(tcp_session)
@@ -183,23 +272,212 @@ class FeatureExtractor:
             if len(session_features) < 3:
                 print(f'Ignoring session {index} containing no TLS key exchange')
             else:
-                capture_labeled_features.append(session_labeled_features)
-                capture_column_names.update(session_column_names)
+                shard_labeled_features.append((index, session_labeled_features))
+                self.add_column_names(shard_column_names, index, session_column_names)
+        return shard_labeled_features, shard_column_names, self.unmatched_randoms
+
+    @staticmethod
+    def add_column_names(shard_column_names: dict, index: int, session_column_names: Dict[str, str]):
+        for position, (machine_name, human_name) in enumerate(session_column_names.items()):
+            first_occurrence, last_index, _ = shard_column_names.get(machine_name, ((index, position), index, None))
+            if index >= last_index:
+                last_index, last_human_name = index, human_name
+            else:
+                last_human_name = shard_column_names[machine_name][2]
+            shard_column_names[machine_name] = (min(first_occurrence, (index, position)), last_index, last_human_name)
 
-        features_dataframe = pandas.DataFrame(capture_labeled_features)
+    def follow_capture_features(self, parts_folder: str, batch_size: int = 1000,
+                                flush_interval: float = 60.0) -> (list, dict, int):
+        """
+        Extracts the features of a capture that is still being written, until the stop file exists. Every batch_size
+        sessions or flush_interval seconds, the labeled sessions are written as a new part of the feature store, so
+        the classification can already evaluate the growing dataset. Sessions whose client hello random is not in
+        the label file yet are kept back until the client has written it, or until the capture is stopped.
+
+        :return: The same as extract_shard_features, for the whole capture
+        """
+        print(f'Following {self.capture_file} until {self.stop_file} exists')
+        self.iterable_capture = self.open_capture()
+        labeled_features = []
+        column_names = {}
+        pending_sessions = []
+        part_index = 0
+        last_flush = time.time()
+
+        def flush(final: bool):
+            nonlocal pending_sessions, part_index, last_flush
+            self.refresh_label_index()
+            part_features, part_column_names, still_pending = [], {}, []
+            for index, random, session_features, session_column_names in pending_sessions:
+                matching_label = self.label_index.get(random)
+                if matching_label is None and not final:
+                    still_pending.append((index, random, session_features, session_column_names))
+                    continue
+                if matching_label is None:
+                    self.unmatched_randoms += 1
+                    matching_label = ('label unknown', False)
+                session_labeled_features = {'label': matching_label[0], 'missing_ccs_fin': matching_label[1]}
+                session_labeled_features.update(session_features)
+                part_features.append((index, session_labeled_features))
+                self.add_column_names(part_column_names, index, session_column_names)
+                self.add_column_names(column_names, index, session_column_names)
+            pending_sessions = still_pending
+            last_flush = time.time()
+            if part_features:
+                labeled_features.extend(part_features)
+                features_dataframe, column_names_dataframe, _ = self.merge_shard_results([(part_features,
+                                                                                           part_column_names, 0)])
+                write_feature_part(features_dataframe, column_names_dataframe, parts_folder, part_index)
+                print(f'Wrote part {part_index} with {len(part_features)} sessions, {len(labeled_features)} in total, '
+                      f'{len(pending_sessions)} waiting for their label')
+                part_index += 1
+
+        for index, tcp_session in self.iterable_capture:
+            session_features, session_column_names = self.extract_session_features(tcp_session)
+            if len(session_features) < 3:
+                print(f'Ignoring session {index} containing no TLS key exchange')
+                continue
+            pending_sessions.append((index, self.get_session_random(tcp_session), session_features,
+                                     session_column_names))
+            if len(pending_sessions) >= batch_size or time.time() - last_flush >= flush_interval:
+                flush(final=False)
+        flush(final=True)
+        return labeled_features, column_names, self.unmatched_randoms
+
+    @staticmethod
+    def merge_shard_results(shard_results: list) -> (pandas.DataFrame, pandas.DataFrame, int):
+        # Merge the shards in tcp.stream order, the column names in the order the serial extraction would see them
+        capture_labeled_features = sorted((row for rows, _, _ in shard_results for row in rows), key=lambda row: row[0])
+        first_occurrences = {}
+        last_occurrences = {}
+        for _, shard_column_names, _ in shard_results:
+            for machine_name, (first_occurrence, last_index, human_name) in shard_column_names.items():
+                if machine_name not in first_occurrences or first_occurrence < first_occurrences[machine_name]:
+                    first_occurrences[machine_name] = first_occurrence
+                if machine_name not in last_occurrences or last_index > last_occurrences[machine_name][0]:
+                    last_occurrences[machine_name] = (last_index, human_name)
+        capture_column_names = {machine_name: last_occurrences[machine_name][1]
+                                for machine_name in sorted(first_occurrences, key=first_occurrences.get)}
+
+        features_dataframe = pandas.DataFrame([features for _, features in capture_labeled_features])
         column_names_dataframe = pandas.DataFrame(capture_column_names.items(), columns=['machine', 'human'])
+        unmatched_randoms = sum(shard_unmatched_randoms for _, _, shard_unmatched_randoms in shard_results)
+        return features_dataframe, column_names_dataframe, unmatched_randoms
+
+    def extract_capture_features(self, processes: int = 1, parts_folder: Optional[str] = None,
+                                 batch_size: int = 1000) -> (pandas.DataFrame, pandas.DataFrame):
+        print('Starting feature extraction')
+
+        if self.follow:
+            shard_results = [self.follow_capture_features(parts_folder, batch_size=batch_size)]
+        elif processes > 1:
+            shard_arguments = [[self.capture_file, self.label_file, self.single_pass, self.backend, shard_index,
+                                processes] for shard_index in range(processes)]
+            with multiprocessing.Pool(processes=processes) as pool:
+                shard_results = pool.starmap(extract_shard_features, shard_arguments)
+        else:
+            shard_results = [self.extract_shard_features()]
+
+        features_dataframe, column_names_dataframe, unmatched_randoms = self.merge_shard_results(shard_results)
+        if unmatched_randoms:
+            print(f'Warning: No matching label found for {unmatched_randoms} sessions')
+        if self.duplicate_randoms:
+            print(f'Warning: {self.duplicate_randoms} client hello randoms appear more than once in the label file, '
+                  f'using the first label')
         print(f'Finished feature extraction')
         return features_dataframe, column_names_dataframe
 
 
+def extract_shard_features(capture_file: str, label_file: str, single_pass: bool, backend: str, shard_index: int,
+                           shard_count: int) -> (list, dict, int):
+    extractor = FeatureExtractor(capture_file, label_file, single_pass=single_pass, backend=backend)
+    return extractor.extract_shard_features(shard_index, shard_count)
+
+
+def compare_backends(capture_file: str, label_file: str) -> int:
+    """
+    The parity check of the raw backend. Extracts the features of a capture with tshark through pyshark and with the
+    raw decoder, and prints every feature that only one of them extracted and every feature whose values differ.
+
+    :return: The number of differences
+    """
+    backend_features = {}
+    for backend in ['pyshark', 'raw']:
+        extractor = FeatureExtractor(capture_file, label_file, single_pass=True, backend=backend)
+        backend_features[backend], _ = extractor.extract_capture_features()
+    pyshark_features, raw_features = backend_features['pyshark'], backend_features['raw']
+    differences = 0
+    for backend, features, other_features in [('pyshark', pyshark_features, raw_features),
+                                              ('raw', raw_features, pyshark_features)]:
+        for machine_name in features.columns.difference(other_features.columns, sort=False):
+            print(f'Only the {backend} backend extracted {machine_name}')
+            differences += 1
+    if len(pyshark_features) != len(raw_features):
+        print(f'The pyshark backend extracted {len(pyshark_features)} sessions, the raw backend {len(raw_features)}')
+        differences += 1
+    else:
+        for machine_name in pyshark_features.columns.intersection(raw_features.columns, sort=False):
+            pyshark_values, raw_values = pyshark_features[machine_name], raw_features[machine_name]
+            differing = ~((pyshark_values == raw_values) | (pyshark_values.isna() & raw_values.isna()))
+            if differing.any():
+                example = differing.idxmax()
+                print(f'{machine_name} differs in {differing.sum()} sessions, e.g. {pyshark_values[example]} with '
+                      f'the pyshark backend and {raw_values[example]} with the raw backend')
+                differences += 1
+    print(f'Found {differences} differences between the backends')
+    return differences
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--folder', '-f', help='Folder that contains the input files Packets.pcap and Client Requests.csv '
                                                'and that the output files will be written to')
+    parser.add_argument('--singlepass', '-s', action='store_true', default=False,
+                        help='Read the capture only once and process every TCP session as soon as it is closed, '
+                             'instead of re-reading the capture for every slice of 10000 sessions. With the pyshark '
+                             'backend, only without --processes')
+    parser.add_argument('--backend', '-b', choices=['pyshark', 'raw'], default='pyshark',
+                        help=f'Dissect the capture with tshark through pyshark, or decode the TCP and TLS headers '
+                             f'directly from the capture bytes without tshark (implies --singlepass). The raw backend '
+                             f'extracts the same features except for {FIELD_DIFFERENCES}')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='Parallelization factor, how many processes extract disjoint ranges of TCP sessions '
+                             'concurrently. With the pyshark backend, every process reads the slices of its own '
+                             'sessions, --singlepass is ignored since tshark would dissect the whole capture once per '
+                             'process')
+    parser.add_argument('--csv', action='store_true', default=False,
+                        help=f'Additionally write the features as Features.csv, the classification reads {FEATURES_FILE}')
+    parser.add_argument('--xlsx', action='store_true', default=False,
+                        help='Additionally write the features and feature names as Excel files, which is slow for '
+                             'large captures')
+    parser.add_argument('--follow', action='store_true', default=False,
+                        help=f'Extract the features while the capture is still being written, appending them to '
+                             f'{FEATURE_PARTS_FOLDER} until the stop file exists (implies --backend raw)')
+    parser.add_argument('--paritycheck', action='store_true', default=False,
+                        help='Instead of writing the features, extract them with both backends and print every '
+                             'difference of the raw backend to tshark')
+    parser.add_argument('--stopfile', default=None,
+                        help='With --follow, the capture is complete once this file exists, '
+                             'defaults to "Capture Done" in the folder')
+    parser.add_argument('--batchsize', type=int, default=1000,
+                        help='With --follow, the number of sessions written to the feature store at a time')
     args = parser.parse_args()
-    extractor = FeatureExtractor(f'{args.folder}/Packets.pcap', f'{args.folder}/Client Requests.csv')
-    feature_dataframe, column_name_dataframe = extractor.extract_capture_features()
-    feature_dataframe.to_csv(f'{args.folder}/Features.csv')
-    feature_dataframe.to_excel(f'{args.folder}/Features.xlsx')
+    if args.paritycheck:
+        sys.exit(1 if compare_backends(f'{args.folder}/Packets.pcap', f'{args.folder}/Client Requests.csv') else 0)
+    stop_file = args.stopfile if args.stopfile else f'{args.folder}/Capture Done'
+    extractor = FeatureExtractor(f'{args.folder}/Packets.pcap', f'{args.folder}/Client Requests.csv',
+                                 single_pass=args.singlepass, backend=args.backend, follow=args.follow,
+                                 stop_file=stop_file)
+    parts_folder = f'{args.folder}/{FEATURE_PARTS_FOLDER}'
+    feature_dataframe, column_name_dataframe = extractor.extract_capture_features(
+        processes=1 if args.follow else args.processes, parts_folder=parts_folder, batch_size=args.batchsize)
+    write_feature_store(feature_dataframe, column_name_dataframe, f'{args.folder}/{FEATURES_FILE}')
+    if args.follow:
+        # The complete feature store replaces the parts
+        shutil.rmtree(parts_folder, ignore_errors=True)
     column_name_dataframe.to_csv(f'{args.folder}/Feature Names.csv')
-    column_name_dataframe.to_excel(f'{args.folder}/Feature Names.xlsx')
+    if args.csv:
+        feature_dataframe.to_csv(f'{args.folder}/Features.csv')
+    if args.xlsx:
+        feature_dataframe.to_excel(f'{args.folder}/Features.xlsx')
+        column_name_dataframe.to_excel(f'{args.folder}/Feature Names.xlsx')
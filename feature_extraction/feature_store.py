@@ -0,0 +1,62 @@
+import json
+import os
+import numpy
+import pandas
+import pyarrow
+import pyarrow.parquet
+
+FEATURES_FILE = 'Features.parquet'
+# Folder of the parts written while the capture is still running, see extract.py --follow
+FEATURE_PARTS_FOLDER = 'Feature Parts'
+# Schema metadata key under which the machine -> human feature name mapping is stored, see pycsca.constants
+FEATURE_NAMES_METADATA_KEY = 'feature_names'
+INT32_MIN, INT32_MAX = numpy.iinfo(numpy.int32).min, numpy.iinfo(numpy.int32).max
+
+
+def get_feature_dtype(column: pandas.Series) -> str:
+    """
+    Determines the narrowest explicit dtype of a feature column.
+    Integer columns stay integers even if some sessions lack the feature, using the nullable integer dtypes.
+    """
+    values = column.dropna()
+    if column.dtype == bool or (len(values) and values.map(type).eq(bool).all()):
+        return 'bool'
+    if not pandas.api.types.is_numeric_dtype(column):
+        return 'category'
+    if len(values) and not (values % 1 == 0).all():
+        return 'float32'
+    if not len(values) or (values.min() >= INT32_MIN and values.max() <= INT32_MAX):
+        return 'Int32'
+    return 'Int64'
+
+
+def get_typed_features(features_dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    dtypes = {column: get_feature_dtype(features_dataframe[column]) for column in features_dataframe.columns}
+    return features_dataframe.astype(dtypes)
+
+
+def write_feature_store(features_dataframe: pandas.DataFrame, column_names_dataframe: pandas.DataFrame,
+                        path: str):
+    """
+    Writes the features as a typed, columnar Parquet file.
+    The mapping of machine-readable to human-readable feature names is stored in the schema metadata, so the file
+    is self-contained and Feature Names.csv is only needed for inspection.
+    """
+    table = pyarrow.Table.from_pandas(get_typed_features(features_dataframe), preserve_index=False)
+    feature_names = [[machine_name, human_name] for machine_name, human_name in column_names_dataframe.values]
+    metadata = dict(table.schema.metadata or {})
+    metadata[FEATURE_NAMES_METADATA_KEY.encode()] = json.dumps(feature_names).encode()
+    pyarrow.parquet.write_table(table.replace_schema_metadata(metadata), path)
+
+
+def write_feature_part(features_dataframe: pandas.DataFrame, column_names_dataframe: pandas.DataFrame,
+                       parts_folder: str, part_index: int):
+    """
+    Appends a part to the feature store of a capture that is still running. The part is renamed into place once it
+    is complete, so readers never see a partially written file.
+    """
+    os.makedirs(parts_folder, exist_ok=True)
+    path = os.path.join(parts_folder, f'part-{part_index:05d}.parquet')
+    write_feature_store(features_dataframe, column_names_dataframe, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
@@ -6,26 +6,26 @@ from pyshark.packet.packet import Packet
 
 
 class IterableCapture:
-    def __init__(self, capture_path: str, slice_size: int = 10000):
+    def __init__(self, capture_path: str, slice_size: int = 10000, shard_index: int = 0, shard_count: int = 1):
         self.capture_path = capture_path
         print(f'Loading {self.capture_path}')
         self.slice_size = slice_size
-        self.next_slice_start = 0
+        # When sharded, only every shard_count-th slice belongs to this capture
+        self.slice_stride = slice_size * shard_count
+        self.next_slice_start = shard_index * slice_size
         self.slice_iterator = None
         self.load_next_slice()
-        self.current_tcp_index = 0
 
     def __iter__(self):
         return self
 
     def __next__(self):
         try:
-            result = (self.current_tcp_index, next(self.slice_iterator))
+            result = next(self.slice_iterator)
         except StopIteration:
             # The slice is exhausted, load the next
             self.load_next_slice()
-            result = (self.current_tcp_index, next(self.slice_iterator))
-        self.current_tcp_index = self.current_tcp_index + 1
+            result = next(self.slice_iterator)
         return result
 
     def load_next_slice(self):
@@ -42,27 +42,179 @@ class IterableCapture:
             print(f'Warning: TShark returned a non-zero returncode and might have crashed. '
                   f'When running docker, this happens because of asyncio and is no cause for concern.')
             slice_capture = [].__iter__()
-        self.next_slice_start = slice_end
-        self.slice_iterator = self.splice_sessions(slice_capture)
+        self.next_slice_start = slice_start + self.slice_stride
+        self.slice_iterator = self.splice_sessions(slice_capture, slice_start)
 
 
-    def splice_sessions(self, packet_capture: Capture):
+    def splice_sessions(self, packet_capture: Capture, slice_start: int):
         """
         Splits a single continuous capture file into the TCP sessions contained in it.
         Non-TCP packets are ignored.
 
         :param packet_capture: The pyshark capture to analyze
-        :return: A list of TCP sessions, each a list of Packets
+        :param slice_start: The first tcp.stream index contained in the capture
+        :return: An iterator of (tcp.stream index, TCP session), each session a list of Packets
         """
         session_list = []
-        current_slice_start = self.next_slice_start - self.slice_size
         for packet in packet_capture:
             if 'TCP' in packet:
-                session_index = int(packet.tcp.stream.get_default_value()) - current_slice_start
+                session_index = int(packet.tcp.stream.get_default_value()) - slice_start
                 if session_index >= len(session_list):
                     # New session, grow the list
                     session_list.append([packet])
                 else:
                     session_list[session_index].append(packet)
         packet_capture.close()
-        return session_list.__iter__()
+        return enumerate(session_list, start=slice_start)
+
+
+class StreamingCapture:
+    def __init__(self, capture_path: str, idle_timeout: float = 60.0, close_timeout: float = 1.0,
+                 progress_interval: int = 10000, shard_index: int = 0, shard_count: int = 1, shard_size: int = 1000):
+        """
+        Reads a capture file exactly once and yields every TCP session as soon as it is complete.
+        A session is complete once it has been closed (FIN or RST) and no further packets arrived for close_timeout
+        seconds of capture time, or once it has been idle for idle_timeout seconds of capture time.
+        Sessions are yielded in ascending tcp.stream order, just like IterableCapture, so memory is bounded by the
+        sessions that are open (or closed but waiting for a lower stream index) at any point of the capture.
+
+        :param capture_path: The pcap file to read
+        :param idle_timeout: Seconds of capture time after which a session without FIN/RST is considered complete
+        :param close_timeout: Seconds of capture time a closed session waits for trailing packets (ACKs, RSTs)
+        :param progress_interval: Print a progress line every time this many sessions have been yielded
+        :param shard_index: Only yield the sessions of this shard, see owns_stream. Every shard still reads the
+            whole capture, so only sharding the cheap raw decoding of RawCapture pays off
+        :param shard_count: The number of shards the sessions are split into
+        :param shard_size: The number of consecutive stream indices assigned to a shard at a time
+        """
+        self.capture_path = capture_path
+        print(f'Loading {self.capture_path}')
+        self.idle_timeout = idle_timeout
+        self.close_timeout = close_timeout
+        self.progress_interval = progress_interval
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_size = shard_size
+        # Sessions that still receive packets, indexed by tcp.stream
+        self.open_sessions: Dict[int, List[Packet]] = {}
+        self.last_seen: Dict[int, float] = {}
+        self.closing_sessions = set()
+        # Complete sessions that wait until every lower stream index has been yielded
+        self.complete_sessions: Dict[int, List[Packet]] = {}
+        self.current_tcp_index = shard_index * shard_size
+        # Packets that arrived after their session was already yielded, e.g. late retransmissions, ACKs or alerts
+        self.dropped_packets = 0
+        self.session_iterator = self.stream_sessions()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.session_iterator)
+
+    def open_capture(self):
+        try:
+            return pyshark.FileCapture(self.capture_path, keep_packets=False, display_filter='tcp')
+        except TSharkCrashException:
+            print(f'Warning: TShark returned a non-zero returncode and might have crashed. '
+                  f'When running docker, this happens because of asyncio and is no cause for concern.')
+            return [].__iter__()
+
+    def owns_stream(self, session_index: int) -> bool:
+        """
+        Stream indices are assigned to the shards in blocks of shard_size, round-robin.
+        """
+        return (session_index // self.shard_size) % self.shard_count == self.shard_index
+
+    @staticmethod
+    def get_stream_index(packet: Packet) -> int:
+        return int(packet.tcp.stream.get_default_value())
+
+    @staticmethod
+    def get_timestamp(packet: Packet) -> float:
+        return float(packet.sniff_timestamp)
+
+    @staticmethod
+    def is_closing(packet: Packet) -> bool:
+        return packet.tcp.get('flags.fin').get_default_value() == "1" \
+            or packet.tcp.get('flags.reset').get_default_value() == "1"
+
+    def stream_sessions(self):
+        packet_capture = self.open_capture()
+        last_sweep = None
+        try:
+            for packet in packet_capture:
+                if 'TCP' not in packet:
+                    continue
+                session_index = self.get_stream_index(packet)
+                timestamp = self.get_timestamp(packet)
+                self.add_packet(session_index, packet, timestamp)
+
+                if last_sweep is None:
+                    last_sweep = timestamp
+                if timestamp - last_sweep >= min(self.close_timeout, self.idle_timeout):
+                    # Only look for complete sessions every now and then, that keeps the per-packet cost constant
+                    last_sweep = timestamp
+                    self.complete_timed_out_sessions(timestamp)
+                    yield from self.pop_ready_sessions()
+        except TSharkCrashException:
+            print(f'Warning: TShark returned a non-zero returncode and might have crashed. '
+                  f'When running docker, this happens because of asyncio and is no cause for concern.')
+        finally:
+            if hasattr(packet_capture, 'close'):
+                packet_capture.close()
+
+        # The capture is exhausted, every remaining session is complete
+        for session_index in list(self.open_sessions):
+            self.complete_session(session_index)
+        yield from self.pop_ready_sessions()
+        if self.dropped_packets:
+            print(f'Warning: {self.dropped_packets} packets arrived after their session was already yielded and '
+                  f'were not extracted, consider a longer close_timeout')
+
+    def add_packet(self, session_index: int, packet: Packet, timestamp: float):
+        if not self.owns_stream(session_index):
+            return
+        if session_index in self.complete_sessions:
+            # A straggler of a complete session that still waits for a lower stream index, it still belongs to it
+            self.complete_sessions[session_index].append(packet)
+            return
+        if session_index < self.current_tcp_index:
+            # A straggler of a session that was already yielded, it can no longer be added
+            self.dropped_packets += 1
+            return
+        self.open_sessions.setdefault(session_index, []).append(packet)
+        self.last_seen[session_index] = timestamp
+        if self.is_closing(packet):
+            self.closing_sessions.add(session_index)
+
+    def complete_timed_out_sessions(self, now: float):
+        for session_index, last_seen in list(self.last_seen.items()):
+            timeout = self.close_timeout if session_index in self.closing_sessions else self.idle_timeout
+            if now - last_seen >= timeout:
+                self.complete_session(session_index)
+
+    def complete_session(self, session_index: int):
+        self.complete_sessions[session_index] = self.open_sessions.pop(session_index)
+        self.last_seen.pop(session_index)
+        self.closing_sessions.discard(session_index)
+
+    def pop_ready_sessions(self):
+        """
+        Yields the complete sessions in ascending stream order, stopping at the first stream index that is still open.
+        """
+        while self.complete_sessions:
+            if self.current_tcp_index not in self.complete_sessions:
+                if self.current_tcp_index in self.open_sessions:
+                    return
+                # This stream index never showed up in the capture or belongs to another shard,
+                # continue with the next known one
+                known_indices = list(self.complete_sessions) + list(self.open_sessions)
+                self.current_tcp_index = min(known_indices)
+                if self.current_tcp_index in self.open_sessions:
+                    return
+            session_index = self.current_tcp_index
+            self.current_tcp_index = self.current_tcp_index + 1
+            if self.current_tcp_index % self.progress_interval == 0:
+                print(f'Processed sessions up to tcp.stream {session_index}, {len(self.open_sessions)} still open')
+            yield session_index, self.complete_sessions.pop(session_index)
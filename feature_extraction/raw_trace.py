@@ -0,0 +1,753 @@
+import ipaddress
+import os
+import struct
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from network_trace import StreamingCapture
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+TCP_FIN = 0x001
+TCP_SYN = 0x002
+TCP_RST = 0x004
+TCP_PSH = 0x008
+TCP_ACK = 0x010
+TCP_URG = 0x020
+TCP_ECE = 0x040
+TCP_CWR = 0x080
+TCP_NS = 0x100
+
+TLS_CHANGE_CIPHER_SPEC = 20
+TLS_ALERT = 21
+TLS_HANDSHAKE = 22
+TLS_CLIENT_HELLO = 1
+TLS_SERVER_HELLO = 2
+TLS_NEW_SESSION_TICKET = 4
+TLS_CERTIFICATE = 11
+TLS_SERVER_KEY_EXCHANGE = 12
+TLS_1_2 = 0x0303
+EC_CURVE_TYPE_NAMED_CURVE = 3
+TLS_CONTENT_TYPES = (20, 21, 22, 23, 24)
+# The tshark fields the raw decoder does not reproduce, besides the ones the feature extraction ignores anyway
+FIELD_DIFFERENCES = 'tcp.completeness (tshark 3.6 and later), the SACK option fields, the reassembly fields ' \
+                    '(tcp.reassembled_in, tcp.segment*), the handshake fields of Certificate Request and Certificate ' \
+                    'Status messages and of all but the first cipher suite, extension and certificate, and handshake ' \
+                    'messages spanning several records. The human-readable names of the TCP header bit fields lack ' \
+                    'the bit notation of tshark'
+TLS_HANDSHAKE_NAMES = {0: 'Hello Request', 1: 'Client Hello', 2: 'Server Hello', 4: 'New Session Ticket',
+                       11: 'Certificate', 12: 'Server Key Exchange', 13: 'Certificate Request',
+                       14: 'Server Hello Done', 15: 'Certificate Verify', 16: 'Client Key Exchange', 20: 'Finished',
+                       22: 'Certificate Status'}
+
+
+class RawField:
+    """
+    A decoded protocol field. Mimics the parts of pyshark's LayerFieldsContainer used by the feature extraction:
+    the value is the string tshark would show, showname_key is the human-readable field name.
+    """
+    __slots__ = ['show', 'showname_key']
+
+    def __init__(self, show: str, showname_key: Optional[str]):
+        self.show = show
+        self.showname_key = showname_key
+
+    def get_default_value(self) -> str:
+        return self.show
+
+
+class RawLayer:
+    """
+    A decoded protocol layer with tshark field names, mimicking the parts of pyshark's Layer used by the feature
+    extraction. Like pyshark, only the first occurrence of a field is kept.
+    """
+
+    def __init__(self, layer_name: str):
+        self.layer_name = layer_name
+        self._all_fields: Dict[str, RawField] = {}
+        self._sanitized_fields: Dict[str, RawField] = {}
+
+    def add_field(self, name: str, show, showname_key: Optional[str]):
+        machine_field_name = f'{self.layer_name}.{name}' if name else self.layer_name
+        if machine_field_name not in self._all_fields:
+            field = RawField(str(show), showname_key)
+            self._all_fields[machine_field_name] = field
+            self._sanitized_fields[name.replace('.', '_').lower()] = field
+
+    def get(self, name: str, default=None) -> Optional[RawField]:
+        field = self._all_fields.get(name)
+        if field is None:
+            field = self._sanitized_fields.get(name.replace('.', '_').lower(), default)
+        return field
+
+    def __getattr__(self, item: str) -> RawField:
+        if item.startswith('_'):
+            raise AttributeError(item)
+        field = self.get(item)
+        if field is None:
+            raise AttributeError(f'No field {item} in layer {self.layer_name}')
+        return field
+
+
+class RawPacket:
+    """
+    A packet decoded from the raw capture bytes, mimicking the parts of pyshark's Packet used by the feature extraction.
+    """
+
+    def __init__(self, sniff_timestamp: float):
+        self.sniff_timestamp = sniff_timestamp
+        self.layers: Dict[str, RawLayer] = {}
+
+    def add_layer(self, layer_name: str) -> RawLayer:
+        layer = RawLayer(layer_name)
+        self.layers.setdefault(layer_name, layer)
+        return self.layers[layer_name]
+
+    def __contains__(self, item: str) -> bool:
+        return item.lower() in self.layers
+
+    def __getattr__(self, item: str) -> RawLayer:
+        if item.startswith('_') or item not in self.layers:
+            raise AttributeError(item)
+        return self.layers[item]
+
+
+class CaptureFileReader:
+    def __init__(self, capture_path: str, follow: bool = False, stop_file: Optional[str] = None,
+                 poll_interval: float = 1.0):
+        """
+        Reads the frames of a pcap or pcapng file without any dissection.
+
+        :param capture_path: The pcap or pcapng file to read
+        :param follow: Tail a capture that is still being written, e.g. by tcpdump -U, like tail -f. Incomplete
+            records at the end of the file are waited for instead of ending the capture
+        :param stop_file: When following, the capture ends at the end of the file once this file exists
+        :param poll_interval: Seconds to wait for more data when following
+        """
+        self.capture_path = capture_path
+        self.follow = follow
+        self.stop_file = stop_file
+        self.poll_interval = poll_interval
+
+    def is_stopped(self) -> bool:
+        return self.stop_file is not None and os.path.exists(self.stop_file)
+
+    def read(self, capture_file, size: int) -> bytes:
+        """
+        Reads size bytes. When following, waits until the writer appended them or the capture is stopped, so a
+        record is never split at the current end of the file.
+        """
+        data = capture_file.read(size)
+        while self.follow and len(data) < size:
+            # Check before reading, so everything written before the stop file appeared is still read
+            stopped = self.is_stopped()
+            more = capture_file.read(size - len(data))
+            data += more
+            if len(data) == size or (stopped and not more):
+                break
+            if not more:
+                time.sleep(self.poll_interval)
+        return data
+
+    def __iter__(self) -> Iterator[Tuple[int, int, bytes]]:
+        """
+        :return: An iterator of (timestamp in nanoseconds, link type, frame bytes). The timestamps are exact integers,
+            so differences of timestamps are exact like tshark's
+        """
+        while self.follow and not os.path.exists(self.capture_path) and not self.is_stopped():
+            time.sleep(self.poll_interval)
+        if not os.path.exists(self.capture_path):
+            return
+        with open(self.capture_path, 'rb') as capture_file:
+            magic = self.read(capture_file, 4)
+            if len(magic) < 4:
+                return
+            if struct.unpack('<I', magic)[0] == PCAPNG_SECTION_HEADER:
+                yield from self.read_pcapng(capture_file, magic)
+            else:
+                yield from self.read_pcap(capture_file, magic)
+
+    def read_pcap(self, capture_file, magic: bytes) -> Iterator[Tuple[int, int, bytes]]:
+        header = magic + self.read(capture_file, 20)
+        if len(header) < 24:
+            return
+        for byte_order in '<>':
+            magic = struct.unpack(f'{byte_order}I', header[:4])[0]
+            if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+                break
+        else:
+            raise ValueError(f'{capture_file.name} is neither a pcap nor a pcapng file')
+        nanoseconds_per_fraction = 1000 if magic == PCAP_MAGIC_MICROSECONDS else 1
+        link_type = struct.unpack(f'{byte_order}I', header[20:24])[0] & 0x0fffffff
+        record_header = struct.Struct(f'{byte_order}IIII')
+        while True:
+            header = self.read(capture_file, 16)
+            if len(header) < 16:
+                return
+            seconds, fraction, captured_length, _ = record_header.unpack(header)
+            data = self.read(capture_file, captured_length)
+            if len(data) < captured_length:
+                return
+            yield seconds * 1000000000 + fraction * nanoseconds_per_fraction, link_type, data
+
+    def read_pcapng(self, capture_file, magic: bytes) -> Iterator[Tuple[int, int, bytes]]:
+        byte_order = '<'
+        interfaces: List[Tuple[int, Tuple[int, int], int]] = []
+        while True:
+            block_header = self.read(capture_file, 8 - len(magic))
+            block_header, magic = magic + block_header, b''
+            if len(block_header) < 8:
+                return
+            block_type = struct.unpack('<I', block_header[:4])[0]
+            if block_type == PCAPNG_SECTION_HEADER:
+                # A new section may switch the byte order and always resets the interfaces
+                byte_order_magic = self.read(capture_file, 4)
+                if len(byte_order_magic) < 4:
+                    return
+                byte_order = '<' if struct.unpack('<I', byte_order_magic)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                block_length = struct.unpack(f'{byte_order}I', block_header[4:])[0]
+                body = byte_order_magic + self.read(capture_file, block_length - 12)
+                interfaces = []
+            else:
+                block_length = struct.unpack(f'{byte_order}I', block_header[4:])[0]
+                body = self.read(capture_file, block_length - 8)
+            if len(body) < block_length - 8:
+                return
+            body = body[:-4]
+
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                link_type, _, snap_length = struct.unpack(f'{byte_order}HHI', body[:8])
+                interfaces.append((link_type, CaptureFileReader.pcapng_resolution(body[8:], byte_order),
+                                   snap_length))
+            elif block_type == PCAPNG_ENHANCED_PACKET:
+                interface_id, high, low, captured_length, _ = struct.unpack(f'{byte_order}IIIII', body[:20])
+                link_type, (multiplier, divisor), _ = interfaces[interface_id]
+                yield ((high << 32) | low) * multiplier // divisor, link_type, body[20:20 + captured_length]
+            elif block_type == PCAPNG_PACKET:
+                interface_id, _, high, low, captured_length, _ = struct.unpack(f'{byte_order}HHIIII', body[:20])
+                link_type, (multiplier, divisor), _ = interfaces[interface_id]
+                yield ((high << 32) | low) * multiplier // divisor, link_type, body[20:20 + captured_length]
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                # Simple packet blocks carry no timestamp
+                original_length = struct.unpack(f'{byte_order}I', body[:4])[0]
+                link_type, _, snap_length = interfaces[0]
+                captured_length = min(original_length, snap_length) if snap_length else original_length
+                yield 0, link_type, body[4:4 + captured_length]
+
+    @staticmethod
+    def pcapng_resolution(options: bytes, byte_order: str) -> Tuple[int, int]:
+        """
+        :return: The timestamp unit of an interface as the fraction (multiplier, divisor) of nanoseconds
+        """
+        offset = 0
+        while offset + 4 <= len(options):
+            code, length = struct.unpack(f'{byte_order}HH', options[offset:offset + 4])
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = options[offset + 4]
+                if value & 0x80:
+                    return 1000000000, 2 ** (value & 0x7f)
+                return (10 ** (9 - value), 1) if value <= 9 else (1, 10 ** (value - 9))
+            offset += 4 + ((length + 3) & ~3)
+        return 1000, 1
+
+
+class TcpDirection:
+    __slots__ = ['base_seq', 'next_seq', 'buffer', 'window_shift', 'syn_seen', 'encrypted', 'tls_version']
+
+    def __init__(self):
+        self.base_seq: Optional[int] = None
+        self.next_seq: Optional[int] = None
+        self.buffer = b''
+        self.window_shift: Optional[int] = None
+        self.syn_seen = False
+        self.encrypted = False
+        # The version of the Server Hello sent in this direction, it determines the layout of the Server Key Exchange
+        self.tls_version: Optional[int] = None
+
+
+class TcpStream:
+    __slots__ = ['index', 'client', 'directions', 'last_timestamp', 'closed']
+
+    def __init__(self, index: int, client: Tuple[str, int]):
+        self.index = index
+        self.client = client
+        self.directions: Optional[Dict[bool, TcpDirection]] = {True: TcpDirection(), False: TcpDirection()}
+        self.last_timestamp: Optional[int] = None
+        self.closed = False
+
+
+class RawPacketDecoder:
+    def __init__(self, capture_path: str, owns_stream: Optional[Callable[[int], bool]] = None, follow: bool = False,
+                 stop_file: Optional[str] = None, stream_timeout: Optional[float] = None):
+        """
+        Decodes the TCP and TLS record layers of every frame in a pcap or pcapng file straight from the bytes,
+        without a tshark process. Field names and values follow tshark, so the packets can be used in place of
+        pyshark packets by the feature extraction. Only the fields of TCP headers (including the timestamp, MSS and
+        window scale options) and TLS record, handshake and alert headers are decoded; tshark's expert analysis
+        fields are not reproduced, see FIELD_DIFFERENCES.
+
+        :param capture_path: The pcap or pcapng file to decode
+        :param owns_stream: Only decode the packets of the TCP streams whose index this function accepts
+        :param follow: Tail a capture that is still being written, see CaptureFileReader
+        :param stop_file: When following, the capture ends once this file exists
+        :param stream_timeout: Seconds of capture time after the last packet of a stream when its state is dropped.
+            A later packet of the same addresses and ports starts a new stream, unlike in tshark, which keeps the state
+            of every stream until the end of the capture. None keeps every stream like tshark
+        """
+        self.capture_reader = CaptureFileReader(capture_path, follow=follow, stop_file=stop_file)
+        self.owns_stream = owns_stream
+        self.stream_timeout = None if stream_timeout is None else int(stream_timeout * 1000000000)
+        self.streams: Dict[Tuple, TcpStream] = {}
+        self.stream_keys: Dict[int, Tuple] = {}
+        self.stream_count = 0
+
+    def __iter__(self) -> Iterator[RawPacket]:
+        last_purge = None
+        for timestamp, link_type, frame in self.capture_reader:
+            packet = self.decode_frame(timestamp, link_type, frame)
+            if packet is not None:
+                yield packet
+            if self.stream_timeout is not None:
+                if last_purge is None:
+                    last_purge = timestamp
+                if timestamp - last_purge >= self.stream_timeout:
+                    # Only look for timed out streams every now and then, that keeps the per-packet cost constant
+                    last_purge = timestamp
+                    self.purge_streams(timestamp - self.stream_timeout)
+
+    def purge_streams(self, oldest_timestamp: int):
+        """
+        Drops the state of every stream without packets since oldest_timestamp.
+        """
+        for key, stream in list(self.streams.items()):
+            if stream.last_timestamp < oldest_timestamp:
+                del self.streams[key]
+                del self.stream_keys[stream.index]
+
+    def release_stream(self, index: int):
+        """
+        Drops the reassembly buffers of a stream whose session was yielded. The stream keeps its index until it times
+        out, so stragglers are still attributed to it.
+        """
+        key = self.stream_keys.get(index)
+        if key is not None:
+            self.streams[key].directions = None
+
+    def decode_frame(self, timestamp: int, link_type: int, frame: bytes) -> Optional[RawPacket]:
+        network = self.decode_link_layer(link_type, frame)
+        if network is None:
+            return None
+        ethertype, offset = network
+        if ethertype == ETHERTYPE_IPV4:
+            decoded = self.decode_ipv4(frame, offset)
+        elif ethertype == ETHERTYPE_IPV6:
+            decoded = self.decode_ipv6(frame, offset)
+        else:
+            return None
+        if decoded is None:
+            return None
+        layer_name, source, destination, segment = decoded
+        if len(segment) < 20:
+            return None
+
+        packet = RawPacket(timestamp / 1000000000)
+        ip_layer = packet.add_layer(layer_name)
+        ip_layer.add_field('src', source, 'Source Address')
+        ip_layer.add_field('dst', destination, 'Destination Address')
+        sender, data = self.decode_tcp(packet, timestamp, source, destination, segment)
+        if 'tcp' not in packet:
+            return None
+        if data is not None:
+            self.decode_tls(packet, sender, data)
+        return packet
+
+    @staticmethod
+    def decode_link_layer(link_type: int, frame: bytes) -> Optional[Tuple[int, int]]:
+        if link_type == LINKTYPE_ETHERNET:
+            if len(frame) < 14:
+                return None
+            ethertype = struct.unpack('!H', frame[12:14])[0]
+            offset = 14
+            while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 4:
+                ethertype = struct.unpack('!H', frame[offset + 2:offset + 4])[0]
+                offset += 4
+            return ethertype, offset
+        if link_type == LINKTYPE_LINUX_SLL:
+            return (struct.unpack('!H', frame[14:16])[0], 16) if len(frame) >= 16 else None
+        if link_type == LINKTYPE_LINUX_SLL2:
+            return (struct.unpack('!H', frame[0:2])[0], 20) if len(frame) >= 20 else None
+        if link_type == LINKTYPE_NULL:
+            if len(frame) < 4:
+                return None
+            family = struct.unpack('=I', frame[:4])[0]
+            if family > 0xffff:
+                family = struct.unpack('>I', frame[:4])[0] if frame[0] == 0 else struct.unpack('<I', frame[:4])[0]
+            return (ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6), 4
+        if link_type in LINKTYPE_RAW or link_type in (LINKTYPE_IPV4, LINKTYPE_IPV6):
+            if len(frame) < 1:
+                return None
+            return (ETHERTYPE_IPV4 if frame[0] >> 4 == 4 else ETHERTYPE_IPV6), 0
+        return None
+
+    @staticmethod
+    def decode_ipv4(frame: bytes, offset: int) -> Optional[Tuple[str, str, str, bytes]]:
+        if len(frame) < offset + 20:
+            return None
+        header_length = (frame[offset] & 0x0f) * 4
+        total_length, = struct.unpack('!H', frame[offset + 2:offset + 4])
+        fragment, = struct.unpack('!H', frame[offset + 6:offset + 8])
+        if frame[offset + 9] != 6 or fragment & 0x3fff:
+            # Not TCP, or a fragment we would need to reassemble
+            return None
+        source = str(ipaddress.IPv4Address(frame[offset + 12:offset + 16]))
+        destination = str(ipaddress.IPv4Address(frame[offset + 16:offset + 20]))
+        return 'ip', source, destination, frame[offset + header_length:offset + total_length]
+
+    @staticmethod
+    def decode_ipv6(frame: bytes, offset: int) -> Optional[Tuple[str, str, str, bytes]]:
+        if len(frame) < offset + 40:
+            return None
+        payload_length, next_header = struct.unpack('!HB', frame[offset + 4:offset + 7])
+        source = str(ipaddress.IPv6Address(frame[offset + 8:offset + 24]))
+        destination = str(ipaddress.IPv6Address(frame[offset + 24:offset + 40]))
+        end = offset + 40 + payload_length
+        offset += 40
+        # Skip hop-by-hop, routing and destination options extension headers
+        while next_header in (0, 43, 60) and len(frame) >= offset + 2:
+            next_header, length = frame[offset], (frame[offset + 1] + 1) * 8
+            offset += length
+        if next_header != 6:
+            return None
+        return 'ipv6', source, destination, frame[offset:end]
+
+    def get_stream(self, source: Tuple[str, int], destination: Tuple[str, int], flags: int) -> TcpStream:
+        key = (source, destination) if source < destination else (destination, source)
+        stream = self.streams.get(key)
+        if stream is None or (flags & TCP_SYN and not flags & TCP_ACK and stream.closed):
+            # A new connection, or a new connection reusing the ports of a closed one
+            if stream is not None:
+                del self.stream_keys[stream.index]
+            stream = TcpStream(self.stream_count, source if flags & TCP_SYN and not flags & TCP_ACK else destination)
+            self.stream_count += 1
+            self.streams[key] = stream
+            self.stream_keys[stream.index] = key
+        return stream
+
+    def decode_tcp(self, packet: RawPacket, timestamp: int, source_ip: str, destination_ip: str,
+                   segment: bytes) -> Tuple[TcpDirection, Optional[bytes]]:
+        source_port, destination_port, seq, ack, offset_flags, window, checksum, urgent_pointer = \
+            struct.unpack('!HHIIHHHH', segment[:20])
+        header_length = (offset_flags >> 12) * 4
+        flags = offset_flags & 0x1ff
+        payload = segment[header_length:]
+        stream = self.get_stream((source_ip, source_port), (destination_ip, destination_port), flags)
+        previous_timestamp = stream.last_timestamp
+        stream.last_timestamp = timestamp
+        if flags & (TCP_FIN | TCP_RST):
+            stream.closed = True
+        if self.owns_stream is not None and not self.owns_stream(stream.index):
+            # Only keep track of the stream indices, the packet belongs to another shard
+            return None, None
+        if stream.directions is None:
+            # A straggler of a released stream, its session was already yielded and the packet is discarded by the
+            # capture, so the relative sequence numbers of the fresh state do not matter
+            stream.directions = {True: TcpDirection(), False: TcpDirection()}
+        from_client = stream.client == (source_ip, source_port)
+        sender, receiver = stream.directions[from_client], stream.directions[not from_client]
+        options = self.decode_tcp_options(segment[20:header_length])
+
+        if flags & TCP_SYN:
+            sender.syn_seen = True
+            sender.window_shift = options['options.wscale.shift'][0] if 'options.wscale.shift' in options else None
+        if sender.base_seq is None:
+            sender.base_seq = seq if flags & TCP_SYN else (seq - 1) & 0xffffffff
+        if receiver.base_seq is None and flags & TCP_ACK:
+            receiver.base_seq = (ack - 1) & 0xffffffff
+        segment_length = len(payload)
+        relative_seq = (seq - sender.base_seq) & 0xffffffff
+        time_delta = 0 if previous_timestamp is None else timestamp - previous_timestamp
+
+        tcp = packet.add_layer('tcp')
+        tcp.add_field('srcport', source_port, 'Source Port')
+        tcp.add_field('dstport', destination_port, 'Destination Port')
+        tcp.add_field('port', source_port, 'Source or Destination Port')
+        tcp.add_field('stream', stream.index, 'Stream index')
+        tcp.add_field('len', segment_length, 'TCP Segment Len')
+        tcp.add_field('seq', relative_seq, 'Sequence Number')
+        tcp.add_field('seq_raw', seq, 'Sequence Number (raw)')
+        # Like tshark, SYN and FIN only count towards the next sequence number of segments that carry data
+        next_seq = relative_seq + segment_length + (1 if flags & (TCP_SYN | TCP_FIN) and segment_length else 0)
+        tcp.add_field('nxtseq', next_seq, 'Next Sequence Number')
+        if flags & TCP_ACK:
+            tcp.add_field('ack', (ack - receiver.base_seq) & 0xffffffff, 'Acknowledgment Number')
+            tcp.add_field('ack_raw', ack, 'Acknowledgment number (raw)')
+        tcp.add_field('hdr_len', header_length, 'Header Length')
+        tcp.add_field('flags', f'0x{flags:03x}', 'Flags')
+        tcp.add_field('flags.res', (offset_flags >> 9) & 0x7, 'Reserved')
+        for name, flag, human_name in [('ns', TCP_NS, 'Nonce'), ('cwr', TCP_CWR, 'Congestion Window Reduced (CWR)'),
+                                       ('ecn', TCP_ECE, 'ECN-Echo'), ('urg', TCP_URG, 'Urgent'),
+                                       ('ack', TCP_ACK, 'Acknowledgment'), ('push', TCP_PSH, 'Push'),
+                                       ('reset', TCP_RST, 'Reset'), ('syn', TCP_SYN, 'Syn'), ('fin', TCP_FIN, 'Fin')]:
+            tcp.add_field(f'flags.{name}', 1 if flags & flag else 0, human_name)
+        tcp.add_field('window_size_value', window, 'Window size value')
+        if flags & TCP_SYN:
+            tcp.add_field('window_size', window, 'Calculated window size')
+        else:
+            if not (sender.syn_seen and receiver.syn_seen):
+                scale_factor = -1
+            elif sender.window_shift is None or receiver.window_shift is None:
+                scale_factor = -2
+            else:
+                scale_factor = 2 ** min(sender.window_shift, 14)
+            tcp.add_field('window_size', window * scale_factor if scale_factor > 0 else window,
+                          'Calculated window size')
+            tcp.add_field('window_size_scalefactor', scale_factor, 'Window size scaling factor')
+        tcp.add_field('checksum', f'0x{checksum:04x}', 'Checksum')
+        # tshark does not validate checksums by default, its status is always 2 (Unverified)
+        tcp.add_field('checksum.status', 2, 'Checksum Status')
+        tcp.add_field('urgent_pointer', urgent_pointer, 'Urgent Pointer')
+        if header_length > 20:
+            tcp.add_field('options', ':'.join(f'{byte:02x}' for byte in segment[20:header_length]), 'Options')
+        for name, (value, human_name) in options.items():
+            tcp.add_field(name, value, human_name)
+        tcp.add_field('time_delta', f'{"-" if time_delta < 0 else ""}{abs(time_delta) // 1000000000}.'
+                                    f'{abs(time_delta) % 1000000000:09d}',
+                      'Time since previous frame in this TCP stream')
+
+        return sender, self.reassemble(sender, seq, payload, flags)
+
+    @staticmethod
+    def decode_tcp_options(options: bytes) -> Dict[str, Tuple[int, Optional[str]]]:
+        decoded = {}
+        offset = 0
+        while offset < len(options):
+            kind = options[offset]
+            if kind in (0, 1):
+                # tshark shows the byte of these single-byte options as the value, without a human-readable name
+                decoded.setdefault('options.eol' if kind == 0 else 'options.nop', (f'{kind:02x}', None))
+                decoded.setdefault('option_kind', (kind, 'Kind'))
+                if kind == 0:
+                    break
+                offset += 1
+                continue
+            decoded.setdefault('option_kind', (kind, 'Kind'))
+            if offset + 1 >= len(options) or options[offset + 1] < 2:
+                break
+            length = options[offset + 1]
+            value = options[offset + 2:offset + length]
+            decoded.setdefault('option_len', (length, 'Length'))
+            if kind == 2 and len(value) == 2:
+                decoded['options.mss_val'] = (struct.unpack('!H', value)[0], 'MSS Value')
+            elif kind == 3 and len(value) == 1:
+                decoded['options.wscale.shift'] = (value[0], 'Shift count')
+                decoded['options.wscale.multiplier'] = (2 ** min(value[0], 14), 'Multiplier')
+            elif kind == 8 and len(value) == 8:
+                tsval, tsecr = struct.unpack('!II', value)
+                decoded['options.timestamp.tsval'] = (tsval, 'Timestamp value')
+                decoded['options.timestamp.tsecr'] = (tsecr, 'Timestamp echo reply')
+            offset += length
+        return decoded
+
+    @staticmethod
+    def reassemble(direction: TcpDirection, seq: int, payload: bytes, flags: int) -> Optional[bytes]:
+        """
+        Appends the payload to the byte stream of its direction, dropping retransmitted bytes and resetting on gaps.
+
+        :return: The buffered bytes of the direction that are not yet consumed by TLS records, None if nothing is new
+        """
+        if flags & TCP_SYN:
+            direction.next_seq = (seq + 1) & 0xffffffff
+        if not payload:
+            return None
+        if direction.next_seq is not None:
+            difference = (seq - direction.next_seq) & 0xffffffff
+            if difference >= 0x80000000:
+                # Retransmission of data we already have, only keep the part that is new
+                overlap = 0x100000000 - difference
+                if overlap >= len(payload):
+                    return None
+                payload = payload[overlap:]
+                seq = direction.next_seq
+            elif difference > 0:
+                # Missing segments, the buffered record can never be completed
+                direction.buffer = b''
+        direction.next_seq = (seq + len(payload)) & 0xffffffff
+        return direction.buffer + payload
+
+    def decode_tls(self, packet: RawPacket, direction: TcpDirection, data: bytes):
+        """
+        Decodes every complete TLS record in the byte stream of a direction. Like tshark, records spanning several
+        segments are attributed to the segment that completes them.
+        """
+        offset = 0
+        tls = None
+        while offset + 5 <= len(data):
+            content_type = data[offset]
+            if content_type not in TLS_CONTENT_TYPES or data[offset + 1] != 3:
+                # Not TLS, or we lost track of the record boundaries
+                direction.buffer = b''
+                return
+            length, = struct.unpack('!H', data[offset + 3:offset + 5])
+            if offset + 5 + length > len(data):
+                break
+            if tls is None:
+                tls = packet.add_layer('tls')
+            version, = struct.unpack('!H', data[offset + 1:offset + 3])
+            self.decode_tls_record(tls, direction, content_type, version, data[offset + 5:offset + 5 + length])
+            offset += 5 + length
+        direction.buffer = data[offset:]
+
+    @staticmethod
+    def decode_tls_record(tls: RawLayer, direction: TcpDirection, content_type: int, version: int, fragment: bytes):
+        tls.add_field('record.content_type', content_type, 'Content Type')
+        tls.add_field('record.version', f'0x{version:04x}', 'Version')
+        tls.add_field('record.length', len(fragment), 'Length')
+        if content_type == TLS_CHANGE_CIPHER_SPEC:
+            tls.add_field('change_cipher_spec', 'Change Cipher Spec Message', 'Change Cipher Spec Message')
+            direction.encrypted = True
+        elif content_type == TLS_ALERT:
+            if direction.encrypted or len(fragment) != 2:
+                tls.add_field('alert_message', 'Encrypted Alert', 'Alert Message')
+            else:
+                tls.add_field('alert_message', 'Alert Message', 'Alert Message')
+                tls.add_field('alert_message.level', fragment[0], 'Level')
+                tls.add_field('alert_message.desc', fragment[1], 'Description')
+        elif content_type == TLS_HANDSHAKE:
+            if direction.encrypted:
+                tls.add_field('handshake', 'Handshake Protocol: Encrypted Handshake Message', 'Handshake Protocol')
+                return
+            offset = 0
+            while offset + 4 <= len(fragment):
+                handshake_type = fragment[offset]
+                length = struct.unpack('!I', b'\x00' + fragment[offset + 1:offset + 4])[0]
+                name = TLS_HANDSHAKE_NAMES.get(handshake_type, f'Unknown ({handshake_type})')
+                tls.add_field('handshake', f'Handshake Protocol: {name}', 'Handshake Protocol')
+                tls.add_field('handshake.type', handshake_type, 'Handshake Type')
+                tls.add_field('handshake.length', length, 'Length')
+                try:
+                    RawPacketDecoder.decode_handshake(tls, direction, handshake_type,
+                                                      fragment[offset + 4:offset + 4 + length])
+                except (IndexError, struct.error):
+                    # The message continues in the next record, tshark would reassemble it
+                    pass
+                offset += 4 + length
+
+    @staticmethod
+    def decode_handshake(tls: RawLayer, direction: TcpDirection, handshake_type: int, body: bytes):
+        """
+        Decodes the fields of the unencrypted handshake messages, only the first occurrence of repeated fields like the
+        cipher suites, extensions or certificates. Raises an IndexError or struct.error for truncated messages.
+        """
+        if handshake_type in (TLS_CLIENT_HELLO, TLS_SERVER_HELLO):
+            version, = struct.unpack('!H', body[0:2])
+            if len(body) < 35:
+                raise IndexError(handshake_type)
+            tls.add_field('handshake.version', f'0x{version:04x}', 'Version')
+            tls.add_field('handshake.random', ':'.join(f'{byte:02x}' for byte in body[2:34]), 'Random')
+            session_id_length = body[34]
+            tls.add_field('handshake.session_id_length', session_id_length, 'Session ID Length')
+            if session_id_length:
+                session_id = body[35:35 + session_id_length]
+                tls.add_field('handshake.session_id', ':'.join(f'{byte:02x}' for byte in session_id), 'Session ID')
+            offset = 35 + session_id_length
+            if handshake_type == TLS_CLIENT_HELLO:
+                cipher_suites_length, cipher_suite = struct.unpack('!HH', body[offset:offset + 4])
+                tls.add_field('handshake.cipher_suites_length', cipher_suites_length, 'Cipher Suites Length')
+                tls.add_field('handshake.ciphersuite', f'0x{cipher_suite:04x}', 'Cipher Suite')
+                offset += 2 + cipher_suites_length
+                tls.add_field('handshake.comp_methods_length', body[offset], 'Compression Methods Length')
+                tls.add_field('handshake.comp_method', body[offset + 1], 'Compression Method')
+                offset += 1 + body[offset]
+            else:
+                direction.tls_version = version
+                cipher_suite, = struct.unpack('!H', body[offset:offset + 2])
+                tls.add_field('handshake.ciphersuite', f'0x{cipher_suite:04x}', 'Cipher Suite')
+                tls.add_field('handshake.comp_method', body[offset + 2], 'Compression Method')
+                offset += 3
+            if offset < len(body):
+                extensions_length, = struct.unpack('!H', body[offset:offset + 2])
+                tls.add_field('handshake.extensions_length', extensions_length, 'Extensions Length')
+                if extensions_length:
+                    extension_type, extension_length = struct.unpack('!HH', body[offset + 2:offset + 6])
+                    tls.add_field('handshake.extension.type', extension_type, 'Type')
+                    tls.add_field('handshake.extension.len', extension_length, 'Length')
+        elif handshake_type == TLS_CERTIFICATE:
+            certificates_length, = struct.unpack('!I', b'\x00' + body[0:3])
+            tls.add_field('handshake.certificates_length', certificates_length, 'Certificates Length')
+            if certificates_length:
+                certificate_length, = struct.unpack('!I', b'\x00' + body[3:6])
+                tls.add_field('handshake.certificate_length', certificate_length, 'Certificate Length')
+        elif handshake_type == TLS_SERVER_KEY_EXCHANGE:
+            # The layout depends on the negotiated cipher suite, without a table of cipher suites an ECDHE exchange is
+            # recognized by its named curve and everything else decoded as DHE
+            if body[0] == EC_CURVE_TYPE_NAMED_CURVE:
+                named_curve, point_length = struct.unpack('!HB', body[1:4])
+                tls.add_field('handshake.server_curve_type', f'0x{body[0]:02x}', 'Curve Type')
+                tls.add_field('handshake.server_named_curve', f'0x{named_curve:04x}', 'Named Curve')
+                tls.add_field('handshake.server_point_len', point_length, 'Pubkey Length')
+                offset = 4 + point_length
+            else:
+                offset = 0
+                for name, human_name in [('p_len', 'p Length'), ('g_len', 'g Length'), ('ys_len', 'Pubkey Length')]:
+                    parameter_length, = struct.unpack('!H', body[offset:offset + 2])
+                    tls.add_field(f'handshake.{name}', parameter_length, human_name)
+                    offset += 2 + parameter_length
+            if direction.tls_version == TLS_1_2:
+                signature_algorithm, = struct.unpack('!H', body[offset:offset + 2])
+                tls.add_field('handshake.sig_hash_alg', f'0x{signature_algorithm:04x}', 'Signature Algorithm')
+                tls.add_field('handshake.sig_hash_hash', signature_algorithm >> 8, 'Signature Hash Algorithm Hash')
+                tls.add_field('handshake.sig_hash_sig', signature_algorithm & 0xff,
+                              'Signature Hash Algorithm Signature')
+                offset += 2
+            signature_length, = struct.unpack('!H', body[offset:offset + 2])
+            tls.add_field('handshake.sig_len', signature_length, 'Signature Length')
+        elif handshake_type == TLS_NEW_SESSION_TICKET:
+            lifetime_hint, ticket_length = struct.unpack('!IH', body[0:6])
+            tls.add_field('handshake.session_ticket_lifetime_hint', lifetime_hint, 'Session Ticket Lifetime Hint')
+            tls.add_field('handshake.session_ticket_length', ticket_length, 'Session Ticket Length')
+
+
+class RawCapture(StreamingCapture):
+    def __init__(self, capture_path: str, follow: bool = False, stop_file: Optional[str] = None, **kwargs):
+        """
+        Single-pass session splitter on top of RawPacketDecoder, a drop-in replacement for the pyshark based
+        StreamingCapture that needs no tshark process. Unlike tshark, it can also follow a capture that is still
+        being written, yielding the sessions while the handshakes are being recorded.
+        The decoder releases the state of a stream once its session is yielded and drops it entirely after twice the
+        idle timeout without packets, so memory stays bounded for arbitrarily long captures.
+        """
+        self.follow = follow
+        self.stop_file = stop_file
+        self.decoder: Optional[RawPacketDecoder] = None
+        super().__init__(capture_path, **kwargs)
+
+    def open_capture(self):
+        self.decoder = RawPacketDecoder(self.capture_path, owns_stream=self.owns_stream, follow=self.follow,
+                                        stop_file=self.stop_file, stream_timeout=2 * self.idle_timeout)
+        return self.decoder
+
+    def pop_ready_sessions(self):
+        for session_index, session in super().pop_ready_sessions():
+            self.decoder.release_stream(session_index)
+            yield session_index, session
@@ -20,6 +20,8 @@ CLIENT_ARGUMENTS=""
 SERVER_ARGUMENTS=""
 DOCKER_ARGUMENTS=""
 DATASET_FOLDER=""
+STREAMING=0
+LEAN=0
 
 set -e
 
@@ -61,6 +63,10 @@ while [ "$1" != "" ]; do
                                 ;;
         --alltests )            ALL_TESTS=1
                                 ;;
+        --streaming )           STREAMING=1
+                                ;;
+        --lean )                LEAN=1
+                                ;;
         --clientarguments )     shift
                                 CLIENT_ARGUMENTS=$1
                                 ;;
@@ -175,6 +181,15 @@ echo "On interface $SUT_INTERFACE" >> "$CONFIG"
 tcpdump host "$CAPTURE_HOST" -U -w "$FOLDER/Packets.pcap" -i $SUT_INTERFACE &
 TCPDUMP_PID=$!
 
+if [ "$STREAMING" = "1" ]; then
+    echo "Starting streaming feature extraction and interim evaluation while capturing"
+    rm -f "$FOLDER/Capture Done"
+    pipenv run python3 "$TOOL_FOLDER/feature_extraction/extract.py" --folder="$FOLDER" --follow 2>&1 | tee "$FOLDER/Feature Extraction.log" &
+    EXTRACTION_PID=$!
+    pipenv run python3 "$TOOL_FOLDER/classification_model/interim_evaluation.py" --folder="$FOLDER" --n_jobs=$PARALLEL_THREADS 2>&1 | tee "$FOLDER/Interim Evaluation.log" &
+    INTERIM_PID=$!
+fi
+
 if [ "$LATENCY" ]; then
     echo "Adding an artificial latency of $LATENCY to the interface $SUT_INTERFACE"
     tc qdisc replace dev $SUT_INTERFACE root netem delay "$LATENCY"
@@ -232,13 +247,24 @@ echo "Starting feature extraction"
 echo " " >> "$CONFIG"
 echo "# Feature Extraction" >> "$CONFIG"
 START_TIME=$(date +%s)
-pipenv run python3 feature_extraction/extract.py --folder="$FOLDER" 2>&1 | tee "$FOLDER/Feature Extraction.log"
+if [ "$STREAMING" = "1" ]; then
+    # The streaming extraction reads the rest of the capture and writes the final feature store
+    touch "$FOLDER/Capture Done"
+    wait $EXTRACTION_PID
+else
+    pipenv run python3 feature_extraction/extract.py --folder="$FOLDER" 2>&1 | tee "$FOLDER/Feature Extraction.log"
+fi
 END_TIME=$(date +%s)
 DURATION="$(($END_TIME-$START_TIME))"
 echo "Finished feature extraction, execution took $DURATION seconds"
 echo "## Execution Time" >> "$CONFIG"
 echo "$DURATION seconds" >> "$CONFIG"
 
+if [ "$STREAMING" = "1" ]; then
+    echo "Waiting for the final interim evaluation"
+    wait $INTERIM_PID
+fi
+
 echo "Starting classification model training"
 echo " " >> "$CONFIG"
 echo "# Machine Learning" >> "$CONFIG"
@@ -247,8 +273,15 @@ echo "Using $CROSSVALIDATION_TECHNIQUE crossvalidation technique" >> "$CONFIG"
 echo "Doing $CROSSVALIDATION_ITERATIONS crossvalidation iterations" >> "$CONFIG"
 echo "Doing $HYPERPARAMETER_ITERATIONS hyperparameter optimization iterations" >> "$CONFIG"
 
+if [ "$LEAN" = "1" ]; then
+    echo "Deferring the final models to the plots" >> "$CONFIG"
+    LEAN_ARGUMENT="--lean"
+else
+    LEAN_ARGUMENT=""
+fi
+
 START_TIME=$(date +%s)
-pipenv run python3 classification_model/train_models.py --folder="$FOLDER" --cv_technique=$CROSSVALIDATION_TECHNIQUE --cv_iterations=$CROSSVALIDATION_ITERATIONS --iterations=$HYPERPARAMETER_ITERATIONS --n_jobs=$PARALLEL_THREADS 2>&1 | tee "$FOLDER/Classification Model Training.log"
+pipenv run python3 classification_model/train_models.py --folder="$FOLDER" --cv_technique=$CROSSVALIDATION_TECHNIQUE --cv_iterations=$CROSSVALIDATION_ITERATIONS --iterations=$HYPERPARAMETER_ITERATIONS --n_jobs=$PARALLEL_THREADS $LEAN_ARGUMENT 2>&1 | tee "$FOLDER/Classification Model Training.log"
 END_TIME=$(date +%s)
 DURATION="$(($END_TIME-$START_TIME))"
 echo "Finished classification model training, execution took $DURATION seconds"
@@ -259,6 +292,11 @@ echo "$DURATION seconds" >> "$CONFIG"
 echo "Generating report"
 pipenv run python3 classification_model/pvalues_calculation.py --folder="$FOLDER" 2>&1 | tee "$FOLDER/Report Generation.log"
 
+if [ "$LEAN" = "1" ]; then
+    echo "Fitting the final models of the vulnerable labels"
+    pipenv run python3 classification_model/fit_models.py --folder="$FOLDER" --n_jobs=$PARALLEL_THREADS 2>&1 | tee "$FOLDER/Final Model Fitting.log"
+fi
+
 echo "Plotting the machine learning results"
 pipenv run python3 classification_model/plot_results.py --folder="$FOLDER" 2>&1 | tee "$FOLDER/Classification Model Plotting.log"
 echo "Finished plotting"
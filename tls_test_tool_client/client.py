@@ -1,13 +1,28 @@
-import multiprocessing
-from os import cpu_count
+import asyncio
+import os
 import random
-import subprocess
 import time
-from random import choice
+from collections import Counter
+from datetime import datetime
 
 import pandas
 
 import argparse
+import csv
+
+CONFIG_FOLDER = './tls_test_tool_client/config'
+BUNDLE_FOLDER = 'Client Configurations'
+# Written by classification_model/interim_evaluation.py while the streaming feature extraction is running
+INTERIM_RESULTS_FILE = 'Intermediate Results/Interim Results.csv'
+INTERIM_TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+CORRECT_CASE = 'Correctly_formatted_PKCS#1_PMS_message'
+LABEL_COLUMNS = ['client_hello_random', 'label', 'skipped_ccs_fin']
+ALL_TEST_CASES = ['Correctly_formatted_PKCS#1_PMS_message',
+                  'Wrong_separator_(0x00_set_to_0x17)',
+                  'Invalid_TLS_version_in_PMS',
+                  'Wrong_first_byte_(0x00_set_to_0x17)',
+                  'Wrong_second_byte_(0x02_set_to_0x17)',
+                  'Wrong_separator_position_(44)']
 
 
 def determine_client_hello_random(log: str) -> str:
@@ -17,73 +32,309 @@ def determine_client_hello_random(log: str) -> str:
     raise AssertionError('There was no Client Hello randomness in the log of a client, aborting')
 
 
-def run_single_session(request_index: int, sut_name: str, use_sentinel: bool, wait_time: float, enable_skip_ccs_fin: bool, enable_noskip_ccs_fin: bool, twoclass: bool, oneclass: bool) -> (str, str, bool):
-    config_files = ['./tls_test_tool_client/config/base.conf',
-                    f'./tls_test_tool_client/config/{sut_name}.conf']
-    if enable_skip_ccs_fin:
-        if enable_noskip_ccs_fin:
-            # Coin flip
-            skip_ccs_fin = bool(random.randint(0, 1))
-        else:
-            skip_ccs_fin = True
-    else:
-        if enable_noskip_ccs_fin:
-            skip_ccs_fin = False
-        else:
-            print('At least one of --skip or --noskip must be selected')
-            skip_ccs_fin = False
-            exit(1)
+class TokenBucket:
+    """
+    Limits the rate at which handshakes are started. Up to burst handshakes can start at once, afterwards the bucket
+    refills with rate tokens per second. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # Holding the lock while sleeping hands out the tokens in the order they were requested
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LabelWriter:
+    """
+    Appends the labels of the finished handshakes to Client Requests.csv in the format of pandas.DataFrame.to_csv.
+    Rows are written in batches of batch_size, or after flush_interval seconds for the streaming feature extraction,
+    and every batch is synced to disk, so a crash loses at most the current batch instead of every label.
+    """
+
+    def __init__(self, csv_path: str, batch_size: int = 100, flush_interval: float = 5.0, resume: bool = False):
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.recorded_indices = set()
+        # Number of recorded handshakes of each (test case, skip flag), the plan of the remaining requests balances them
+        self.recorded_counts = Counter()
+        if resume:
+            self.read_recorded_requests()
+        self.csv_file = open(csv_path, 'a' if resume and os.path.exists(csv_path) else 'w', newline='')
+        self.writer = csv.writer(self.csv_file, lineterminator='\n')
+        if self.csv_file.tell() == 0:
+            self.writer.writerow([''] + LABEL_COLUMNS)
+            self.sync()
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def read_recorded_requests(self):
+        if not os.path.exists(self.csv_path):
+            return
+        with open(self.csv_path, 'rb') as csv_file:
+            content = csv_file.read()
+        # A crash may have left a partially written row, which is dropped and its handshake repeated
+        complete_length = content.rfind(b'\n') + 1
+        if complete_length < len(content):
+            print(f'Removing the partially written last row of {self.csv_path}')
+            with open(self.csv_path, 'r+b') as csv_file:
+                csv_file.truncate(complete_length)
+        rows = list(csv.reader(content[:complete_length].decode('utf-8').splitlines()))
+        for row in rows[1:]:
+            if len(row) == len(LABEL_COLUMNS) + 1:
+                self.recorded_indices.add(int(row[0]))
+                self.recorded_counts[(row[2], row[3] == 'True')] += 1
+
+    def append(self, request_index: int, result: tuple):
+        self.rows.append([request_index, *result])
+        self.recorded_counts[(result[1], result[2])] += 1
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+        self.sync()
+        self.last_flush = time.monotonic()
 
+    def sync(self):
+        self.csv_file.flush()
+        os.fsync(self.csv_file.fileno())
+
+    def close(self):
+        self.flush()
+        self.csv_file.close()
+
+
+def get_test_cases(twoclass: bool, oneclass: bool) -> list:
     if oneclass:
-        test_cases = ['Wrong_first_byte_(0x00_set_to_0x17)']
-    elif twoclass:
-        test_cases = ['Correctly_formatted_PKCS#1_PMS_message',
-                      'Invalid_TLS_version_in_PMS']
-    else:
-        test_cases = ['Correctly_formatted_PKCS#1_PMS_message',
-                      'Wrong_separator_(0x00_set_to_0x17)',
-                      'Invalid_TLS_version_in_PMS',
-                      'Wrong_first_byte_(0x00_set_to_0x17)',
-                      'Wrong_second_byte_(0x02_set_to_0x17)',
-                      'Wrong_separator_position_(44)']
-
-    current_case = choice(test_cases)
-    config_files.append(f'./tls_test_tool_client/config/{current_case}.conf')
+        return ['Wrong_first_byte_(0x00_set_to_0x17)']
+    if twoclass:
+        return ['Correctly_formatted_PKCS#1_PMS_message',
+                'Invalid_TLS_version_in_PMS']
+    return ALL_TEST_CASES
+
+
+def get_skip_options(enable_skip_ccs_fin: bool, enable_noskip_ccs_fin: bool) -> list:
+    if not enable_skip_ccs_fin and not enable_noskip_ccs_fin:
+        print('At least one of --skip or --noskip must be selected')
+        exit(1)
+    return [skip_ccs_fin for skip_ccs_fin, enabled in [(False, enable_noskip_ccs_fin), (True, enable_skip_ccs_fin)]
+            if enabled]
+
+
+def get_combinations(test_cases: list, skip_options: list) -> list:
+    return [(test_case, skip_ccs_fin) for test_case in test_cases for skip_ccs_fin in skip_options]
+
+
+def plan_sessions(repetitions: int, combinations: list, seed: int, recorded_counts: Counter = None) -> list:
+    """
+    Plans the (test case, skip flag) of the requests that are not recorded yet. The plan consists of shuffled blocks
+    that contain every combination once, so the classes stay balanced in every prefix of the run and all of them
+    reach the minimum number of instances of the cross-validation with the fewest handshakes. When resuming, the
+    blocks only contain the combinations that are still below their share of the repetitions.
+    """
+    rng = random.Random(seed)
+    recorded_counts = recorded_counts or Counter()
+    recorded = sum(recorded_counts[combination] for combination in combinations)
+    # The remainder of the repetitions is spread over randomly chosen combinations
+    extra = set(rng.sample(range(len(combinations)), repetitions % len(combinations)))
+    deficits = {combination: max(0, repetitions // len(combinations) + (i in extra) - recorded_counts[combination])
+                for i, combination in enumerate(combinations)}
+    plan = []
+    while len(plan) < repetitions - recorded:
+        block = [combination for combination in combinations if deficits[combination] > 0] or combinations
+        rng.shuffle(block)
+        for combination in block:
+            deficits[combination] -= 1
+        plan.extend(block)
+    return plan[:max(0, repetitions - recorded)]
+
+
+def get_config_files(sut_name: str, current_case: str, skip_ccs_fin: bool) -> list:
+    config_files = [f'{CONFIG_FOLDER}/base.conf',
+                    f'{CONFIG_FOLDER}/{sut_name}.conf',
+                    f'{CONFIG_FOLDER}/{current_case}.conf']
     if skip_ccs_fin:
-        config_files.append('./tls_test_tool_client/config/skip_change_cipher_spec_and_finished.conf')
+        config_files.append(f'{CONFIG_FOLDER}/skip_change_cipher_spec_and_finished.conf')
+    return config_files
+
+
+class ConfigBundles:
+    """
+    Merges the configuration files of every (test case, skip flag) of the system under test once into a single file,
+    so each TlsTestTool process opens one file instead of four. The tool applies the name-value pairs of its
+    configuration files in order, hence the lines of the files are concatenated in the order they were given.
+    """
+
+    def __init__(self, sut_name: str, bundle_folder: str):
+        self.sut_name = sut_name
+        self.bundle_folder = bundle_folder
+        self.bundles = dict()
+
+    def prepare(self, sessions):
+        os.makedirs(self.bundle_folder, exist_ok=True)
+        for current_case, skip_ccs_fin in sorted(set(sessions)):
+            self.get(current_case, skip_ccs_fin)
+        print(f'Merged {len(self.bundles)} configuration bundles into {self.bundle_folder}')
+
+    def get(self, current_case: str, skip_ccs_fin: bool) -> str:
+        if (current_case, skip_ccs_fin) not in self.bundles:
+            config_files = get_config_files(self.sut_name, current_case, skip_ccs_fin)
+            lines = [f'# Merged from {", ".join(config_files)}']
+            for config_file in config_files:
+                with open(config_file) as f:
+                    # Empty lines and comments are skipped by the tool as well
+                    lines.extend(line.rstrip('\r\n') for line in f if line.strip() and not line.startswith('#'))
+            bundle_path = f'{self.bundle_folder}/{self.sut_name}_{current_case}{"_skip" if skip_ccs_fin else ""}.conf'
+            with open(bundle_path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(bundle_path + '.tmp', bundle_path)
+            self.bundles[(current_case, skip_ccs_fin)] = bundle_path
+        return self.bundles[(current_case, skip_ccs_fin)]
+
+
+def get_call_array(use_sentinel: bool, config_file: str) -> list:
     if use_sentinel:
         call_array = ['./tls_test_tool_client/TlsTestToolSentinel']
     else:
         call_array = ['./tls_test_tool_client/TlsTestTool']
+    call_array.append(f'--configFile={config_file}')
+    return call_array
+
+
+async def run_single_session(request_index: int, bundles: ConfigBundles, use_sentinel: bool, current_case: str, skip_ccs_fin: bool) -> (str, str, bool):
+    call_array = get_call_array(use_sentinel, bundles.get(current_case, skip_ccs_fin))
     print(f'Starting client {request_index} with test case {current_case}{", skipping CCS&FIN" if skip_ccs_fin else ""}')
-    call_array.extend([f'--configFile={config_file}' for config_file in config_files])
 
-    # Start the tls test tool using popen, save log output to string
+    # Start the tls test tool as a subprocess of the event loop, save log output to string
     try:
-        pipes = subprocess.Popen(call_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        std_out, std_err = pipes.communicate()
+        process = await asyncio.create_subprocess_exec(*call_array, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        std_out, std_err = await process.communicate()
         std_out = std_out.decode('utf-8')
         std_err = std_err.decode('utf-8')
-        if pipes.returncode != 0:
+        if process.returncode != 0:
             print(std_out)
-            print(f'Return code: {pipes.returncode}')
+            print(f'Return code: {process.returncode}')
         if len(std_err):
             print(f'Stderr: {std_err}')
     except OSError as error:
         print(f'OSError {error}')
-        std_out = b''
+        std_out = ''
 
     client_hello_random = determine_client_hello_random(std_out)
-    time.sleep(wait_time * 0.001)
     return client_hello_random, current_case, skip_ccs_fin
 
 
-def run_multiple_clients(repetitions: int, sut_name: str, use_sentinel: bool, wait_time: float, skip: bool, noskip: bool, parallelization_factor: int, twoclass: bool, oneclass: bool):
-    request_arguments = [[index, sut_name, use_sentinel, wait_time, skip, noskip, twoclass, oneclass] for index in range(repetitions)]
-    with multiprocessing.Pool(processes=parallelization_factor) as pool:
-        results = pool.starmap(run_single_session, request_arguments)
-    results_dataframe = pandas.DataFrame(results, columns=['client_hello_random', 'label', 'skipped_ccs_fin'])
-    return results_dataframe
+async def run_multiple_clients(requests, bundles: ConfigBundles, use_sentinel: bool, concurrency: int, bucket: TokenBucket, label_writer: LabelWriter) -> int:
+    """
+    Runs the requests, pairs of request index and planned session, with at most concurrency TLS Test Tool processes at
+    a time, started at the rate of the token bucket. A fixed number of workers take the next request, so the Python
+    overhead does not grow with the number of repetitions. The labels are handed to the label writer as the handshakes
+    finish.
+    """
+    requests = iter(requests)
+    completed = 0
+
+    async def worker():
+        nonlocal completed
+        for request_index, (current_case, skip_ccs_fin) in requests:
+            await bucket.acquire()
+            result = await run_single_session(request_index, bundles, use_sentinel, current_case, skip_ccs_fin)
+            label_writer.append(request_index, result)
+            completed += 1
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    label_writer.flush()
+    return completed
+
+
+def get_label_name(current_case: str, skip_ccs_fin: bool) -> str:
+    # The label names of the classification, see pycsca.csv_reader.CSVReader
+    label = ' '.join(current_case.split('_')).title()
+    return label + ' Missing-CCS-FIN' if skip_ccs_fin else label
+
+
+def read_interim_verdicts(folder: str, evaluated_after: datetime):
+    """
+    Returns the labels the latest interim evaluation decided to leak, i.e. at least one classifier rejected the null
+    hypothesis after the Holm-Bonferroni correction, or None if there was no evaluation after the given time yet.
+    """
+    interim_path = f'{folder}/{INTERIM_RESULTS_FILE}'
+    if not os.path.exists(interim_path):
+        return None
+    interim_results = pandas.read_csv(interim_path)
+    if interim_results.empty:
+        return None
+    interim_results['Time'] = pandas.to_datetime(interim_results['Time'], format=INTERIM_TIME_FORMAT)
+    if interim_results['Time'].max() < evaluated_after:
+        return None
+    latest = interim_results.groupby(['Dataset', 'Model']).last().reset_index()
+    rejected = latest['fisher-pval-median-rejected'].astype(str) == 'True'
+    return set(latest.loc[rejected, 'Dataset'])
+
+
+async def run_adaptive_campaign(repetitions: int, combinations: list, seed: int, batch_size: int, folder: str, wait_time: float, bundles: ConfigBundles, use_sentinel: bool, concurrency: int, bucket: TokenBucket, label_writer: LabelWriter) -> int:
+    """
+    Spends the budget of repetitions in batches. After each batch the latest interim evaluation of the streaming
+    feature extraction is read, and the next batch only contains the manipulations that do not leak yet, together
+    with the correctly formatted messages they are compared to. The campaign ends early once every manipulation
+    leaks.
+    """
+    next_index = max(label_writer.recorded_indices, default=-1) + 1
+    budget = repetitions - sum(label_writer.recorded_counts.values())
+    decided = set()
+    completed, batch = 0, 0
+    while budget > 0:
+        undecided = [c for c in combinations if c[0] != CORRECT_CASE and get_label_name(*c) not in decided]
+        if len(undecided) == 0 and any(c[0] != CORRECT_CASE for c in combinations):
+            print(f'All manipulations leak according to the interim evaluation, stopping with {budget} requests left')
+            break
+        baselines = [c for c in combinations if c[0] == CORRECT_CASE and (len(undecided) == 0 or c[1] in {u[1] for u in undecided})]
+        active = baselines + undecided
+        size = min(batch_size, budget)
+        recorded = sum(label_writer.recorded_counts[c] for c in active)
+        plan = plan_sessions(recorded + size, active, seed + batch, label_writer.recorded_counts)
+        print(f'Batch {batch} of {len(plan)} requests for {[get_label_name(*c) for c in active]}')
+        completed += await run_multiple_clients(zip(range(next_index, next_index + len(plan)), plan), bundles, use_sentinel, concurrency, bucket, label_writer)
+        next_index += len(plan)
+        budget -= len(plan)
+        batch += 1
+        if budget <= 0:
+            break
+        batch_end = datetime.now()
+        waiting_since = time.monotonic()
+        verdicts = read_interim_verdicts(folder, batch_end)
+        while verdicts is None and time.monotonic() - waiting_since < wait_time:
+            await asyncio.sleep(5)
+            verdicts = read_interim_verdicts(folder, batch_end)
+        if verdicts is None:
+            print(f'No interim evaluation of batch {batch - 1} within {wait_time} seconds, keeping the manipulations')
+        else:
+            decided = verdicts
+            print(f'Interim evaluation decided {sorted(decided)}')
+    return completed
+
+
+def export_excel(csv_path: str, xlsx_path: str):
+    requests_dataframe = pandas.read_csv(csv_path, index_col=0).sort_index()
+    requests_dataframe.to_excel(xlsx_path)
 
 
 parser = argparse.ArgumentParser()
@@ -97,18 +348,70 @@ parser.add_argument('-s', '--sentinel', action='store_true',
 parser.add_argument('-n', '--name', required=True,
                     help='Name of the system under test, used to load the matching IP&port configuration')
 parser.add_argument('-w', '--wait', type=int, default=0,
-                    help='Wait time in milliseconds after each request before starting the next request')
+                    help='Wait time in milliseconds between the requests of each concurrent client, ignored if --rate is given')
+parser.add_argument('--rate', type=float, default=0,
+                    help='Maximum number of handshakes started per second, 0 for no limit')
+parser.add_argument('--burst', type=int, default=1,
+                    help='Number of handshakes that may start at once before the --rate limit applies')
 parser.add_argument('--skip', action='store_true', default=False,
                     help='Make some request where the client omits ChangeCipherSpec and Finished')
 parser.add_argument('--noskip', action='store_true', default=False,
                     help='Make some request where the client properly sends ChangeCipherSpec and Finished')
 parser.add_argument('--processes', type=int, default=1,
-                    help='Parallelization factor, how many processes to use concurrently')
+                    help='Parallelization factor, how many handshakes to run concurrently')
+parser.add_argument('--batchsize', type=int, default=100,
+                    help='Number of labels written to Client Requests.csv and synced to disk at once')
+parser.add_argument('--flushinterval', type=float, default=5.0,
+                    help='Seconds after which the labels are written even if the batch is not full')
+parser.add_argument('--resume', action='store_true', default=False,
+                    help='Continue an interrupted run, skipping the requests already recorded in Client Requests.csv')
+parser.add_argument('--xlsx', action='store_true', default=False,
+                    help='Additionally export the labels as Client Requests.xlsx once all handshakes finished')
 parser.add_argument('--twoclass', action='store_true', default=False,
                     help='Only choose between correct padding and wrong version number manipulations')
 parser.add_argument('--oneclass', action='store_true', default=False,
                     help='Instead of randomly choosing between all manipulations, choose only wrong first byte')
+parser.add_argument('--adaptive', action='store_true', default=False,
+                    help='Spend the repetitions in batches and only continue the manipulations that the interim '
+                    'evaluation did not find to leak yet, requires start.sh --streaming')
+parser.add_argument('--adaptivebatch', type=int, default=1000,
+                    help='Number of requests per batch of the adaptive campaign')
+parser.add_argument('--adaptivewait', type=float, default=900,
+                    help='Seconds to wait for the interim evaluation of a batch before continuing without it')
+parser.add_argument('--seed', type=int, default=None,
+                    help='Seed of the shuffled plan of manipulations, a random seed is chosen and printed if not given')
 args = parser.parse_args()
-request_results = run_multiple_clients(args.repetitions, args.name, args.sentinel, args.wait, args.skip, args.noskip, args.processes, args.twoclass, args.oneclass)
-request_results.to_csv(f'{args.folder}/Client Requests.csv')
-request_results.to_excel(f'{args.folder}/Client Requests.xlsx')
+plan_seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+request_rate = args.rate
+if not request_rate and args.wait > 0:
+    # The same throughput as each concurrent client waiting between its requests
+    request_rate = args.processes * 1000.0 / args.wait
+plan_test_cases = get_test_cases(args.twoclass, args.oneclass)
+plan_skip_options = get_skip_options(args.skip, args.noskip)
+requests_csv_path = f'{args.folder}/Client Requests.csv'
+requests_label_writer = LabelWriter(requests_csv_path, args.batchsize, args.flushinterval, args.resume)
+if args.resume:
+    print(f'Resuming, {len(requests_label_writer.recorded_indices)} of {args.repetitions} requests are already recorded')
+plan_combinations = get_combinations(plan_test_cases, plan_skip_options)
+config_bundles = ConfigBundles(args.name, f'{args.folder}/{BUNDLE_FOLDER}')
+config_bundles.prepare(plan_combinations)
+
+
+async def run_client():
+    bucket = TokenBucket(request_rate, args.burst)
+    if args.adaptive:
+        print(f'Adaptive campaign with seed {plan_seed}')
+        return await run_adaptive_campaign(args.repetitions, plan_combinations, plan_seed, args.adaptivebatch, args.folder, args.adaptivewait, config_bundles, args.sentinel, args.processes, bucket, requests_label_writer)
+    session_plan = plan_sessions(args.repetitions, plan_combinations, plan_seed, requests_label_writer.recorded_counts)
+    print(f'Planned {len(session_plan)} requests with seed {plan_seed}: {dict(Counter(session_plan))}')
+    request_indices = (index for index in range(args.repetitions) if index not in requests_label_writer.recorded_indices)
+    return await run_multiple_clients(zip(request_indices, session_plan), config_bundles, args.sentinel, args.processes, bucket, requests_label_writer)
+
+
+try:
+    completed_requests = asyncio.run(run_client())
+finally:
+    requests_label_writer.close()
+print(f'Finished {completed_requests} requests')
+if args.xlsx:
+    export_excel(requests_csv_path, f'{args.folder}/Client Requests.xlsx')